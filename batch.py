@@ -0,0 +1,113 @@
+"""
+Пакетный режим: выравнивание сразу многих пар рипов (например, целого сезона) в пуле процессов.
+Запуск: python batch.py <манифест.json или директория сезона> [файл отчёта]
+
+Манифест - JSON-список заданий вида {"name": "s06e24", "media": ["рип_сабов.mkv", "новый_рип.mkv"],
+"subs": ["English.ass", "Russian.ass"]}, пути в нём относительно директории манифеста.
+В директории сезона каждая поддиректория - одно задание: в ней лежат source.* (рип, к которому подогнаны сабы),
+target.* (рип, к которому их надо подвинуть) и сколько угодно *.ass и *.srt.
+Для каждого задания путь пишется в path.log рядом с первым сабом (или рядом с target), сдвинутые сабы -
+в *_shifted.ass (*_shifted.srt), а итоги всех заданий (статус, ошибка, время этапов) - в файл отчёта,
+по умолчанию Config.BATCH_SUMMARY.
+"""
+import json
+import sys
+import traceback
+from multiprocessing import Pool, BoundedSemaphore
+from os import path, listdir
+from time import perf_counter
+
+import media
+import metrics
+from config import Config
+from main import find_path, write_path, shift_files, delete_files, subtitle_times
+
+
+def read_manifest(filename):
+    with open(filename, encoding='utf-8') as f:
+        jobs = json.load(f)
+    base = path.dirname(path.abspath(filename))
+    for job in jobs:
+        job['media'] = [path.join(base, i) for i in job['media']]
+        job['subs'] = [path.join(base, i) for i in job.get('subs', [])]
+        job.setdefault('name', path.basename(job['media'][1]))
+    return jobs
+
+
+def read_directory(dirname):
+    jobs = []
+    for name in sorted(listdir(dirname)):
+        episode = path.join(dirname, name)
+        if not path.isdir(episode):
+            continue
+        files = sorted(listdir(episode))
+        found = {role: [path.join(episode, i) for i in files if path.splitext(i)[0] == role]
+                 for role in ('source', 'target')}
+        if len(found['source']) != 1 or len(found['target']) != 1:
+            print("Skipping {}: exactly one source.* and one target.* file are needed".format(episode))
+            continue
+        subs = [path.join(episode, i) for i in files
+                if path.splitext(i)[1] in ('.ass', '.srt') and not path.splitext(i)[0].endswith('_shifted')]
+        jobs.append({'name': name, 'media': found['source'] + found['target'], 'subs': subs})
+    return jobs
+
+
+def init_worker(decode_slots):
+    media.decode_slots = decode_slots
+    # Задания и так идут параллельно, а процессы пула не могут заводить своих детей
+    Config.PARALLEL_PREPARE, Config.SEARCH_WORKERS, Config.SHIFT_WORKERS = False, 1, 1
+    Config.PROGRESS = False  # Строки прогресса из разных процессов перемешались бы
+
+
+def run_job(job):
+    """Выполняется в процессе пула; исключения не пробрасываются, а попадают в отчёт"""
+    report, stamp, to_delete = {'name': job['name'], 'timings': {}}, perf_counter(), set()
+    metrics.start(job['name'])
+    try:
+        final_path = find_path(job['media'], to_delete, subtitle_times(job['subs']))
+        report['timings']['alignment'] = perf_counter() - stamp
+        write_path(final_path, path.join(path.dirname((job['subs'] or job['media'][1:])[0]), 'path.log'))
+        shift_stamp = perf_counter()
+        shift_files(job['subs'], final_path)
+        report['timings']['shift'] = perf_counter() - shift_stamp
+        report['status'] = 'ok'
+    except Exception:
+        report['status'], report['error'] = 'failed', traceback.format_exc()
+    finally:
+        if not Config.SAVE_WAV:
+            delete_files(to_delete)
+    report['timings']['total'] = perf_counter() - stamp
+    tree = metrics.finish()
+    if tree is not None:
+        report['metrics'] = tree  # Замеры по этапам, если они включены в Config.METRICS_FILE или Config.PROGRESS
+    return report
+
+
+def run_batch(jobs, summary_file=None):
+    """
+    Прогоняет задания в пуле из Config.BATCH_WORKERS процессов, при этом одновременно работают не больше
+    Config.BATCH_DECODES декодеров: декодирование упирается в диск, а поиск пути - в процессор.
+    """
+    stamp, reports = perf_counter(), []
+    pool = Pool(Config.BATCH_WORKERS, initializer=init_worker, initargs=(BoundedSemaphore(Config.BATCH_DECODES),))
+    try:
+        for report in pool.imap_unordered(run_job, jobs):
+            print("Job {0[name]}: {0[status]} in {0[timings][total]:.2f} sec".format(report))
+            reports.append(report)
+    finally:
+        pool.close()
+        pool.join()
+    summary = {'jobs': sorted(reports, key=lambda i: i['name']), 'total': perf_counter() - stamp,
+               'failed': sum(report['status'] != 'ok' for report in reports)}
+    with open(summary_file or Config.BATCH_SUMMARY, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    print("{0} jobs done, {1} failed, {2:.2f} sec".format(len(reports), summary['failed'], summary['total']))
+    return summary
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print(__doc__)
+        sys.exit(1)
+    source = sys.argv[1]
+    run_batch(read_directory(source) if path.isdir(source) else read_manifest(source), *sys.argv[2:])
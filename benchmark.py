@@ -0,0 +1,269 @@
+"""
+Замеры скорости и точности на синтетических звуковых дорожках с известным сдвигом.
+Запуск: python benchmark.py [файл результатов.json] [длины в секундах через пробел]
+
+Для каждого сценария из SCENARIOS и каждой длины из LENGTHS строится пара сигналов, в которой второй получен
+из первого известными правками: вырезанными и вставленными кусками, сдвигом начала, небольшим изменением скорости,
+шумом и сменой громкости. Пара проходит весь путь Spectrogram -> full_search -> shift_subs на расставленных
+по первому сигналу событиях, и их новые тайминги сравниваются с истинными.
+"""
+import io
+import json
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from copy import deepcopy
+from fractions import Fraction
+from time import perf_counter
+
+import numpy as np
+from scipy.signal import resample_poly
+
+import metrics
+from config import Config
+from main import shift_subs
+from online import OnlineAligner
+from spectrum import Spectrogram, Comparator, StreamFeatures
+from util import Subs, Event, Timing
+
+LENGTHS = (60, 600, 1800, 7200)
+# Правки применяются ко второму сигналу. Доли - от длины первого, остальное - в секундах
+SCENARIOS = {
+    'remove': [('remove', (0.3, 0.34))],
+    'insert': [('insert', (0.5, 20.))],
+    'offset': [('offset', 7.3)],
+    'speed': [('speed', 1.0005)],
+    'noise': [('noise', 0.05)],
+    'loudness': [('gain', 0.3)],
+    'recap': [('insert', (0.1, 90.)), ('repeat', (0.5, 0.2, 0.3)), ('repeat', (0.8, 0.05, 0.1))],
+    'mixed': [('offset', -4.1), ('remove', (0.2, 0.23)), ('insert', (0.6, 15.)), ('noise', 0.02), ('gain', 0.5)],
+}
+
+
+def synthetic_signal(seconds, rate, rng):
+    """Случайные тоны с гауссовыми огибающими; каждый тон считается только на своём окне, так что время линейно"""
+    n = int(seconds * rate)
+    signal = np.zeros(n)
+    for _ in range(int(seconds) * 3):
+        freq, start, length = rng.uniform(100, rate/2 - 100), rng.uniform(0, seconds), rng.uniform(0.1, 1.5)
+        center = start + length/2
+        begin, end = max(int((center - 1.5*length) * rate), 0), min(int((center + 1.5*length) * rate) + 1, n)
+        t = np.arange(begin, end) / rate
+        signal[begin:end] += rng.uniform(0.2, 1) * np.exp(-((t - center) / (length/2))**2) * np.sin(2*np.pi*freq*t)
+    return signal / max(np.abs(signal).max(), 1e-9)
+
+
+def to_int16(signal):
+    return (np.clip(signal, -1, 1) * 32767).astype(np.int16)
+
+
+def apply_edits(source, rate, edits, rng):
+    """
+    Второй сигнал по первому и правкам edits (см. SCENARIOS).
+    Возвращает его и истинное соответствие: список кусков (начало в первом, начало во втором, длина) в отсчётах
+    первого сигнала и коэффициент, на который умножаются отсчёты второго после изменения скорости.
+    """
+    n = len(source)
+    cuts, inserts, speed, noise, gain = [], [], 1., 0., 1.
+    for kind, value in edits:
+        if kind == 'remove':
+            cuts.append(tuple(int(n * i) for i in value))
+        elif kind == 'insert':
+            inserts.append((int(n * value[0]), int(value[1] * rate), None))
+        elif kind == 'repeat':  # Повтор уже бывшего куска (рекап): (куда вставить, начало и конец куска) в долях
+            inserts.append((int(n * value[0]), int(n * value[2]) - int(n * value[1]), int(n * value[1])))
+        elif kind == 'offset':
+            if value > 0:
+                inserts.append((0, int(value * rate), None))
+            else:
+                cuts.append((0, int(-value * rate)))
+        elif kind == 'speed':
+            speed = value
+        elif kind == 'noise':
+            noise = value
+        elif kind == 'gain':
+            gain = value
+        else:
+            raise ValueError("Unknown edit: {}".format(kind))
+    keep = np.ones(n + 1, dtype=bool)
+    for begin, end in cuts:
+        keep[begin:end] = False
+    points = sorted({0, n} | {i for cut in cuts for i in cut} | {insert[0] for insert in inserts})
+    pieces, mapping, length = [], [], 0
+    for begin, end in zip(points, points[1:] + [None]):
+        for position, size, copy in inserts:
+            if position == begin:
+                pieces.append(synthetic_signal(size / rate, rate, rng) if copy is None else source[copy:copy + size])
+                length += size
+        if end is not None and keep[begin]:
+            pieces.append(source[begin:end])
+            mapping.append((begin, length, end - begin))
+            length += end - begin
+    target = np.concatenate(pieces)
+    ratio = Fraction(speed).limit_denominator(10000)
+    if ratio != 1:  # Ускорение в speed раз - это передискретизация в 1/speed раз
+        target = resample_poly(target, ratio.denominator, ratio.numerator)
+    target = target * gain + rng.normal(0, noise, len(target)) if noise else target * gain
+    return target, mapping, ratio.denominator / ratio.numerator
+
+
+def synthetic_pair(seconds, rate=Config.DEFAULT_HZ, cut=(0.3, 0.4), seed=31168):
+    """
+    Пара сигналов: случайные тоны с огибающими и второй сигнал - тот же самый, но без куска cut
+    (доли от длины первого) и немного зашумлённый.
+    """
+    rng = np.random.RandomState(seed)
+    first = synthetic_signal(seconds, rate, rng)
+    second, _, _ = apply_edits(first, rate, [('remove', cut), ('noise', 0.01)], rng)
+    return [to_int16(i) for i in (first, second)]
+
+
+def synthetic_events(seconds, rng):
+    """События по всей длине первого сигнала: каждые 2-6 секунд реплика длиной 1-3 секунды"""
+    subs, stamp = Subs(), rng.uniform(0, 2)
+    while stamp + 3 < seconds:
+        begin, end = int(stamp * 100), int((stamp + rng.uniform(1, 3)) * 100)
+        subs.events.append(Event('0,{0},{1},Default,,0,0,0,,Line {2}'.format(Timing.to_string(begin),
+                                                                            Timing.to_string(end), len(subs.events))))
+        stamp += rng.uniform(2, 6)
+    return subs
+
+
+def true_times(times, rate, mapping, ratio, margin):
+    """
+    Истинные моменты во втором сигнале для моментов times первого (в сантисекундах) или nan для тех,
+    что вырезаны или лежат ближе margin отсчётов к краю куска: там выравнивание неоднозначно по самой постановке.
+    """
+    samples = np.asarray(times) * rate / 100
+    result = np.full(len(samples), np.nan)
+    for begin, target_begin, length in mapping:
+        inside = (samples >= begin + margin) & (samples <= begin + length - margin)
+        result[inside] = (samples[inside] - begin + target_begin) * ratio * 100 / rate
+    return result
+
+
+def scenario(name, seconds, rate=Config.DEFAULT_HZ, seed=31168):
+    """Сигналы сценария name, события по первому и истинные моменты их начал и концов во втором (см. true_times)"""
+    rng = np.random.RandomState(seed)
+    source = synthetic_signal(seconds, rate, rng)
+    target, mapping, ratio = apply_edits(source, rate, SCENARIOS[name], rng)
+    subs = synthetic_events(seconds, rng)
+    times = [event.timing.begin_ss for event in subs] + [event.timing.end_ss for event in subs]
+    return source, target, subs, true_times(times, rate, mapping, ratio, rate // 2)
+
+
+def timing_errors(subs, truth):
+    """Ошибки в сантисекундах сдвинутых начал и концов событий там, где истинный момент известен"""
+    shifted = np.array([event.timing.begin_ss for event in subs] + [event.timing.end_ss for event in subs])
+    return np.abs(shifted - truth)[~np.isnan(truth)]
+
+
+def run_case(name, seconds, rate=Config.DEFAULT_HZ, seed=31168, feature_kind=None):
+    """
+    Прогоняет один сценарий: время этапов, пик памяти процесса после каждого этапа, ошибка таймингов
+    в сантисекундах и подробные замеры из metrics. Чтобы пики памяти не смешивались, run_suite вызывает его
+    каждый раз в новом процессе. feature_kind, если задан, заменяет Config.FEATURES в этом процессе.
+    """
+    if feature_kind is not None:
+        Config.FEATURES = feature_kind
+    source, target, subs, truth = scenario(name, seconds, rate, seed)
+    begins = np.array([event.timing.begin_ss for event in subs])
+    ends = np.array([event.timing.end_ss for event in subs])
+    timings, memory = {}, {'input': metrics.peak_rss()}
+    metrics.start(name, force=True)
+    with redirect_stdout(io.StringIO()):
+        for stage in ('spectrogram', 'search', 'shift'):
+            stamp = perf_counter()
+            with metrics.span(stage):
+                if stage == 'spectrogram':
+                    spectrums = [Spectrogram('synthetic', (rate, to_int16(i))) for i in (source, target)]
+                elif stage == 'search':
+                    focus = np.concatenate((begins, ends)) if Config.LAZY_WINDOW is not None else None
+                    final_path = Comparator(*spectrums).full_search(focus=focus)
+                else:
+                    shift_subs(subs, final_path.time_map())
+            timings[stage] = perf_counter() - stamp
+            memory[stage] = metrics.peak_rss()
+    tree = metrics.finish()
+    errors = timing_errors(subs, truth)
+    return {'scenario': name, 'seconds': seconds, 'features': Config.FEATURES, 'timings': timings, 'peak_rss': memory,
+            'error': {'stamps': len(errors), 'mean': float(np.mean(errors)), 'median': float(np.median(errors)),
+                      'p95': float(np.percentile(errors, 95)), 'max': float(np.max(errors)),
+                      'within_10ss': float(np.mean(errors <= 10))} if len(errors) else None,
+            'path': repr(final_path), 'metrics': tree}
+
+
+def run_suite(lengths=LENGTHS, scenarios=None, output='benchmark.json'):
+    """Все сценарии на всех длинах; результаты вместе с настройками пишутся в output в JSON"""
+    results = []
+    for seconds in lengths:
+        for name in scenarios or sorted(SCENARIOS):
+            with ProcessPoolExecutor(1) as pool:
+                result = pool.submit(run_case, name, seconds).result()
+            error = result['error'] or {'mean': float('nan'), 'max': float('nan')}
+            print("{0:>8} {1:>5} sec: {2} sec; peak {3:.0f} MB; error mean {4[mean]:.1f} ss, max {4[max]:.0f} ss"
+                  .format(name, seconds, ', '.join('{0} {1:.2f}'.format(*i) for i in result['timings'].items()),
+                          result['peak_rss']['shift'] / 2**20, error))
+            results.append(result)
+    settings = {key: value for key, value in vars(Config).items() if key.isupper() and key != 'VISUAL'}
+    summary = {'config': settings, 'results': results}
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+def compare_engines(seconds=300, engines=('dict', 'wavefront')):
+    """Прогоняет full_search каждым из движков на одних и тех же данных и сравнивает время и результат."""
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, signal)) for signal in synthetic_pair(seconds)]
+    results = {}
+    for engine in engines:
+        stamp = perf_counter()
+        final_path = Comparator(*spectrums).full_search(engine=engine)
+        results[engine] = (perf_counter() - stamp, repr(final_path))
+    for engine in engines:
+        print("{0}: {1:.2f} sec".format(engine, results[engine][0]))
+    paths = set(result[1] for result in results.values())
+    print("Paths are {}".format("equal: " + paths.pop() if len(paths) == 1 else "different!"))
+    return results
+
+
+def compare_features(seconds=300, scenarios=None, kinds=('linear', 'mel', 'log')):
+    """Прогоняет сценарии с каждым видом признаков (Config.FEATURES) и сравнивает время, память и ошибку"""
+    results = []
+    for name in scenarios or sorted(SCENARIOS):
+        for kind in kinds:
+            with ProcessPoolExecutor(1) as pool:
+                result = pool.submit(run_case, name, seconds, feature_kind=kind).result()
+            error = result['error'] or {'mean': float('nan'), 'max': float('nan')}
+            print("{0:>8} {1:>6}: search {2:.2f} sec; peak {3:.0f} MB; error mean {4[mean]:.1f} ss, max {4[max]:.0f} ss"
+                  .format(name, kind, result['timings']['search'], result['peak_rss']['shift'] / 2**20, error))
+            results.append(result)
+    return results
+
+
+def compare_online(seconds=300, scenarios=None, rate=Config.DEFAULT_HZ):
+    """
+    Сдвигает события сценариев полным поиском и OnlineAligner, которому второй сигнал подаётся кусками
+    по Config.STREAM_CHUNK секунд, и сравнивает наибольшие ошибки таймингов
+    """
+    results = {}
+    for name in scenarios or sorted(SCENARIOS):
+        source, target, subs, truth = scenario(name, seconds, rate)
+        offline, online = deepcopy(subs), deepcopy(subs)
+        with redirect_stdout(io.StringIO()):
+            spectrums = [Spectrogram('synthetic', (rate, to_int16(i))) for i in (source, target)]
+            shift_subs(offline, Comparator(*spectrums).full_search().time_map())
+            aligner, features, signal = OnlineAligner(spectrums[0], online), StreamFeatures(rate), to_int16(target)
+            step = int(Config.STREAM_CHUNK * rate)
+            for start in range(0, len(signal), step):
+                aligner.push(features.push(signal[start:start + step]))
+            aligner.push(features.finish())
+            aligner.finish()
+        results[name] = tuple(float(np.max(timing_errors(i, truth), initial=0)) for i in (offline, online))
+        print("{0:>8}: error max {1[0]:.0f} ss offline, {1[1]:.0f} ss online".format(name, results[name]))
+    return results
+
+
+if __name__ == '__main__':
+    run_suite(output=sys.argv[1] if len(sys.argv) > 1 else 'benchmark.json',
+              lengths=[int(i) for i in sys.argv[2:]] or LENGTHS)
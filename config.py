@@ -4,17 +4,68 @@ class Config:
     LOG_FILE = 'log.out'  # файл, в который выводится путь
     TEXT_FILE = None if MEDIA else LOG_FILE  # Вместо указания видео можно взять предподсчитанный путь из файла
     ASS_FILES = ['Sub_MLPFiM_S06E24_English.ass', 'Sub_MLPFiM_S06E24_Russian.ass']  # Список всех сабов, которые нужно подвинуть
-    # TODO: Сделать возможность одновременно двигать и сливать несколько сабов воедино
+    # (.ass или .srt); каждый пишется рядом в *_shifted.ass (*_shifted.srt)
+    MERGED_FILE = None  # Если задан файл .ass или .srt, все сдвинутые сабы ещё и сливаются в него
+    SHIFT_WORKERS = 4  # Во сколько процессов двигать сабы; 1 - по очереди в основном процессе
+    DECODER = ['ffmpeg']  # Чем вынимать звук; без FFmpeg wav-файлы можно подавать через ['python', 'wav_decoder.py']
+    DECODE_MODE = 'pipe'  # 'pipe' - читать звук из stdout декодера прямо в память, 'wav' - через временные wav-файлы
+    PIPE_FORMAT = 's16le'  # Формат сырого звука в режиме 'pipe': 's16le' или 'f32le'
+    # Следующие две настройки имеют смысл только в режиме DECODE_MODE = 'wav'
     REWRITE_WAV = False  # Переписать имеющиеся временные файлы в директории
     SAVE_WAV = True  # Сохранить временные файлы, имеет смысл только если при следующем запуске REWRITE_WAV = False
+    PARALLEL_PREPARE = True  # Декодировать оба видео и строить их спектрограммы одновременно в разных процессах
     DEFAULT_HZ = 4000  # Частота, в которой вынимаются звуковые файлы из видео
+    SPEC_CHUNK = 2**16  # Сколько векторов базовой спектрограммы считать за раз; None - всю сразу одним куском
+    SPEC_MEMMAP_DIR = None  # Если задана директория, базовая спектрограмма пишется туда .npy-файлом через mmap
+    CACHE_DIR = None  # Директория для кэша спектрограмм между запусками; None - не кэшировать
+    CACHE_SIZE = 2**32  # Сколько байт может занимать кэш, давно не использованные записи удаляются
+    CACHE_PYRAMID = False  # Кэшировать ли, кроме базовой спектрограммы, все уровни, построенные при поиске
+    FEATURES = 'linear'  # Во что проецировать спектр (features.py): 'linear' - все частоты как есть, 'mel' - полосы
+    FEATURE_BANDS = 24  # по шкале мел, 'log' - полосы с границами в геом. прогрессии; сколько этих полос
+    FEATURE_MIN_HZ = 50  # и с какой частоты они начинаются
+    MEMORY_BUDGET = None  # Сколько байт можно занять на пару медиафайлов (memory.py); None - всё во float64 без оценки
+    FLOAT16_MULT = 8  # Если float32 не хватает, единичные векторы уровней начиная с этого хранятся во float16
+    OVER_BUDGET = 'disk'  # Если не влезает и так: 'disk' - спектрограммы во временных файлах, 'refuse' - MemoryError
     BASE_TICK = 1.  # Размер минимальной единицы, по которой строится спектрограмма, в сантисекундах
     PRECISION = 4   # Точность, с которой нужно прокладывать путь в графе, в BASE_TICK'ах
     # Каждое следующее окно перескается с предыдущим по доле 1-1/OVERLAP_DEGREE
     B_OVERLAP_DEGREE = 3   # при построении спектрограммы по сигналу
     C_OVERLAP_DEGREE = 3   # при взятии среднего по уже полученной спектрограмме
     SAMPLE_SIZE = 3000  # Размер выборки при подсчёте среднего расстояния между векторами
+    SEED = 31168  # Зерно для этой выборки, чтобы результаты повторялись от запуска к запуску
+    LOCAL_AV_COST = None  # Если задано число секунд, среднее расстояние считается своё в каждом окне такой длины
+    LOCAL_SAMPLE_SIZE = 300  # вдоль пути (чтобы тихие и громкие сцены штрафовались одинаково), по стольким парам в окне
+    SEARCH_ENGINE = 'wavefront'  # 'wavefront' - поиск целыми срезами на numpy, 'dict' - старый поточечный
     RADIUS = 6  # В какой окрестности нужно искать путь
+    ADAPTIVE_RADIUS = False  # Сужать полосу до MIN_RADIUS вдали от изломов грубого пути и расширять (до MAX_RADIUS)
+    MIN_RADIUS = 2  # (не меньше 1) там, где найденный путь упёрся в её край или свернул
+    MAX_RADIUS = 24
+    TRACEBACK_MEMORY = None  # Сколько байт можно занять кодами решений в полосе; если больше, путь ищется делением
+    # пополам с памятью порядка ширины полосы (Comparator._split_solve). Каждое деление - ещё проход по полосе: если
+    # коды в 2^k раз больше порога, поиск на уровне примерно в k раз дольше. None - без ограничения
+    SEARCH_WORKERS = 1  # Во сколько процессов уточнять путь: больше 1 - путь режется на куски по грубому уровню
+    SEGMENT_SLICES = 64  # Наименьшая длина куска в срезах на уровне, где путь режется
+    SEGMENT_OVERLAP = 8  # и на сколько срезов этого уровня соседние куски перекрываются в каждую сторону от разреза
+    LAZY_WINDOW = None  # Если задано число секунд, подробные уровни считаются только в окнах такой ширины в каждую
+    LAZY_MULT = 16  # сторону от начал и концов событий сабов, а между ними остаётся путь уровня LAZY_MULT
+    ANCHORS = False  # Начинать поиск не с самого грубого уровня, а с пути через якоря по отпечаткам (landmarks.py)
+    ANCHOR_PEAKS = 10  # Сколько самых сильных спектральных пиков в секунду брать в отпечатки
+    ANCHOR_NEIGHBOURHOOD = (0.2, 3)  # Пик - максимум в окрестности из стольких секунд и частотных полос в обе стороны
+    ANCHOR_FAN = 5  # С каждым пиком в пару берётся столько следующих за ним
+    ANCHOR_ZONE = 2.  # если они не дальше стольких секунд
+    ANCHOR_MAX_HITS = 64  # Отпечатки, встречающиеся чаще, не ищутся: это тишина или однообразный фон
+    ANCHOR_WINDOW = 10.  # Совпадения голосуют за сдвиг в своём окне из стольких секунд
+    ANCHOR_VOTES = 8  # и сдвиг становится якорем, набрав столько голосов
     PENALTY = 15  # Штраф за переход с диагонального на вертикальное и наоборот, выраженный в средних расстояниях
     NONDIAGKOEF = 1.3  # Длина любого вертикального или горизонтального ребра в средних расстояниях
-    VISUAL = None  # Сохранённая копия картинки в виде numpy-массива, можно использовать из питон-консоли
+    BATCH_WORKERS = 4  # Пакетный режим (batch.py): сколько заданий выполнять одновременно
+    BATCH_DECODES = 2  # и сколько из них могут одновременно декодировать видео
+    BATCH_SUMMARY = 'batch_summary.json'  # Куда писать отчёт о заданиях
+    STREAM_RADIUS = 60  # Выравнивание потока (online.py): в окне из скольких секунд эталона в каждую сторону искать
+    STREAM_LAG = 20  # Наибольшая задержка в секундах, после которой путь фиксируется, даже если он ещё не ясен
+    STREAM_CHUNK = 1.  # По сколько секунд звука потока читать из декодера
+    METRICS_FILE = None  # Куда писать время, счётчики и пики памяти этапов работы в JSON; None - не писать
+    PROGRESS = False  # Показывать в stderr строку прогресса текущего этапа
+    IMAGE_SIZE = 4096  # Comparator.image: наибольшая сторона картинки в режиме 'overview'
+    IMAGE_TILE = 1024  # и размер блоков, которыми она считается
+    VISUAL = None  # Сохранённая копия картинки в виде numpy-массива uint8, можно использовать из питон-консоли
@@ -0,0 +1,120 @@
+"""Кэш спектрограмм на диске, чтобы при повторных запусках не декодировать и не пересчитывать одни и те же файлы."""
+import hashlib
+import json
+import os
+import shutil
+from os import path
+
+import numpy as np
+
+from config import Config
+from spectrum import Spectrogram
+
+
+class FeatureCache:
+    """
+    Каждая запись - директория с base.npy (базовая спектрограмма), уровнями пирамиды level_*.npy и meta.json.
+    Ключ записи - хэш содержимого исходного медиафайла вместе с настройками, от которых зависит базовая спектрограмма.
+    Время последнего использования записи - mtime её meta.json; при превышении Config.CACHE_SIZE удаляются
+    давно не использованные записи.
+    """
+    def __init__(self, dirname=None, max_size=None):
+        self._dirname = dirname or Config.CACHE_DIR
+        self._max_size = max_size if max_size is not None else Config.CACHE_SIZE
+        self._hashes = {}  # Путь к файлу : хэш его содержимого, чтобы не читать файл дважды за запуск
+        os.makedirs(self._dirname, exist_ok=True)
+
+    def content_hash(self, filename):
+        if filename not in self._hashes:
+            sha = hashlib.sha1()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(2**20), b''):
+                    sha.update(block)
+            self._hashes[filename] = sha.hexdigest()
+        return self._hashes[filename]
+
+    def _entry(self, filename):
+        key = '{0}_{1}_{2}_{3}'.format(self.content_hash(filename), Config.DEFAULT_HZ, Config.BASE_TICK,
+                                       Config.B_OVERLAP_DEGREE)
+        decoding = Config.PIPE_FORMAT if Config.DECODE_MODE == 'pipe' else Config.DECODE_MODE
+        if decoding != 's16le':  # Сигнал из f32le или wav-файла другой; s16le из pipe остаётся под прежними ключами
+            key += '_{0}'.format(decoding)
+        if Config.FEATURES != 'linear':  # Так записи без проекции остаются под прежними ключами
+            key += '_{0}_{1}_{2}'.format(Config.FEATURES, Config.FEATURE_BANDS, Config.FEATURE_MIN_HZ)
+        if Config.MEMORY_BUDGET is not None:  # Тип хранения (memory.plan) зависит от бюджета и размера файла
+            key += '_{0}_{1}_{2}'.format(Config.MEMORY_BUDGET, Config.FLOAT16_MULT, Config.OVER_BUDGET)
+        return path.join(self._dirname, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    @staticmethod
+    def _pyramid_key():
+        # Уровни пирамиды зависят ещё и от этих настроек
+        return '{0}_{1}'.format(Config.PRECISION, Config.C_OVERLAP_DEGREE)
+
+    def _level_name(self, mult):
+        return 'level_{0}_{1}.npy'.format(self._pyramid_key(), mult)
+
+    def load(self, filename):
+        """Spectrogram для filename из кэша (массивы открываются через mmap) или None, если записи нет"""
+        entry = self._entry(filename)
+        meta_file = path.join(entry, 'meta.json')
+        if not path.isfile(meta_file):
+            return None
+        with open(meta_file) as f:
+            meta = json.load(f)
+        os.utime(meta_file)
+        levels = {}
+        for mult in meta['levels'].get(self._pyramid_key(), []):
+            levels[mult] = np.load(path.join(entry, self._level_name(mult)), mmap_mode='r')
+        print("Spectrogram of {} is taken from cache".format(filename))
+        return Spectrogram(filename, cached=(meta['rate'], np.load(path.join(entry, 'base.npy'), mmap_mode='r'), levels))
+
+    def store(self, filename, spectrogram):
+        """
+        Кладёт в кэш базовую спектрограмму, а если Config.CACHE_PYRAMID, то и уже построенные уровни пирамиды.
+        Можно вызывать повторно для того же файла, например, после full_search, чтобы дописать уровни.
+        """
+        entry = self._entry(filename)
+        os.makedirs(entry, exist_ok=True)
+        meta_file = path.join(entry, 'meta.json')
+        meta = {'source': filename, 'rate': int(spectrogram.rate), 'levels': {}}
+        if path.isfile(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+        else:
+            self._save(path.join(entry, 'base.npy'), spectrogram.base_spec)
+        if Config.CACHE_PYRAMID:
+            stored = set(meta['levels'].get(self._pyramid_key(), []))
+            for mult, spec in spectrogram.levels.items():
+                if mult not in stored:
+                    self._save(path.join(entry, self._level_name(mult)), spec)
+                    stored.add(mult)
+            meta['levels'][self._pyramid_key()] = sorted(stored)
+        with open(meta_file + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_file + '.tmp', meta_file)  # Запись считается готовой, только когда есть meta.json
+        self._evict(keep=entry)
+
+    @staticmethod
+    def _save(filename, array):
+        with open(filename + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(filename + '.tmp', filename)
+
+    def _evict(self, keep):
+        """Удаляет давно не использованные записи, пока кэш не влезет в Config.CACHE_SIZE байт"""
+        entries = []
+        for name in os.listdir(self._dirname):
+            entry = path.join(self._dirname, name)
+            if not path.isdir(entry):
+                continue
+            meta_file = path.join(entry, 'meta.json')
+            used = path.getmtime(meta_file) if path.isfile(meta_file) else 0
+            size = sum(path.getsize(path.join(entry, i)) for i in os.listdir(entry))
+            entries.append((used, size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self._max_size:
+                break
+            if entry != keep:
+                shutil.rmtree(entry, ignore_errors=True)
+                total -= size
@@ -0,0 +1,60 @@
+"""
+Признаки, в которые проецируется каждый вектор базовой спектрограммы до построения пирамиды (Config.FEATURES).
+Проекция - одно умножение на матрицу (частоты) x (полосы), так что она делается прямо по кускам спектрограммы,
+пока они считаются, и дальше вся пирамида, расстояния и память уже в полосах, а не в частотах.
+Уровни пирамиды - средние базовых векторов, а проекция линейна, поэтому она всё равно что сделана на каждом уровне.
+"""
+import numpy as np
+
+from config import Config
+
+
+def mel(freq):
+    return 2595 * np.log10(1 + freq / 700)
+
+
+def mel_inverse(value):
+    return 700 * (10 ** (value / 2595) - 1)
+
+
+def mel_bands(freqs, bands):
+    """Треугольные фильтры, центры и края которых равномерно расставлены по шкале мел"""
+    edges = mel_inverse(np.linspace(mel(Config.FEATURE_MIN_HZ), mel(freqs[-1]), bands + 2))
+    lower, center, upper = edges[:-2], edges[1:-1], edges[2:]
+    column = freqs[:, np.newaxis]
+    return np.maximum(0, np.minimum((column - lower) / (center - lower), (upper - column) / (upper - center)))
+
+
+def log_bands(freqs, bands):
+    """Полосы с границами в геометрической прогрессии, признак полосы - сумма её частот; всё ниже первой - в ней"""
+    edges = np.geomspace(max(Config.FEATURE_MIN_HZ, freqs[1]), freqs[-1], bands + 1)
+    index = np.clip(np.searchsorted(edges, freqs, side='right') - 1, 0, bands - 1)
+    matrix = np.zeros((len(freqs), bands))
+    matrix[np.arange(len(freqs)), index] = 1
+    return matrix
+
+
+PROJECTIONS = {'mel': mel_bands, 'log': log_bands}
+
+
+def projection(rate, window_size):
+    """
+    Матрица (частоты scipy.signal.spectrogram с окном window_size) x (признаки) для Config.FEATURES
+    или None при 'linear'. Полосы, в которые не попало ни одной частоты (на низких частотах при коротком окне
+    они уже расстояния между соседними частотами), выбрасываются, так что признаков бывает меньше
+    Config.FEATURE_BANDS.
+    """
+    if Config.FEATURES == 'linear':
+        return None
+    freqs = np.arange(window_size // 2 + 1) * rate / window_size
+    matrix = PROJECTIONS[Config.FEATURES](freqs, Config.FEATURE_BANDS)
+    return matrix[:, matrix.any(axis=0)]
+
+
+def width(matrix, window_size):
+    """Размерность признаков при проекции matrix (см. projection)"""
+    return window_size // 2 + 1 if matrix is None else matrix.shape[1]
+
+
+def project(spec, matrix):
+    return spec if matrix is None else spec @ matrix
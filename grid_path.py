@@ -1,5 +1,7 @@
 import re
 
+import numpy as np
+
 
 class Point:
     def __init__(self, x, y):
@@ -25,32 +27,50 @@ class Point:
         return 'p{0}'.format((self.x, self.y))
 
 
-class PathItem:
-    def __init__(self, move, times=1):
-        """Последовательжость одинаковых ходов вида |,-,/"""
-        self.move, self.times = move, times
-
-    def __mul__(self, other):
-        return PathItem(self.move, self.times * other)  # Предполагается, что other целое
-
-    def __repr__(self):
-        return self.move + str(self.times)
-
-    def copy(self):
-        return PathItem(self.move, self.times)
-
-    @staticmethod
-    def parse(string):
-        return PathItem(string[0], int(string[1:]))
+class TimeMap:
+    """
+    Кусочно-линейное неубывающее отображение x -> y, в которое компилируется путь: xs, ys - координаты его вершин.
+    Между вершинами путь идёт по ходам '-' (наклон 0) или '/' (наклон 1), а вертикальный участок '|' даёт
+    несколько y для одного x: first берёт нижний из них, last - верхний. За пределами пути отображение
+    продолжается с наклоном 1, то есть всё, что раньше начала или позже конца пути, просто сдвигается.
+    """
+    def __init__(self, xs, ys):
+        self.xs, self.ys = xs, ys
+        dx, dy = np.diff(xs), np.diff(ys)
+        slopes = np.where(dx > 0, dy // np.maximum(dx, 1), 0)
+        self._slope_in = np.concatenate(([1], slopes))  # Наклон участка, входящего в вершину
+        self._slope_out = np.concatenate((slopes, [1]))  # и выходящего из неё
+
+    def first(self, times):
+        """Наименьший y, соответствующий каждому x из times (для концов событий)"""
+        times = np.asarray(times, dtype=np.int64)
+        i = np.minimum(np.searchsorted(self.xs, times, side='left'), len(self.xs) - 1)
+        slope = np.where(times > self.xs[i], 1, self._slope_in[i])
+        return self.ys[i] + (times - self.xs[i]) * slope
+
+    def last(self, times):
+        """Наибольший y, соответствующий каждому x из times (для начал событий)"""
+        times = np.asarray(times, dtype=np.int64)
+        i = np.maximum(np.searchsorted(self.xs, times, side='right') - 1, 0)
+        slope = np.where(times < self.xs[i], 1, self._slope_out[i])
+        return self.ys[i] + (times - self.xs[i]) * slope
 
 
 class Path:
     # A compact structure for storing paths with large segments of equal elements
-    def __init__(self, sequence=list()):
-        self._sequence = sequence  # of PathItems
+    # Путь хранится параллельными массивами: коды ходов (индексы в MOVES) и длины участков из одинаковых ходов
+    MOVES = '|-/'
+    _DX, _DY = np.array([0, 1, 1]), np.array([1, 0, 1])
+    _CODES = np.zeros(128, dtype=np.uint8)
+    _CODES[ord('-')], _CODES[ord('/')] = 1, 2
+
+    def __init__(self, codes=(), times=()):
+        self._codes = np.array(codes, dtype=np.uint8)
+        self._times = np.array(times, dtype=np.int64)
+        self._vertices = None  # Накопленные координаты вершин, считаются по требованию
 
     def __len__(self):
-        return len(self._sequence)
+        return len(self._codes)
 
     def __lt__(self, other):
         """Нужно только чтобы был корректно определён min((cost1, path1), (cost2, path2)), когда cost1==cost2
@@ -60,33 +80,79 @@ class Path:
 
     def __mul__(self, other):
         assert type(other) is int and other > 0
-        return Path([item * other for item in self._sequence])
+        return Path(self._codes, self._times * other)
+
+    def __floordiv__(self, other):
+        """Обратное к умножению: длины участков делятся нацело"""
+        assert type(other) is int and other > 0
+        return Path(self._codes, self._times // other)
 
     def __repr__(self):
-        return " ".join(repr(item) for item in self._sequence)
+        return " ".join(self.MOVES[code] + str(times) for code, times in zip(self._codes.tolist(), self._times.tolist()))
 
     def append(self, move):
-        if self._sequence and self._sequence[-1].move == move:
-            self._sequence[-1].times += 1
+        code = self.MOVES.index(move)
+        if len(self._codes) and self._codes[-1] == code:
+            self._times[-1] += 1
         else:
-            self._sequence.append(PathItem(move))
+            self._codes, self._times = np.append(self._codes, code), np.append(self._times, 1)
+        self._vertices = None
         return self
 
     def copy(self):
-        return Path([item.copy() for item in self._sequence])
+        return Path(self._codes, self._times)
+
+    def moves(self):
+        """Строка из всех ходов пути подряд"""
+        return ''.join(self.MOVES[code] * times for code, times in zip(self._codes.tolist(), self._times.tolist()))
+
+    def vertices(self):
+        """Массивы xs, ys координат вершин пути: начала (0, 0) и концов всех участков"""
+        if self._vertices is None:
+            self._vertices = tuple(np.concatenate(([0], np.cumsum(d[self._codes] * self._times)))
+                                   for d in (self._DX, self._DY))
+        return self._vertices
+
+    def _steps(self):
+        # Длины участков в срезах: диагональный ход пересекает два среза, остальные - один
+        return self._times * (1 + (self._codes == 2))
 
     def near_path(self, radius):
         """
         Генератор точек, отстоящих от пути по диагонали не больше, чем на радиус.
         """
-        x, y = 0., 0.
-        for item in self._sequence:
-            dx, dy = {'|': (0, 1), '-': (1, 0), '/': (0.5, 0.5)}[item.move]
-            for _ in range(item.times if item.move != '/' else item.times*2):
-                x += dx
-                y += dy
-                for i in self._path_range(x, radius):
-                    yield Point(int(x+i), int(y-i))
+        xs, ys = self.band_cells(radius)
+        for x, y in zip(xs.tolist(), ys.tolist()):
+            yield Point(x, y)
+
+    def band_cells(self, radius, first=1, last=None):
+        """
+        Клетки near_path(radius) на срезах от first до last включительно (по умолчанию до конца пути) в том же
+        порядке, но сразу массивами xs, ys без отдельных объектов на каждую клетку.
+        """
+        lo, hi = self.slice_bounds(radius)
+        lo, hi = lo[first-1:last], hi[first-1:last]
+        counts = np.maximum(hi - lo + 1, 0)
+        slices = np.repeat(np.arange(first, first + len(lo)), counts)
+        xs = np.arange(np.sum(counts)) + np.repeat(lo - np.cumsum(counts) + counts, counts)
+        return xs, slices - xs
+
+    def slice_bounds(self, radius):
+        """
+        То же, что near_path, но сразу для всех срезов: возвращает массивы lo, hi, где lo[s-1], hi[s-1] - наименьший
+        и наибольший x точек, которые near_path выдаёт на срезе x+y=s.
+        """
+        deltas = np.array([0, 2, 1], dtype=np.int64)[self._codes]
+        x2 = np.cumsum(np.repeat(deltas, self._steps()))  # Удвоенная абсцисса пути после каждого шага
+        return -((2*radius - x2)//2), (x2 + 2*radius)//2
+
+    def breaks(self):
+        """Срезы, на которых кончаются участки пути из одинаковых ходов (последний - длина пути в срезах)"""
+        return np.cumsum(self._steps())
+
+    def time_map(self):
+        """Компилирует путь в TimeMap по его вершинам"""
+        return TimeMap(*self.vertices())
 
     @property
     def on_path(self):
@@ -94,29 +160,28 @@ class Path:
         Генератор координат точек, через которые проходит путь. Нужен для подвижки субтитров, поэтому из-за некоторых
         особенностей алгоритма можно пропустить все точки на вертикальных участках, кроме концов
         """
+        xs, ys = self.vertices()
         yield 0, 0
-        x, y = 0, 0
-        for item in self._sequence:
-            dx, dy = {'|': (0, item.times), '-': (1, 0), '/': (1, 1)}[item.move]
-            for _ in range(1 if item.move == '|' else item.times):
-                x += dx
-                y += dy
-                yield x, y
-
-    @staticmethod
-    def _path_range(x, radius):
-        if int(x) == x:
-            for i in range(-radius, radius+1):
-                yield i
-        else:
-            for i in range(-radius, radius):
-                yield i + .5
+        for code, x, y, times in zip(self._codes.tolist(), xs.tolist(), ys.tolist(), self._times.tolist()):
+            if code == 0:
+                yield x, y + times
+            else:
+                for i in range(1, times + 1):
+                    yield x + i, y + (i if code == 2 else 0)
 
     @staticmethod
     def parse(string):
         if not re.match(r'(-|/|\|)\d+( (-|/|\|)\d+)*', string):
             raise ValueError('Incorrect path format')
-        return Path([PathItem.parse(i) for i in string.split()])
+        items = string.split()
+        return Path([Path.MOVES.index(i[0]) for i in items], [int(i[1:]) for i in items])
+
+    @staticmethod
+    def from_moves(moves):
+        """Путь из последовательности ходов '|', '-', '/'"""
+        codes = Path._CODES[np.frombuffer(''.join(moves).encode('ascii'), dtype=np.uint8)]
+        starts = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1])))[:len(codes)]
+        return Path(codes[starts], np.diff(np.append(starts, len(codes))))
 
     def plus(self, move):
         if move is None:
@@ -0,0 +1,131 @@
+"""
+Якоря для начального пути: пары заведомо соответствующих друг другу мест двух спектрограмм, найденные
+без всякой динамики, по отпечаткам из спектральных пиков (как в поиске музыки по фрагменту).
+Отпечаток - пара пиков одной спектрограммы: (частота первого, частота второго, расстояние между ними по времени).
+По отпечаткам первой спектрограммы строится обратный индекс, отпечатки второй ищутся в нём, и каждое совпадение
+голосует за сдвиг y - x в своём окне из Config.ANCHOR_WINDOW секунд. Сдвиги, набравшие много голосов,
+дают якоря, а из них берётся возрастающая по обеим осям цепочка с наибольшим числом голосов.
+Все координаты - в векторах уровня 1 пирамиды (Config.PRECISION базовых тиков).
+"""
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+import metrics
+from config import Config
+
+
+def vectors_per_second():
+    return 100 / (Config.BASE_TICK * Config.PRECISION)
+
+
+def find_peaks(spec):
+    """
+    Пики spec: максимумы в окрестности Config.ANCHOR_NEIGHBOURHOOD (секунды, частотные полосы), из которых
+    в каждой секунде остаются Config.ANCHOR_PEAKS самых сильных. Возвращает массивы времён и частот по времени.
+    """
+    per_second = vectors_per_second()
+    seconds, bands = Config.ANCHOR_NEIGHBOURHOOD
+    size = (2 * max(int(seconds * per_second), 1) + 1, 2 * bands + 1)
+    times, freqs = np.nonzero((spec == maximum_filter(spec, size=size, mode='constant')) & (spec > 0))
+    strength, second = spec[times, freqs], (times // per_second).astype(np.int64)
+    order = np.lexsort((-strength, second))  # По секундам, внутри секунды - от сильных к слабым
+    second = second[order]
+    starts = np.flatnonzero(np.concatenate(([True], second[1:] != second[:-1])))
+    rank = np.arange(len(order)) - np.repeat(starts, np.diff(np.append(starts, len(order))))
+    keep = np.sort(order[rank < Config.ANCHOR_PEAKS])
+    return times[keep], freqs[keep]
+
+
+def fingerprints(times, freqs, n_freqs):
+    """
+    Отпечатки пар пиков: каждый пик в паре с Config.ANCHOR_FAN следующими за ним, если они не дальше
+    Config.ANCHOR_ZONE секунд. Возвращает массивы отпечатков (целые числа) и времён первого пика пары.
+    """
+    zone = int(Config.ANCHOR_ZONE * vectors_per_second())
+    hashes, anchors = [], []
+    for k in range(1, Config.ANCHOR_FAN + 1):
+        dt = times[k:] - times[:-k]
+        pair = (dt > 0) & (dt <= zone)
+        hashes.append(((freqs[:-k][pair] * n_freqs + freqs[k:][pair]) * (zone + 1) + dt[pair]).astype(np.int64))
+        anchors.append(times[:-k][pair])
+    return np.concatenate(hashes), np.concatenate(anchors)
+
+
+def match(index, query):
+    """
+    Совпадения отпечатков query с отпечатками index, оба - пары (отпечатки, времена). Отпечатки, которые
+    встречаются в index больше Config.ANCHOR_MAX_HITS раз, пропускаются: это тишина или однообразный фон.
+    Возвращает массивы времён совпавших отпечатков в index и в query.
+    """
+    order = np.argsort(index[0], kind='stable')
+    keys, times = index[0][order], index[1][order]
+    left, right = np.searchsorted(keys, query[0], side='left'), np.searchsorted(keys, query[0], side='right')
+    hits = np.where(right - left <= Config.ANCHOR_MAX_HITS, right - left, 0)
+    at = np.repeat(left - np.cumsum(hits) + hits, hits) + np.arange(np.sum(hits))
+    return times[at], np.repeat(query[1], hits)
+
+
+def vote(xs, ys):
+    """
+    Якоря по совпадениям (xs[i], ys[i]): для каждого окна из Config.ANCHOR_WINDOW секунд по x и каждого сдвига
+    d = y - x голоса - число совпадений со сдвигом от d-1 до d+1 (так переживаются округления и небольшое изменение
+    скорости). Сдвиг становится якорем, если он набрал не меньше Config.ANCHOR_VOTES голосов и больше соседних.
+    Якорь стоит в среднем x своих совпадений. Возвращает массивы x, y, голосов якорей.
+    """
+    window = max(int(Config.ANCHOR_WINDOW * vectors_per_second()), 1)
+    span = int(max(np.max(ys, initial=0) + 2, np.max(xs, initial=0) + 2))
+    keys = (xs // window) * (3 * span) + (ys - xs + span)  # Сдвиг d кодируется числом d+span от 1 до 2*span
+    bins, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+    near = {delta: _neighbour(bins, counts, delta) for delta in (-2, -1, 1, 2)}
+    votes = near[-1] + counts + near[1]
+    left, right = near[-2] + near[-1] + counts, counts + near[1] + near[2]  # Голоса у сдвигов d-1 и d+1
+    # При равенстве с соседним сдвигом побеждает меньший; пустой соседний сдвиг - не соперник
+    keep = (votes >= Config.ANCHOR_VOTES) & ((votes > left) | (near[-1] == 0)) & (votes >= right)
+    mean_x = np.bincount(inverse.ravel(), weights=xs, minlength=len(bins)) / counts
+    anchor_x = np.round(mean_x[keep]).astype(np.int64)
+    return anchor_x, anchor_x + bins[keep] % (3 * span) - span, votes[keep]
+
+
+def _neighbour(bins, counts, delta):
+    """Для каждой корзины из bins - число совпадений в корзине bins+delta того же окна или 0"""
+    at = np.minimum(np.searchsorted(bins, bins + delta), len(bins) - 1)
+    return np.where(bins[at] == bins + delta, counts[at], 0)
+
+
+def chain(xs, ys, votes):
+    """Возрастающая по x и по y цепочка якорей с наибольшей суммой голосов; якоря на входе упорядочены по x"""
+    order = np.lexsort((ys, xs))
+    xs, ys, votes = xs[order], ys[order], votes[order]
+    best, prev = votes.astype(np.int64), np.full(len(xs), -1)
+    for i in range(1, len(xs)):
+        fits = np.flatnonzero((xs[:i] < xs[i]) & (ys[:i] < ys[i]))
+        if len(fits):
+            j = fits[np.argmax(best[fits])]
+            best[i], prev[i] = best[j] + votes[i], j
+    result = []
+    i = int(np.argmax(best)) if len(xs) else -1
+    while i >= 0:
+        result.append(i)
+        i = prev[i]
+    result = np.array(result[::-1], dtype=np.int64)
+    return xs[result], ys[result]
+
+
+def find_anchors(spec1, spec2):
+    """
+    Якоря между спектрограммами уровня 1 (массивами векторов): массивы xs, ys, строго возрастающие оба.
+    Время работы почти линейно по длине: пики, отпечатки и их сортировка, без попарных расстояний.
+    """
+    with metrics.span('anchors'):
+        prints = []
+        for spec in (spec1, spec2):
+            peaks = find_peaks(spec)
+            metrics.count('peaks', len(peaks[0]))
+            prints.append(fingerprints(*peaks, spec.shape[1]))
+        xs, ys = match(*prints)
+        matches = len(xs)
+        metrics.count('matches', matches)
+        xs, ys = chain(*vote(xs, ys))
+        metrics.record('anchors', len(xs))
+    print("Anchors: {0} from {1} fingerprint matches".format(len(xs), matches))
+    return xs, ys
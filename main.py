@@ -1,12 +1,18 @@
-from subprocess import call
-from os import remove, devnull, path
-from collections import defaultdict
-from time import clock
+from os import remove, path, makedirs
+from concurrent.futures import ProcessPoolExecutor
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import perf_counter
 
+import numpy as np
+
+import metrics
 from config import Config
 from spectrum import Spectrogram, Comparator
 from grid_path import Path
-from util import Subs, Timing, file_to_text
+from media import decode_to_wav, decode_pipe
+from feature_cache import FeatureCache
+from util import load_subs, merge_parts, file_to_text
 
 
 def delete_files(to_delete):
@@ -14,30 +20,185 @@ def delete_files(to_delete):
         remove(file)
 
 
-def shift_subs(subs, sub_path):
-    """Двигает сабы, в subs объект типа util.Subs, в sub_path типа grid_path.Path
-    Предполагается, что в sub_path продолжительности участков указаны в сантисекундах."""
-    # TODO: Нужна корректная работа для сабов, выходящих за рамки видео и более быстрая в общем случае.
-    ss_to_event = defaultdict(list)
-    for event in subs:
-        ss_to_event[event.timing.begin_ss].append((event, 'b'))
-        ss_to_event[event.timing.end_ss].append((event, 'e'))
-    prev_x = -1
-    for x, y in sub_path.on_path:
-        for event, mark in ss_to_event[x]:
-            if mark == 'b':
-                event.timing.begin_ss = y
-            if mark == 'e' and x != prev_x:
-                event.timing.end_ss = y
-        prev_x = x
-    corrupted_events = []  # События, длительность которых была изменена в результате сдвига
-    for event in subs:
-        begin, end = event.timing.begin_str, event.timing.end_str
+def make_spectrogram(filename, to_delete, timings=None):
+    """
+    Декодирует медиафайл способом Config.DECODE_MODE и строит его спектрограмму.
+    В словарь timings, если он дан, записывается время декодирования и построения спектрограммы.
+    """
+    stamp = perf_counter()
+    with metrics.span('decode', file=filename, mode=Config.DECODE_MODE):
+        if Config.DECODE_MODE == 'pipe':
+            source, signal = filename, decode_pipe(filename)
+        else:
+            tmp = filename.split('.')
+            name, ext = ".".join(tmp[:-1]), tmp[-1]
+            source, signal = name + '_tmp{}Hz.wav'.format(Config.DEFAULT_HZ), None
+            if Config.REWRITE_WAV or not path.isfile(source):
+                if path.isfile(source):
+                    remove(source)
+                decode_to_wav(filename, source)  # Весь вывод декодера идёт в devnull, дабы не засорять консоль
+            to_delete.add(source)
+    decoded = perf_counter()
+    spectrum = Spectrogram(source, signal)
+    if timings is not None:
+        timings.update(decode=decoded - stamp, spectrogram=perf_counter() - decoded)
+    return spectrum
+
+
+def prepare_in_worker(filename, dirname, collect=False):
+    """
+    Выполняется в отдельном процессе: строит спектрограмму filename и оставляет базовую спектрограмму .npy-файлом
+    в dirname, откуда основной процесс открывает её через mmap, а не получает через pickle.
+    Если collect, собирает и замеры этапов для metrics основного процесса.
+    Возвращает частоту, .npy-файл, времена этапов, временные файлы и замеры (или None).
+    """
+    makedirs(dirname)
+    Config.SPEC_MEMMAP_DIR = dirname
+    to_delete, timings = set(), {}
+    if collect:
+        metrics.start(force=True)
+    spectrum = make_spectrogram(filename, to_delete, timings)
+    rate, base = spectrum.rate, spectrum.base_spec
+    if isinstance(base, np.memmap):
+        base.flush()
+        npy_file = base.filename
+    else:  # При Config.SPEC_CHUNK = None спектрограмма строится в памяти
+        npy_file = path.join(dirname, 'base.npy')
+        np.save(npy_file, base)
+    return rate, npy_file, timings, to_delete, metrics.finish()['spans'] if collect else None
+
+
+def prepare_spectrums(media, to_delete, cache=None):
+    """
+    Спектрограммы медиафайлов: из кэша, если они там есть, а остальные при Config.PARALLEL_PREPARE строятся
+    одновременно в отдельных процессах. Печатает время этапов по каждому файлу.
+    Возвращает спектрограммы и временную директорию с их .npy-файлами (или None), которую надо удалить после поиска.
+    """
+    spectrums = [cache.load(filename) if cache else None for filename in media]
+    todo = [i for i, spectrum in enumerate(spectrums) if spectrum is None]
+    timings, tmp_dir, stamp = {}, None, perf_counter()
+    if Config.PARALLEL_PREPARE and len(todo) > 1:
+        tmp_dir = mkdtemp(dir=Config.SPEC_MEMMAP_DIR)
+        with ProcessPoolExecutor(len(todo)) as pool:
+            futures = [(i, pool.submit(prepare_in_worker, media[i], path.join(tmp_dir, str(i)), metrics.active()))
+                       for i in todo]
+            for i, future in futures:
+                rate, npy_file, timings[i], tmp_files, spans = future.result()
+                metrics.attach(spans)
+                to_delete |= tmp_files
+                spectrums[i] = Spectrogram(media[i], cached=(rate, np.load(npy_file, mmap_mode='r'), {}))
+    else:
+        for i in todo:
+            timings[i] = {}
+            spectrums[i] = make_spectrogram(media[i], to_delete, timings[i])
+    for i in todo:
+        print("Prepared {0}: decode {1[decode]:.2f} sec, spectrogram {1[spectrogram]:.2f} sec"
+              .format(media[i], timings[i]))
+        if cache:
+            cache.store(media[i], spectrums[i])
+    if todo:
+        print("Preparation took {0:.2f} sec, {1:.2f} sec in sequence"
+              .format(perf_counter() - stamp, sum(sum(i.values()) for i in timings.values())))
+    return spectrums, tmp_dir
+
+
+def shift_subs(subs, time_map):
+    """Двигает сабы, в subs объект типа util.Subs или util.Srt, в time_map - путь, скомпилированный в
+    grid_path.TimeMap (Path.time_map), чтобы не делать этого заново для каждого файла.
+    Предполагается, что в пути продолжительности участков указаны в сантисекундах.
+    Все моменты отображаются разом; начало события, попавшее на вертикальный участок пути,
+    уходит в его верх, а конец - в низ. События за пределами пути сдвигаются так же, как его ближайший конец.
+    Возвращает список событий, длительность которых изменилась в результате сдвига."""
+    events = list(subs)
+    metrics.record('events', len(events))
+    begins = time_map.last([event.timing.begin_ss for event in events])
+    ends = time_map.first([event.timing.end_ss for event in events])
+    corrupted_events = []
+    for event, begin, end in zip(events, begins.tolist(), ends.tolist()):
+        length = len(event.timing)
+        event.timing.begin_ss, event.timing.end_ss = begin, end
         event.timing.str_update()
-        if len(event.timing) != len(Timing(begin, end)):
+        if len(event.timing) != length:
             corrupted_events.append(repr(event))
-    print("Corrupted events: {}".format("\n"+"\n".join(corrupted_events) if corrupted_events else None))
-    print("Successful shift!")
+    return corrupted_events
+
+
+def subtitle_times(sub_files):
+    """Начала и концы всех событий из sub_files в сантисекундах: около них full_search уточняет путь
+    при Config.LAZY_WINDOW (None, если он не задан)"""
+    if Config.LAZY_WINDOW is None:
+        return None
+    return [stamp for name in sub_files for event in load_subs(name)
+            for stamp in (event.timing.begin_ss, event.timing.end_ss)]
+
+
+def find_path(media, to_delete, focus=None):
+    """Строит путь между двумя медиафайлами; временные файлы, которые можно удалить, добавляются в to_delete.
+    focus - моменты первого медиафайла в сантисекундах, см. Comparator.full_search"""
+    cache = FeatureCache() if Config.CACHE_DIR is not None else None
+    with metrics.span('prepare'):
+        spectrums, tmp_dir = prepare_spectrums(media, to_delete, cache)
+    cmp = Comparator(spectrums[0], spectrums[1])
+    with metrics.span('search'):
+        final_path = cmp.full_search(focus=focus)
+    if cache and Config.CACHE_PYRAMID:
+        for filename, spectrum in zip(media, spectrums):
+            cache.store(filename, spectrum)  # Дописываем построенные при поиске уровни
+    if tmp_dir is not None:
+        del cmp, spectrums  # Закрываем mmap'ы перед удалением файлов
+        rmtree(tmp_dir, ignore_errors=True)
+    return final_path
+
+
+def write_path(final_path, log_file):
+    f = open(log_file, 'wb')
+    f.write(str(final_path).encode('utf-8'))
+    f.close()
+
+
+def shift_file(name, time_map, keep=False, collect=False):
+    """
+    Двигает сабы из name (.ass или .srt) и пишет их рядом в *_shifted.ass (*_shifted.srt). Выполняется в процессе
+    пула, если Config.SHIFT_WORKERS больше 1; тогда при collect собирает и замеры для metrics основного процесса.
+    Возвращает испорченные при сдвиге события, сами сабы, если keep (для слияния), и замеры (или None).
+    """
+    if collect:
+        metrics.start(force=True)
+    with metrics.span('file', file=name):
+        subs = load_subs(name)
+        corrupted_events = shift_subs(subs, time_map)
+        base, ext = path.splitext(name)
+        subs.output(base + '_shifted' + ext, remove_garbage=False, default_styles=False, default_events='full')
+    return corrupted_events, subs if keep else None, metrics.finish()['spans'] if collect else None
+
+
+def shift_files(sub_files, final_path, merged_file=None):
+    """
+    Двигает сабы из каждого файла sub_files по пути final_path, результат пишется рядом в *_shifted.ass (.srt).
+    Путь компилируется в TimeMap один раз на все файлы, а сами файлы при Config.SHIFT_WORKERS > 1 обрабатываются
+    в пуле процессов. Если задан merged_file (.ass или .srt), все сдвинутые сабы ещё и сливаются в него.
+    """
+    if not sub_files:
+        print("No subtitles to shift.")
+        return
+    workers, keep = min(Config.SHIFT_WORKERS, len(sub_files)), merged_file is not None
+    with metrics.span('shift', files=len(sub_files), workers=workers):
+        time_map = final_path.time_map()
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                futures = [pool.submit(shift_file, name, time_map, keep, metrics.active()) for name in sub_files]
+                results = [future.result() for future in futures]
+        else:
+            results = [shift_file(name, time_map, keep) for name in sub_files]
+        for name, (corrupted_events, _, spans) in zip(sub_files, results):
+            metrics.attach(spans)
+            print("Shifted subs in {0}, corrupted events: {1}"
+                  .format(name, "\n" + "\n".join(corrupted_events) if corrupted_events else None))
+        if keep:
+            with metrics.span('merge', file=merged_file):
+                merged = merge_parts([subs for _, subs, _ in results], merged_file.lower().endswith('.srt'))
+                merged.output(merged_file, remove_garbage=False, default_styles=False, default_events='full')
+            print("Merged subs written to {}".format(merged_file))
 
 
 def main():
@@ -47,43 +208,23 @@ def main():
     print("Processing...")
     dirname = path.dirname(__file__) + '/'
     # Subs.verbose = False  # Можно раскомментарить, чтобы библиотека util не предупреждала о наложениях событий и т.п.
-    to_delete, final_path, begin_stamp = set(), None, clock()
+    to_delete, final_path, begin_stamp = set(), None, perf_counter()
+    metrics.start()
     if Config.TEXT_FILE is None:
         media = Config.MEDIA
         if len(media) not in (0, 2):
             print("Error: 0 or 2 media files should be given")
         if len(media) == 2:
-            spectrums = []
-            for filename in media:
-                if not path.isabs(filename):
-                    filename = dirname + filename
-                tmp = filename.split('.')
-                name, ext = ".".join(tmp[:-1]), tmp[-1]
-                wav_file = name + '_tmp{}Hz.wav'.format(Config.DEFAULT_HZ)
-                if Config.REWRITE_WAV or not path.isfile(wav_file):
-                    if path.isfile(wav_file):
-                        remove(wav_file)
-                    call('ffmpeg -i "{0}" -y -ac 1 -ar {1} {2}'.format(filename, Config.DEFAULT_HZ, wav_file), shell=True,
-                         stderr=open(devnull, 'w'))  # Весь вывод FFmpeg идёт в devnull, дабы не засорять консоль
-                to_delete.add(wav_file)
-                spectrums.append(Spectrogram(wav_file))
-            cmp = Comparator(spectrums[0], spectrums[1])
-            final_path = cmp.full_search()
-            f = open(Config.LOG_FILE, 'wb')
-            f.write(str(final_path).encode('utf-8'))
-            f.close()
+            media = [filename if path.isabs(filename) else dirname + filename for filename in media]
+            final_path = find_path(media, to_delete, subtitle_times(Config.ASS_FILES))
+            write_path(final_path, Config.LOG_FILE)
             if not Config.SAVE_WAV:
                 delete_files(to_delete)
     else:
         final_path = Path.parse(file_to_text(Config.TEXT_FILE))
-    for name in Config.ASS_FILES:
-        subs = Subs().parse(name)
-        print("Shifting subs in {}".format(name))
-        shift_subs(subs, final_path)
-        subs.output(name[:-4]+'_shifted.ass', remove_garbage=False, default_styles=False, default_events='full')
-    if not Config.ASS_FILES:
-        print("No subtitles to shift.")
-    print('Total time: {} sec'.format(clock()-begin_stamp))
+    shift_files(Config.ASS_FILES, final_path, Config.MERGED_FILE)
+    metrics.finish(Config.METRICS_FILE)
+    print('Total time: {} sec'.format(perf_counter()-begin_stamp))
 
 if __name__ == '__main__':
     main()
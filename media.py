@@ -0,0 +1,88 @@
+"""Вытаскивание звука из медиафайлов внешним декодером (по умолчанию FFmpeg)."""
+from contextlib import contextmanager
+from subprocess import Popen, PIPE, DEVNULL, call
+
+import numpy as np
+
+from config import Config
+
+PCM_TYPES = {'s16le': np.dtype('<i2'), 'f32le': np.dtype('<f4')}
+decode_slots = None  # Семафор, ограничивающий число одновременно работающих декодеров (см. batch.py)
+
+
+@contextmanager
+def decode_slot():
+    """Ждёт, пока освободится место для ещё одного декодера, если их число ограничено"""
+    if decode_slots is None:
+        yield
+    else:
+        with decode_slots:
+            yield
+
+
+def decoder_command(filename, output, fmt=None):
+    """Аргументы для запуска декодера: моно с частотой Config.DEFAULT_HZ в файл output (или 'pipe:1' - в stdout)"""
+    command = list(Config.DECODER) + ['-nostdin', '-y', '-i', filename, '-ac', '1', '-ar', str(Config.DEFAULT_HZ)]
+    if fmt is not None:
+        command += ['-f', fmt]
+    return command + [output]
+
+
+def decode_to_wav(filename, wav_file):
+    """Старый способ: декодер пишет временный wav-файл, который потом читает Spectrogram.file_open"""
+    with decode_slot():
+        call(decoder_command(filename, wav_file), stdout=DEVNULL, stderr=DEVNULL)
+
+
+def decode_pipe(filename, fmt=None, seconds=1800):
+    """
+    Читает сырой PCM из stdout декодера прямо в numpy-буфер, без временных файлов. Буфер выделяется заранее
+    на seconds секунд звука и удваивается, если звук оказался длиннее. Возвращает (частота, сигнал).
+    """
+    fmt = fmt or Config.PIPE_FORMAT
+    dtype = PCM_TYPES[fmt]
+    buffer, filled = np.empty(seconds * Config.DEFAULT_HZ * dtype.itemsize, dtype=np.uint8), 0
+    with decode_slot():
+        process = Popen(decoder_command(filename, 'pipe:1', fmt), stdout=PIPE, stderr=DEVNULL)
+        while True:
+            if filled == len(buffer):
+                buffer = np.concatenate((buffer, np.empty_like(buffer)))
+            read = process.stdout.readinto(memoryview(buffer)[filled:])
+            if not read:
+                break
+            filled += read
+        process.stdout.close()
+        if process.wait() != 0:
+            raise RuntimeError("Decoder failed on {}".format(filename))
+    print("Rate of {}:".format(filename), Config.DEFAULT_HZ)
+    return Config.DEFAULT_HZ, buffer[:filled - filled % dtype.itemsize].view(dtype)
+
+
+def decode_stream(source, fmt=None, seconds=None):
+    """
+    Генератор кусков сырого PCM из stdout декодера по мере того, как он их выдаёт, - для потоков, которые ещё
+    не кончились (URL, именованный канал, '-' для stdin). Кусок - seconds секунд звука (по умолчанию
+    Config.STREAM_CHUNK, последний может быть короче), буфер под него один, так что память не растёт с длиной потока.
+    """
+    fmt = fmt or Config.PIPE_FORMAT
+    dtype = PCM_TYPES[fmt]
+    size = max(int((seconds or Config.STREAM_CHUNK) * Config.DEFAULT_HZ), 1) * dtype.itemsize
+    buffer, filled, finished = np.empty(size, dtype=np.uint8), 0, False
+    process = Popen(decoder_command(source, 'pipe:1', fmt), stdout=PIPE, stderr=DEVNULL)
+    try:
+        while True:
+            read = process.stdout.readinto(memoryview(buffer)[filled:])
+            filled += read or 0
+            if filled == len(buffer) or not read and filled >= dtype.itemsize:
+                whole = filled - filled % dtype.itemsize
+                yield buffer[:whole].view(dtype).copy()
+                buffer[:filled - whole], filled = buffer[whole:filled], filled - whole
+            if not read:
+                break
+        finished = True
+    finally:
+        if not finished:  # Чтение бросили на середине: декодер больше не нужен
+            process.kill()
+        process.stdout.close()
+        if process.wait() != 0 and finished:
+            raise RuntimeError("Decoder failed on {}".format(source))
@@ -0,0 +1,71 @@
+"""
+Бюджет памяти на одну пару медиафайлов (Config.MEMORY_BUDGET). Перед построением спектрограммы каждого файла
+оценивается пик памяти, который она займёт вместе с сигналом, пирамидой, временными массивами и полосой поиска,
+и выбирается самое точное хранение, которое влезает в половину бюджета: всё во float64, всё во float32
+или float32 с единичными векторами грубых уровней (от Config.FLOAT16_MULT) во float16. Если не влезает и так, при
+Config.OVER_BUDGET = 'disk' спектрограмма и пирамида лежат во временных файлах через mmap, а при 'refuse'
+работа останавливается с MemoryError ещё до тяжёлых вычислений.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+import metrics
+from config import Config
+
+# dtype спектрограмм и единичных векторов подробных уровней, dtype единичных векторов грубых уровней,
+# держать ли их в файлах, оценка пика в байтах
+Plan = namedtuple('Plan', 'dtype coarse_dtype on_disk peak')
+
+STORAGES = ((np.float64, np.float64), (np.float32, np.float32), (np.float32, np.float16))
+
+
+def projected_peak(ticks, width, signal_bytes, dtype, coarse_dtype, on_disk=False, base_in_memory=True):
+    """
+    Оценка пика памяти в байтах для спектрограммы из ticks базовых векторов по width признаков: сигнал,
+    базовая спектрограмма, уровни пирамиды (векторы и log-длины в dtype, единичные векторы в dtype или
+    в coarse_dtype от Config.FLOAT16_MULT), временные массивы
+    build_pyramid и normalize, коды решений в полосе ширины до 2*Config.MAX_RADIUS+1.
+    """
+    vectors = -(-ticks // Config.PRECISION)
+    size, coarse_size = np.dtype(dtype).itemsize, np.dtype(coarse_dtype).itemsize
+    temporary = 3 * vectors * width * size
+    band = 2 * vectors * (2 * Config.MAX_RADIUS + 1)
+    if Config.TRACEBACK_MEMORY is not None:
+        band = min(band, Config.TRACEBACK_MEMORY)
+    if on_disk:
+        chunk = 2 * min(Config.SPEC_CHUNK or ticks, ticks) * width * 8
+        return signal_bytes + chunk + temporary + band
+    levels, mult, n = 0, 1, vectors
+    while n > 1:
+        levels += n * (width * (size + (coarse_size if mult >= Config.FLOAT16_MULT else size)) + size)
+        n, mult = -(-n // 2), mult * 2
+    base = ticks * width * size if base_in_memory else 0
+    return signal_bytes + base + levels + temporary + band
+
+
+def plan(filename, ticks, width, signal_bytes=0, base_in_memory=True):
+    """
+    Как хранить спектрограмму filename (см. Plan), или None, если бюджет не задан: тогда всё во float64 в памяти.
+    Печатает оценку пика памяти.
+    """
+    if Config.MEMORY_BUDGET is None:
+        return None
+    budget = Config.MEMORY_BUDGET / 2  # Во время поиска в памяти обе спектрограммы пары
+    for dtype, coarse_dtype in STORAGES:
+        peak = projected_peak(ticks, width, signal_bytes, dtype, coarse_dtype, base_in_memory=base_in_memory)
+        if peak <= budget:
+            result = Plan(dtype, coarse_dtype, False, peak)
+            break
+    else:
+        if Config.OVER_BUDGET == 'refuse':
+            raise MemoryError("Projected peak memory for {0} is {1:.0f} MB, over the budget of {2:.0f} MB"
+                              .format(filename, peak / 2**20, budget / 2**20))
+        dtype, coarse_dtype = STORAGES[-1]
+        result = Plan(dtype, coarse_dtype, True, projected_peak(ticks, width, signal_bytes, dtype, coarse_dtype, True))
+    print("Projected peak memory for {0}: {1:.0f} MB of {2:.0f} MB, {3}{4}{5}"
+          .format(filename, result.peak / 2**20, budget / 2**20, np.dtype(result.dtype).name,
+                  '' if result.coarse_dtype == result.dtype else '/' + np.dtype(result.coarse_dtype).name,
+                  ' on disk' if result.on_disk else ''))
+    metrics.record('projected_peak', int(result.peak))
+    return result
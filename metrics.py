@@ -0,0 +1,119 @@
+"""
+Замеры этапов работы. Этап (span) - именованный отрезок времени со своими счётчиками (посчитанные клетки,
+вычисления расстояний, ширина полосы, длина пути и т.п.) и пиком памяти процесса на момент окончания;
+вложенные этапы хранятся внутри родительского. Сбор начинается с start() и заканчивается finish(), который
+возвращает дерево этапов (main.main пишет его в Config.METRICS_FILE). При Config.PROGRESS в stderr выводится
+строка прогресса.
+Пока сбор не начат, span, count и progress почти ничего не стоят, их можно звать и в горячих циклах.
+"""
+import json
+import sys
+from contextlib import contextmanager
+from time import perf_counter
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from config import Config
+
+_stack = []  # Открытые этапы, снизу корневой; пустой, если сбор не идёт
+_progress = {'on': False, 'stamp': 0., 'width': 0}
+
+
+def peak_rss():
+    """Пик резидентной памяти процесса в байтах или None, если его не узнать (ru_maxrss в Linux в килобайтах)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def _new_span(name, info):
+    return dict(info, name=name, counters={}, spans=[])
+
+
+def start(name='run', force=False):
+    """Начинает сбор, если он включён в Config (или force) - например, в отдельном процессе для родителя"""
+    del _stack[:]
+    _progress['on'] = Config.PROGRESS
+    if force or Config.METRICS_FILE is not None or Config.PROGRESS:
+        _stack.append(_new_span(name, {}))
+        _stack[0]['stamp'] = perf_counter()
+
+
+def active():
+    return bool(_stack)
+
+
+def finish(filename=None):
+    """Заканчивает сбор и возвращает дерево этапов, а если задан filename, пишет его туда в JSON"""
+    if not _stack:
+        return None
+    root = _stack[0]
+    del _stack[:]
+    root['seconds'], root['peak_rss'] = perf_counter() - root.pop('stamp'), peak_rss()
+    _clear_progress()
+    if filename is not None:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(root, f, ensure_ascii=False, indent=2)
+    return root
+
+
+@contextmanager
+def span(name, **info):
+    """Этап name внутри текущего; info - что про него записать, счётчики добавляются через count"""
+    if not _stack:
+        yield None
+        return
+    item = _new_span(name, info)
+    _stack[-1]['spans'].append(item)
+    _stack.append(item)
+    stamp = perf_counter()
+    try:
+        yield item
+    finally:
+        item['seconds'], item['peak_rss'] = perf_counter() - stamp, peak_rss()
+        if _stack and _stack[-1] is item:  # finish() мог быть вызван изнутри этапа
+            _stack.pop()
+
+
+def count(name, value=1):
+    """Прибавляет value к счётчику name текущего этапа"""
+    if _stack:
+        counters = _stack[-1]['counters']
+        counters[name] = counters.get(name, 0) + value
+
+
+def record(name, value):
+    """Записывает в текущий этап значение, которое не суммируется (например, ширину полосы)"""
+    if _stack:
+        _stack[-1]['counters'][name] = value
+
+
+def attach(spans):
+    """Добавляет в текущий этап этапы, собранные в другом процессе"""
+    if _stack and spans:
+        _stack[-1]['spans'].extend(spans)
+
+
+def progress(done, total):
+    """Строка прогресса текущего этапа, обновляется не чаще пяти раз в секунду"""
+    if not _progress['on'] or not _stack:
+        return
+    now = perf_counter()
+    if now - _progress['stamp'] < 0.2:
+        return
+    _progress['stamp'] = now
+    line = '{0}: {1}/{2} ({3:.0%})'.format(' > '.join(i['name'] for i in _stack[1:]), done, total, done / max(total, 1))
+    sys.stderr.write('\r' + line.ljust(_progress['width']))
+    sys.stderr.flush()
+    _progress['width'] = len(line)
+
+
+def _clear_progress():
+    if _progress['width']:
+        sys.stderr.write('\r' + ' ' * _progress['width'] + '\r')
+        sys.stderr.flush()
+        _progress['width'] = 0
@@ -0,0 +1,346 @@
+"""
+Выравнивание по ходу потока: сабы к эталонному видео, которое известно заранее, двигаются под поток (например,
+повтор передачи), который ещё идёт. Запуск: python online.py <эталонное видео> <поток> <сабы.ass> [выход.ass]
+Поток - всё, что понимает декодер (файл, URL, '-' для stdin). Сдвинутые события дописываются в выход
+(по умолчанию *_shifted.ass рядом с сабами) по мере того, как путь за них становится известен, а сам путь
+дописывается в Config.LOG_FILE, так что потом его можно взять через Config.TEXT_FILE.
+"""
+import sys
+from bisect import bisect_left, bisect_right
+from collections import deque
+
+import numpy as np
+
+import metrics
+from config import Config
+from feature_cache import FeatureCache
+from grid_path import Path, TimeMap
+from main import prepare_spectrums
+from media import decode_stream
+from spectrum import StreamFeatures, Spectrogram, _shifted
+from util import Subs, fix_text
+
+
+class OnlineAligner:
+    """
+    Динамика по строкам: строка y - клетки (x, y) решётки, где x - вектор уровня 1 эталона, а y - очередной
+    вектор потока. Переходы, штрафы и стоимости рёбер те же, что в Comparator._wavefront, но грубого пути нет,
+    поэтому полоса на каждой строке - окно из Config.STREAM_RADIUS секунд эталона в каждую сторону от лучшей
+    клетки предыдущей строки.
+    Коды решений хранятся только для строк после последней зафиксированной точки. Точка фиксируется, когда
+    лучшие пути из всех клеток последней строки сходятся в ней: дальше путь до неё уже не изменится. Если они
+    не сходятся Config.STREAM_LAG секунд, фиксируется точка лучшего пути на половине этого срока. Клетки,
+    пути из которых через неё не проходят, не выбрасываются: иначе после ошибки путь не смог бы вернуться
+    на верный, если для этого нужно больше Config.STREAM_LAG секунд (например, после длинного вырезанного куска).
+    Такая точка - лишь догадка: путь до неё окончателен, только когда следующий зафиксированный путь пройдёт
+    через неё или когда пройдёт 2*Config.STREAM_LAG секунд, а до тех пор его можно переложить (см. _fix)
+    и события за ним не сдвигаются. Так память не зависит от длины потока, а задержка ограничена.
+    """
+    DIAG, HORVER = False, True
+    # Как клетка в гор./верт. состоянии начинает цепочку ходов '-' по своей строке (см. _add_row)
+    VERT_STAY, VERT_SWITCH, DASH_SWITCH = 0, 1, 2
+
+    def __init__(self, reference, subs=None, path_file=None):
+        """reference - Spectrogram эталона, subs - его сабы (util.Subs), path_file - куда дописывать путь"""
+        reference.use_level(1)
+        self._unit, self._log_norm, self._goal_x = reference.unit, reference.log_norm, len(reference)
+        vector_ss = Config.BASE_TICK * Config.PRECISION
+        self._radius = max(int(Config.STREAM_RADIUS * 100 / vector_ss), 1)
+        self._lag = max(int(Config.STREAM_LAG * 100 / vector_ss), 2)
+        # Поток ещё не пришёл, так что среднее расстояние берётся между случайными векторами самого эталона
+        rng = np.random.RandomState(Config.SEED)
+        xs, ys = (rng.randint(self._goal_x, size=Config.SAMPLE_SIZE) for _ in range(2))
+        sim = 1 - np.einsum('ij,ij->i', self._unit[xs], self._unit[ys])
+        av_cost = float(np.average(np.clip(sim, 0, 2) * (self._log_norm[xs] + self._log_norm[ys])))
+        print('Av_cost={0}'.format(av_cost))
+        self._horver_cost = av_cost * Config.NONDIAGKOEF
+        # Последняя строка: x первой клетки окна и стоимости путей, кончающихся диагональным и гор./верт. ребром.
+        # Стоимости хранятся за вычетом наименьшей, чтобы не расти с длиной потока
+        n = min(2 * self._radius, self._goal_x) + 1
+        self._lo, self._diag, self._horver = 0, np.full(n, np.inf), np.arange(n) * self._horver_cost
+        self._diag[0] = 0.
+        self._row = 0
+        self._rows = deque()  # (lo, start, kind, diag_from_horver) строк после зафиксированной, см. _add_row
+        self._commit_row = 0  # Строка, до которой путь зафиксирован,
+        self._final_row = 0  # и до которой он уже не переложится (см. _fix)
+        self._checked = 0  # и строка, на которой в последний раз проверялось, не сошлись ли пути (см. _settle)
+        self._xs, self._ys = [0], [0]  # Вершины зафиксированного пути, кроме уже не нужных для событий
+        self._path_file, self._path_written = path_file, False
+        self._written = 0  # Номер вершины, до которой путь уже дописан в path_file
+        if path_file is not None:
+            open(path_file, 'wb').close()
+        self._pending = sorted(subs or [], key=lambda event: max(event.timing.begin_ss, event.timing.end_ss))
+        self.corrupted_events = []  # События, длительность которых изменилась при сдвиге
+        self.commits, self.forced_commits, self.splices, self.max_latency = 0, 0, 0, 0.
+
+    @property
+    def rows(self):
+        """Сколько векторов потока уже пришло"""
+        return self._row
+
+    def push(self, vectors):
+        """Добавляет векторы уровня 1 потока (см. StreamFeatures) и возвращает события, которые уже можно сдвинуть"""
+        for unit, log_norm in zip(*Spectrogram.normalize(vectors)):
+            self._add_row(unit, log_norm)
+            if self._row - max(self._commit_row, self._checked) >= self._lag // 4:
+                self._settle()
+        return self._emit()
+
+    def finish(self):
+        """Поток кончился: фиксирует путь до конца (в угол решётки, если он в окне) и сдвигает все события"""
+        if self._row > self._commit_row:
+            end = self._goal_x - self._lo
+            if not 0 <= end < len(self._diag) or not np.isfinite(min(self._diag[end], self._horver[end])):
+                end = int(np.argmin(np.minimum(self._diag, self._horver)))
+            self._fix(self._row, self._lo + end, self._diag[end] > self._horver[end])
+        return self._emit(final=True)
+
+    def _add_row(self, unit, log_norm):
+        """
+        Строка для очередного вектора потока. Гор./верт. состояние клетки x считается как цепочка ходов '-'
+        из клетки start[x] той же строки, в которую пришли ходом kind[start[x]]: '|' из гор./верт. или
+        диагонального состояния строки выше или '-' из диагонального состояния соседней клетки. Ничьи решаются
+        как в Comparator._wavefront: без смены состояния и ходом '|'.
+        """
+        self._row += 1
+        center = self._lo + int(np.argmin(np.minimum(self._diag, self._horver)))
+        lo = min(max(center - self._radius, 0), max(self._goal_x - 2 * self._radius, 0))
+        n = min(lo + 2 * self._radius, self._goal_x) - lo + 1
+        xs = np.arange(lo, lo + n)
+
+        stay = _shifted(self._diag, self._lo, lo - 1, n)
+        switch = _shifted(self._horver, self._lo, lo - 1, n) + Config.PENALTY
+        diag_from_horver = switch < stay
+        diag = np.where(diag_from_horver, switch, stay)
+        reachable = xs[np.isfinite(diag)] - 1  # Векторы эталона, с которыми сравнивается очередной вектор потока
+        metrics.count('cost_evaluations', len(reachable))
+        sim = 1 - self._unit[reachable] @ unit
+        diag[reachable + 1 - lo] += np.clip(sim, 0, 2) * (self._log_norm[reachable] + log_norm)
+
+        stay, switch = _shifted(self._horver, self._lo, lo, n), _shifted(self._diag, self._lo, lo, n) + Config.PENALTY
+        kind = (switch < stay).astype(np.uint8)
+        vert = np.where(switch < stay, switch, stay) + self._horver_cost
+        dash = np.concatenate(([np.inf], diag[:-1])) + Config.PENALTY + self._horver_cost
+        by_dash = dash < vert
+        kind[by_dash] = self.DASH_SWITCH
+        first = np.where(by_dash, dash, vert)
+        # Цепочка: horver[x] = min по k <= x из first[k] + (x-k)*horver_cost
+        steps = np.arange(n) * self._horver_cost
+        best = np.minimum.accumulate(first - steps)
+        start = np.maximum.accumulate(np.where(first - steps <= best, np.arange(n), 0)).astype(np.int32)
+        horver = best + steps
+
+        least = min(np.min(diag), np.min(horver))
+        self._lo, self._diag, self._horver = lo, diag - least, horver - least
+        self._rows.append((lo, start, kind, diag_from_horver))
+
+    def _step(self, record, xs, horver):
+        """Сдвигает точки xs в состояниях horver одной строки на их лучших путях в строку выше"""
+        lo, start, kind, diag_from_horver = record
+        i = np.where(horver, start[xs - lo], xs - lo)
+        kinds = kind[i]
+        diag = ~horver | (kinds == self.DASH_SWITCH)
+        i = np.where(horver & diag, i - 1, i)
+        return (np.where(diag, i - 1, i) + lo,
+                np.where(diag, diag_from_horver[i], kinds == self.VERT_STAY))
+
+    def _trace(self, row, x, horver, to_row):
+        """
+        Ходы лучшего пути в клетку (x, row) в состоянии horver от строки to_row (не выше зафиксированной),
+        а также клетка и состояние, в которых этот путь приходит в строку to_row.
+        """
+        moves, first = [], to_row - self._commit_row
+        for lo, start, kind, diag_from_horver in reversed(list(self._rows)[first:row - self._commit_row]):
+            i = x - lo
+            if horver:
+                k = start[i]
+                moves.extend('-' * (i - k))
+                i = k
+                if kind[i] != self.DASH_SWITCH:
+                    moves.append('|')
+                    x, horver = lo + i, kind[i] == self.VERT_STAY
+                    continue
+                moves.append('-')
+                i -= 1
+            moves.append('/')
+            x, horver = lo + i - 1, bool(diag_from_horver[i])
+        if to_row == 0 and horver:
+            moves.extend('-' * x)  # В нулевой строке в (0, 0) ведут только ходы '-'
+            x, horver = 0, self.DIAG
+        return moves[::-1], x, horver
+
+    def _settle(self):
+        """
+        Ведёт лучшие пути из всех клеток последней строки вверх, пока они не сойдутся в одну клетку, и фиксирует
+        путь до неё. Если задержка дошла до Config.STREAM_LAG, а на последней половине этого срока пути так
+        и не сошлись, фиксируется путь до лучшей клетки последней строки, взятый на этой половине.
+        """
+        self._checked = self._row
+        forced = self._row - self._commit_row >= self._lag
+        last = self._row - self._lag // 2 if forced else self._commit_row + 1  # Верхняя строка, где ждём схождения
+        finite = [np.flatnonzero(np.isfinite(costs)) + self._lo for costs in (self._diag, self._horver)]
+        codes, row = np.concatenate((finite[0] * 2, finite[1] * 2 + 1)), self._row  # Код точки: 2*x + horver
+        while True:
+            codes.sort()  # Сошедшиеся пути дальше ведутся как один
+            codes = codes[np.concatenate(([True], codes[1:] != codes[:-1]))]
+            if len(codes) == 1:
+                self._fix(row, int(codes[0]) // 2, bool(codes[0] % 2), settled=True)
+                return
+            if row == last:
+                break
+            xs, horver = self._step(self._rows[row - self._commit_row - 1], codes // 2, codes % 2 == 1)
+            codes, row = xs * 2 + horver, row - 1
+        if forced:
+            best = int(np.argmin(np.minimum(self._diag, self._horver)))
+            _, x, horver = self._trace(self._row, self._lo + best, self._diag[best] > self._horver[best], last)
+            self.forced_commits += 1
+            metrics.count('forced_commits')
+            self._fix(last, x, horver)
+
+    def _fix(self, row, x, horver, settled=False):
+        """
+        Фиксирует путь до клетки (x, row) в состоянии horver (settled - это точка схождения). Без схождения
+        (см. _settle) этот путь может прийти в строку прошлой зафиксированной точки не в неё. Если он пришёл
+        правее, он пристыковывается к ней ходами '-' по этой строке. Если левее, то прошлая точка была ошибкой:
+        ещё не окончательная часть пути (см. _final) перекладывается ходами '|' из первой своей точки в столбце,
+        куда пришёл новый путь, а если в нём путь уже окончателен, новый путь пристыковывается к окончательному
+        ходами '|' до места, где он дошёл до его столбца.
+        """
+        moves, landing, _ = self._trace(row, x, horver, self._commit_row)
+        if landing == self._xs[-1]:
+            self._final_row = self._commit_row
+        elif landing < self._xs[-1]:
+            self._rewind(max(landing, self._xs[self._final()]))
+        end_x = self._xs[-1]
+        if landing > end_x:
+            moves = ['-'] * (landing - end_x) + moves
+        elif landing < end_x:
+            codes = np.frombuffer(''.join(moves).encode('ascii'), dtype=np.uint8)
+            xs, ys = landing + np.cumsum(codes != ord('|')), np.cumsum(codes != ord('-'))
+            joint = np.searchsorted(xs, end_x)
+            moves = ['|'] * int(ys[joint] if joint < len(moves) else row - self._commit_row) + moves[joint + 1:]
+        if landing != end_x:
+            self.splices += 1
+            metrics.count('splices')
+        for _ in range(row - self._commit_row):
+            self._rows.popleft()
+        latency = (self._row - row) * Config.BASE_TICK * Config.PRECISION / 100
+        self.max_latency = max(self.max_latency, latency)
+        self.commits += 1
+        metrics.count('commits')
+        metrics.record('max_latency', self.max_latency)
+        self._commit_row = row
+        if settled:
+            self._final_row = row
+        if not moves:
+            return
+        xs, ys = Path.from_moves(moves).vertices()
+        self._xs.extend((xs[1:] + self._xs[-1]).tolist())
+        self._ys.extend((ys[1:] + self._ys[-1]).tolist())
+
+    def _final(self):
+        """
+        Номер последней вершины окончательной части зафиксированного пути: до последней точки схождения или
+        подтверждённой точки (см. _fix) и до строк старше 2*Config.STREAM_LAG секунд
+        """
+        row = max(self._final_row, min(self._commit_row, self._row - 2 * self._lag))
+        return bisect_right(self._ys, row) - 1
+
+    def _rewind(self, x):
+        """
+        Обрезает зафиксированный путь после его первой точки в столбце x (правее окончательной части) и ведёт
+        его оттуда ходами '|' до строки последней зафиксированной точки
+        """
+        i = bisect_left(self._xs, x, self._final() + 1)  # Первая вершина в столбце x или правее
+        if i == len(self._xs):
+            return
+        if self._xs[i] == x:
+            del self._xs[i + 1:], self._ys[i + 1:]
+        else:  # Участок перед вершиной i пересекает столбец x: он диагональный или горизонтальный
+            y = self._ys[i - 1] + (x - self._xs[i - 1] if self._ys[i] > self._ys[i - 1] else 0)
+            del self._xs[i:], self._ys[i:]
+            if self._xs[-1] != x:
+                self._xs.append(x)
+                self._ys.append(y)
+        if self._ys[-1] < self._commit_row:
+            self._xs.append(x)
+            self._ys.append(self._commit_row)
+
+    def _write_path(self, final):
+        """Дописывает в path_file окончательную часть пути от прошлой записи до вершины номер final"""
+        dxs, dys = np.diff(self._xs[self._written:final + 1]), np.diff(self._ys[self._written:final + 1])
+        self._written = final
+        if self._path_file is None or not len(dxs):
+            return
+        added = Path.from_moves([('-' if dy == 0 else '/') * dx if dx else '|' * dy
+                                 for dx, dy in zip(dxs.tolist(), dys.tolist())])
+        with open(self._path_file, 'ab') as f:
+            f.write(((' ' if self._path_written else '') + str(added)).encode('utf-8'))
+        self._path_written = True
+
+    def _emit(self, final=False):
+        """Сдвигает ожидающие события, за концами которых путь уже окончателен (при final - все)"""
+        last = len(self._xs) - 1 if final else self._final()
+        limit = self._xs[last] * Config.PRECISION
+        ready = 0
+        while ready < len(self._pending) and (final or max(self._pending[ready].timing.begin_ss,
+                                                           self._pending[ready].timing.end_ss) < limit):
+            ready += 1
+        events, self._pending = self._pending[:ready], self._pending[ready:]
+        if events:
+            time_map = TimeMap(np.array(self._xs) * Config.PRECISION, np.array(self._ys) * Config.PRECISION)
+            begins = time_map.last([event.timing.begin_ss for event in events])
+            ends = time_map.first([event.timing.end_ss for event in events])
+            for event, begin, end in zip(events, begins.tolist(), ends.tolist()):
+                old = len(event.timing)
+                event.timing.begin_ss, event.timing.end_ss = begin, end
+                event.timing.str_update()
+                if len(event.timing) != old:
+                    self.corrupted_events.append(repr(event))
+        self._write_path(last)
+        # Нужны только вершины с последней окончательной (дальше путь ещё может переложиться) и вокруг
+        # оставшихся событий
+        keep = self._written
+        if self._pending:
+            earliest = min(min(event.timing.begin_ss, event.timing.end_ss) for event in self._pending)
+            keep = min(keep, max(bisect_left(self._xs, earliest / Config.PRECISION) - 1, 0))
+        del self._xs[:keep], self._ys[:keep]
+        self._written -= keep
+        return events
+
+
+def write_text(f, text):
+    f.write(fix_text(text, ()).replace('\n', '\r\n').encode('utf-8'))
+    f.flush()
+
+
+def align_stream(reference, stream, ass_file, output=None):
+    """Двигает сабы ass_file к эталону reference под поток stream, дописывая события в output по мере готовности"""
+    to_delete = set()
+    cache = FeatureCache() if Config.CACHE_DIR is not None else None
+    with metrics.span('prepare'):
+        spectrums, _ = prepare_spectrums([reference], to_delete, cache)
+    subs = Subs().parse(ass_file)
+    output = output or ass_file[:-4] + '_shifted.ass'
+    features = StreamFeatures(Config.DEFAULT_HZ)
+    aligner = OnlineAligner(spectrums[0], subs, Config.LOG_FILE)
+    with open(output, 'wb') as f, metrics.span('stream', source=stream):
+        write_text(f, subs.header(remove_garbage=False, default_styles=False) + subs.event_format)
+        for chunk in decode_stream(stream):
+            write_text(f, ''.join('\n' + repr(event) for event in aligner.push(features.push(chunk))))
+        events = aligner.push(features.finish()) + aligner.finish()
+        write_text(f, ''.join('\n' + repr(event) for event in events))
+        metrics.record('vectors', aligner.rows)
+    print("Corrupted events: {}".format("\n" + "\n".join(aligner.corrupted_events)
+                                        if aligner.corrupted_events else None))
+    print("Stream done: {0} commits ({1} forced, {2} spliced), latency up to {3:.1f} sec"
+          .format(aligner.commits, aligner.forced_commits, aligner.splices, aligner.max_latency))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (4, 5):
+        print(__doc__)
+        sys.exit(1)
+    metrics.start()
+    align_stream(*sys.argv[1:])
+    metrics.finish(Config.METRICS_FILE)
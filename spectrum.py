@@ -1,7 +1,9 @@
 # Standard
-from random import randrange
-import random
-from time import clock
+from concurrent.futures import ProcessPoolExecutor
+from os import path
+from shutil import rmtree
+from tempfile import mkdtemp, TemporaryFile
+from time import perf_counter
 
 # Third-party
 import numpy as np
@@ -15,15 +17,16 @@ except ImportError:
     pass
 
 # My modules
+import features
+import landmarks
+import memory
+import metrics
 from config import Config
 from grid_path import Point, Path
 # from priority_queue import PriorityQueue
 # from grid_set import GridSet
 
 
-random.seed = 31168
-
-
 def cos_sim(x, y):
     # Cosine similarity с учётом возможных нуль-векторов
     nonzero = x.any(), y.any()
@@ -50,6 +53,19 @@ def cos_log(x, y):
     return cos_sim(x, y) * (np.log(1 + np.linalg.norm(x)) + np.log(1 + np.linalg.norm(y)))
 
 
+def _shifted(values, values_lo, lo, n):
+    """
+    Кусок среза values (первая точка которого имеет абсциссу values_lo) на абсциссах lo..lo+n-1,
+    точки вне среза заполняются бесконечностью.
+    """
+    ans = np.full(n, np.inf)
+    start = lo - values_lo
+    begin, end = max(0, -start), min(n, len(values) - start)
+    if begin < end:
+        ans[begin:end] = values[start+begin:start+end]
+    return ans
+
+
 def extract_mono(data):
     if len(data.shape) > 1:
         return np.transpose(data)[0]
@@ -57,14 +73,31 @@ def extract_mono(data):
 
 
 class Spectrogram:
-    MULT_BY = 1  # Текущая точность вычислений, измеряется в Config.PRECISION-ах
-
-    def __init__(self, filename):
+    def __init__(self, filename, signal=None, cached=None):
+        """
+        Если signal=(частота, сигнал) уже раскодирован (см. media.decode_pipe), filename нужен только для вывода.
+        Если дан cached=(частота, базовая спектрограмма, {уровень: спектрограмма}) из FeatureCache, сигнал не нужен вовсе.
+        Как хранить базовую спектрограмму и пирамиду, решает memory.plan по Config.MEMORY_BUDGET.
+        """
         self._filename = filename
-        self._rate, self._wav = self.file_open(filename)
+        self._pyramid = {}  # Уровень (множитель к Config.PRECISION) : (спектрограмма, unit, log_norm)
+        self._curr_spec = self._unit = self._log_norm = self._plan = None
+        if cached is not None:
+            (self._rate, self._base_spec, levels), self._wav = cached, None
+            if self._base_spec is not None:
+                self._plan = memory.plan(filename, *self._base_spec.shape,
+                                         base_in_memory=not isinstance(self._base_spec, np.memmap))
+            for mult, spec in levels.items():
+                self._add_level(mult, spec)
+            return
+        self._rate, self._wav = self.file_open(filename) if signal is None else (signal[0], extract_mono(signal[1]))
         self._samples_in_tick = int(Config.BASE_TICK * self._rate / 100)
+        window_size = self._samples_in_tick * Config.B_OVERLAP_DEGREE
+        self._projection = features.projection(self._rate, window_size)
+        self._plan = memory.plan(filename, -(-len(self._wav) // self._samples_in_tick),
+                                 features.width(self._projection, window_size),
+                                 0 if isinstance(self._wav, np.memmap) else self._wav.nbytes)
         self._base_spec = self.calculate_base_spec()
-        self._curr_spec = None
 
     def __getitem__(self, item):
         return self._curr_spec[item]
@@ -76,30 +109,159 @@ class Spectrogram:
     def base_len(self):
         return len(self._base_spec)
 
+    @property
+    def base_spec(self):
+        return self._base_spec
+
+    @property
+    def rate(self):
+        return self._rate
+
+    @property
+    def levels(self):
+        """Уже построенные уровни пирамиды: {уровень: спектрограмма}"""
+        return {mult: level[0] for mult, level in self._pyramid.items()}
+
     def calculate_base_spec(self):
+        with metrics.span('base_spectrogram', file=self._filename):
+            spec = self._calculate_base_spec()
+            metrics.record('vectors', len(spec))
+        return spec
+
+    def _calculate_base_spec(self):
         window_size = self._samples_in_tick * Config.B_OVERLAP_DEGREE
         overlap = self._samples_in_tick * (Config.B_OVERLAP_DEGREE - 1)
-        wav_reshape = (-len(self._wav))//self._samples_in_tick*(-self._samples_in_tick)+overlap
-        new_wav = np.concatenate((self._wav, np.zeros(wav_reshape-len(self._wav))))
-        spec = np.transpose(spectrogram(new_wav, nperseg=window_size, noverlap=overlap)[2])
-        # chunk_size = len(spec)//self.MAXIMAL_SIZE + 1
-        # chunk_number = len(spec)//chunk_size
-        # self._spec = np.transpose(np.average(spec[:chunk_number*chunk_size]
-        #                                      .reshape(chunk_number, chunk_size, spec.shape[1]), 1))
+        ticks = -(-len(self._wav)//self._samples_in_tick)
+        spec = self._chunked_base_spec(window_size, overlap, max(Config.SPEC_CHUNK or ticks, 1))
         print("Spectrogram size is", spec.shape)
         return spec
 
-    def calculate_curr_spec(self):
-        tick = Config.PRECISION * self.MULT_BY  # in base_ticks
+    def _chunked_base_spec(self, window_size, overlap, chunk_size):
+        """
+        То же, что и один вызов spectrogram по всему дополненному нулями сигналу, но по chunk_size векторов
+        за раз. Кусок сигнала для векторов begin..end-1 захватывает ещё overlap отсчётов следующего куска, а нулями
+        дополняются отдельно только последние векторы, окна которых выходят за конец сигнала, так что остальное
+        берётся из сигнала без копий, а результат совпадает побитово.
+        Каждый кусок сразу проецируется в признаки Config.FEATURES, так что целиком хранятся только они, и считается
+        в типе базовой спектрограммы из memory.plan.
+        """
+        tick = self._samples_in_tick
+        ticks = -(-len(self._wav)//tick)
+        spec = self._allocate_base_spec((ticks, features.width(self._projection, window_size)))
+        inner = max((len(self._wav) - window_size) // tick + 1, 0)  # Векторы, окна которых целиком в сигнале
+        for begin in range(0, ticks, chunk_size):
+            metrics.progress(begin, ticks)
+            end = min(begin + chunk_size, ticks)
+            middle = min(max(inner, begin), end)
+            for first, last in ((begin, middle), (middle, end)):
+                if first == last:
+                    continue
+                piece, size = self._wav[first*tick:last*tick + overlap], (last - first)*tick + overlap
+                if len(piece) < size:
+                    piece = np.concatenate((piece, np.zeros(size - len(piece), dtype=spec.dtype)))
+                spec[first:last] = features.project(
+                    np.transpose(spectrogram(piece.astype(spec.dtype, copy=False), nperseg=window_size,
+                                             noverlap=overlap)[2]), self._projection)
+        return spec
+
+    def _allocate_base_spec(self, shape):
+        """
+        Место под базовую спектрограмму: в .npy-файле в Config.SPEC_MEMMAP_DIR, во временном файле, если так решил
+        memory.plan, или в памяти. Тип - из memory.plan (по умолчанию float64).
+        """
+        dtype = np.float64 if self._plan is None else self._plan.dtype
+        if Config.SPEC_MEMMAP_DIR is not None:
+            name = '{0}_spec{1}Hz.npy'.format(path.splitext(path.basename(self._filename))[0], self._rate)
+            return np.lib.format.open_memmap(path.join(Config.SPEC_MEMMAP_DIR, name), mode='w+', dtype=dtype,
+                                             shape=shape)
+        if self._plan is not None and self._plan.on_disk:
+            return np.memmap(TemporaryFile(), dtype=dtype, mode='w+', shape=shape)
+        return np.empty(shape, dtype=dtype)
+
+    def _store(self, array):
+        """array или его копия во временном файле через mmap, если memory.plan не даёт держать его в памяти"""
+        if self._plan is None or not self._plan.on_disk or isinstance(array, np.memmap):
+            return array
+        stored = np.memmap(TemporaryFile(), dtype=array.dtype, mode='w+', shape=array.shape)
+        stored[:] = array
+        return stored
+
+    def build_pyramid(self, top_mult):
+        """
+        Строит за один проход все уровни 1, 2, 4, ..., top_mult, по которым пройдёт full_search. Вектор номер i
+        уровня mult - среднее строк базовой спектрограммы с i*tick по (i+C_OVERLAP_DEGREE)*tick, где
+        tick = Config.PRECISION * mult, а за концом спектрограммы стоят нули. Для этого считаются суммы блоков по tick
+        строк: блоки уровня 2*mult - суммы пар соседних блоков уровня mult, а окно - сумма C_OVERLAP_DEGREE блоков.
+        (Префиксные суммы по всей спектрограмме дали бы то же за O(1) на окно, но теряют точность на тихих местах
+        после громких и могут сделать нуль-вектор ненулевым.)
+        Нули за концом не дописываются копиями: окно складывается из срезов блоков, а непарный последний блок
+        просто переходит на следующий уровень. Сложение с нулём точное, так что результат тот же. Блоки и уровни -
+        в типе базовой спектрограммы.
+        """
+        if all(2**i in self._pyramid for i in range(int(np.log2(top_mult)) + 1)):
+            return  # Например, все уровни уже загружены из FeatureCache
         ticks, freq = self._base_spec.shape
-        window_number = -((-ticks)//tick)
-        spec_reshape = (window_number + Config.C_OVERLAP_DEGREE - 1) * tick
-        new_spec = np.concatenate((self._base_spec, np.zeros((spec_reshape-ticks, freq))))
-        self._curr_spec = np.array([np.average(new_spec[i*tick:(i+Config.C_OVERLAP_DEGREE)*tick], axis=0) for i in range(window_number)])
+        full = ticks // Config.PRECISION * Config.PRECISION
+        blocks = np.empty((-(-ticks // Config.PRECISION), freq), dtype=self._base_spec.dtype)
+        self._base_spec[:full].reshape(-1, Config.PRECISION, freq).sum(axis=1, out=blocks[:full // Config.PRECISION])
+        if full < ticks:
+            blocks[-1] = self._base_spec[full:].sum(axis=0)
+        mult = 1
+        while mult <= top_mult:
+            tick, window_number = Config.PRECISION * mult, len(blocks)
+            with metrics.span('pyramid_level', file=self._filename, mult=mult):
+                spec = blocks.copy()
+                for i in range(1, Config.C_OVERLAP_DEGREE):
+                    spec[:window_number - i] += blocks[i:]
+                spec /= Config.C_OVERLAP_DEGREE * tick
+                self._add_level(mult, spec)
+                metrics.record('vectors', window_number)
+            half = len(blocks) // 2
+            coarser = np.empty((len(blocks) - half, freq), dtype=blocks.dtype)
+            np.add(blocks[:2*half:2], blocks[1::2], out=coarser[:half])
+            if len(blocks) % 2:
+                coarser[-1] = blocks[-1]
+            blocks, mult = coarser, mult * 2
+
+    def _add_level(self, mult, spec):
+        """
+        Кладёт уровень в пирамиду. По memory.plan векторы приводятся к его типу, а единичные векторы уровней
+        от Config.FLOAT16_MULT - к типу грубых уровней (их координаты от -1 до 1, так что влезают и во float16;
+        сами векторы - суммы спектров мощности, для float16 они слишком велики). Нормировка - до приведения.
+        """
+        unit, log_norm = self.normalize(spec)
+        if self._plan is not None:
+            unit_dtype = self._plan.coarse_dtype if mult >= Config.FLOAT16_MULT else self._plan.dtype
+            spec = self._store(np.asarray(spec, dtype=self._plan.dtype))
+            unit = self._store(np.asarray(unit, dtype=unit_dtype))
+        self._pyramid[mult] = (spec, unit, log_norm)
+
+    @staticmethod
+    def normalize(spec):
+        """Векторы spec, нормированные на единичную длину, и log(1+длина) каждого, как в cos_log"""
+        norms = np.linalg.norm(spec, axis=1)
+        unit = spec / np.where(norms > 0, norms, 1)[:, np.newaxis]  # Нуль-векторы остаются нулями
+        return unit, np.log(1 + norms)
+
+    def use_level(self, mult):
+        """Делает текущим уровень пирамиды с тиком Config.PRECISION * mult базовых тиков"""
+        if mult not in self._pyramid:
+            self.build_pyramid(mult)
+        self._curr_spec, self._unit, self._log_norm = self._pyramid[mult]
+
+    @property
+    def unit(self):
+        """Векторы текущего уровня, нормированные на единичную длину"""
+        return self._unit
+
+    @property
+    def log_norm(self):
+        """log(1+длина) векторов текущего уровня, как в cos_log"""
+        return self._log_norm
 
     @staticmethod
     def file_open(filename):
-        rate, data = wavfile.read(filename)
+        rate, data = wavfile.read(filename, mmap=Config.SPEC_CHUNK is not None)  # По кускам сигнал читается с диска
         print("Rate of {}:".format(filename), rate)
         data = extract_mono(data)
         """
@@ -113,22 +275,87 @@ class Spectrogram:
         """
         return rate, data
 
-    def rand_vector(self):
-        return self._curr_spec[randrange(len(self._curr_spec))]
-
     @property
     def shape(self):
         return self._curr_spec.shape
 
 
+class StreamFeatures:
+    """
+    Векторы самого подробного уровня пирамиды (уровня 1) для сигнала, который приходит кусками: push(кусок)
+    возвращает векторы, которые по уже пришедшему звуку можно посчитать окончательно, а finish() - оставшиеся
+    в конце, где сигнал дополняется нулями. Вместе они совпадают с уровнем 1 Spectrogram.build_pyramid по всему
+    сигналу, а в памяти держится только хвост из нескольких тиков.
+    """
+    def __init__(self, rate):
+        self._tick = int(Config.BASE_TICK * rate / 100)
+        self._window, self._overlap = self._tick * Config.B_OVERLAP_DEGREE, self._tick * (Config.B_OVERLAP_DEGREE - 1)
+        self._projection = features.projection(rate, self._window)
+        self._freq = features.width(self._projection, self._window)
+        self._samples = np.zeros(0)  # Ещё не разобранный хвост сигнала
+        self._received, self._done = 0, 0  # Сколько пришло отсчётов и сколько посчитано векторов базовой спектрограммы
+        self._frames = np.zeros((0, self._freq))  # Векторы базовой спектрограммы, ещё не сложенные в блок
+        self._blocks = np.zeros((0, self._freq))  # Блоки по Config.PRECISION векторов, которые ещё войдут в окна
+
+    def push(self, samples):
+        samples = extract_mono(samples)
+        self._received += len(samples)
+        self._samples = np.concatenate((self._samples, samples))
+        count = max((len(self._samples) - self._overlap) // self._tick, 0)
+        frames = self._base_frames(self._samples[:count*self._tick + self._overlap], count)
+        self._samples = self._samples[count*self._tick:]
+        return self._vectors(frames, final=False)
+
+    def finish(self):
+        count = -(-self._received // self._tick) - self._done
+        chunk = np.zeros(count*self._tick + self._overlap)
+        piece = self._samples[:len(chunk)]
+        chunk[:len(piece)] = piece
+        self._samples = np.zeros(0)
+        return self._vectors(self._base_frames(chunk, count), final=True)
+
+    def _base_frames(self, chunk, count):
+        # Тот же вызов, что в Spectrogram._chunked_base_spec, так что векторы совпадают побитово
+        self._done += count
+        if count <= 0:
+            return np.zeros((0, self._freq))
+        return features.project(np.transpose(spectrogram(chunk, nperseg=self._window, noverlap=self._overlap)[2]),
+                                self._projection)
+
+    def _vectors(self, frames, final):
+        frames = np.concatenate((self._frames, frames))
+        full = len(frames) // Config.PRECISION * Config.PRECISION
+        blocks = frames[:full].reshape(-1, Config.PRECISION, self._freq).sum(axis=1)
+        self._frames = frames[full:]
+        if final and len(self._frames):
+            blocks = np.concatenate((blocks, self._frames.sum(axis=0)[np.newaxis]))
+            self._frames = self._frames[:0]
+        blocks = np.concatenate((self._blocks, blocks))
+        window_number = len(blocks) if final else max(len(blocks) - Config.C_OVERLAP_DEGREE + 1, 0)
+        if final:
+            blocks = np.concatenate((blocks, np.zeros((Config.C_OVERLAP_DEGREE - 1, self._freq))))
+        spec = (sum(blocks[i:i+window_number] for i in range(Config.C_OVERLAP_DEGREE))
+                / (Config.C_OVERLAP_DEGREE * Config.PRECISION))
+        self._blocks = blocks[window_number:]
+        return spec
+
+
 class Comparator:
-    def __init__(self, spec1, spec2):
+    def __init__(self, spec1, spec2, av_costs=None, around=(None, None)):
+        """
+        av_costs - средние расстояния {уровень: среднее}, если они уже известны (см. _parallel_refine);
+        around - ходы, которыми путь входит в начало решётки и выходит из её конца, если она - кусок большей.
+        """
         self._x, self._y = spec1, spec2
+        self._av_costs = dict(av_costs or {})
+        self._around = around
         self._goal, self._av_cost = None, None
+        self._horver_costs = None  # Стоимости гор./верт. рёбер по срезам текущего уровня, см. _local_horver_costs
+        self._mult = 1  # Текущая точность вычислений, измеряется в Config.PRECISION-ах
 
     """
     def _a_star_search(self):
-        first_stamp = prev_stamp = clock()
+        first_stamp = prev_stamp = perf_counter()
         front = PriorityQueue()  # В key хранятся координаты, в value - пара (цена, путь), в priority - цена+эвристика
         front.update(key=Point(0, 0), priority=0, cost=0, path=Path(), move=None)
         cycles, current, self._goal = 0, None, Point(len(self._x), len(self._y))
@@ -138,9 +365,9 @@ class Comparator:
         while not front.empty():
             current = front.pop()
 
-            if clock() - prev_stamp > 10:
+            if perf_counter() - prev_stamp > 10:
                 print('Current: {0}; heap_size: {1}; cnt: {2}'.format(str(current), str(len(front)), str(cycles)))
-                prev_stamp = clock()
+                prev_stamp = perf_counter()
 
             if current.key == self._goal:
                 break
@@ -153,18 +380,66 @@ class Comparator:
             visited.add(current.key)
             cycles += 1
 
-        print("A* terminated in {0} cycles and {1} seconds.".format(cycles, clock()-first_stamp))
+        print("A* terminated in {0} cycles and {1} seconds.".format(cycles, perf_counter()-first_stamp))
         return current.path
     """
 
     def _average_cost(self):
-        ans = sum(cos_log(self._x.rand_vector(), self._y.rand_vector()) for _ in range(Config.SAMPLE_SIZE))/Config.SAMPLE_SIZE
+        """
+        Среднее расстояние на текущем уровне по Config.SAMPLE_SIZE случайным парам векторов; выборка зависит
+        только от Config.SEED. Для уровней, заданных в av_costs при создании, берётся готовое значение.
+        """
+        if self._mult in self._av_costs:
+            return self._av_costs[self._mult]
+        rng = np.random.RandomState(Config.SEED)
+        ans = float(np.average(self.costs(rng.randint(len(self._x), size=Config.SAMPLE_SIZE),
+                                          rng.randint(len(self._y), size=Config.SAMPLE_SIZE))))
         print('Av_cost={0}'.format(ans))
+        self._av_costs[self._mult] = ans
         return ans
 
+    def _local_horver_costs(self, draft_path):
+        """
+        Стоимость гор./верт. ребра, входящего в срез s, для s = 1..goal.slice (элемент s-1). Обычно это
+        Config.NONDIAGKOEF средних расстояний по всей решётке, а при заданном Config.LOCAL_AV_COST среднее своё
+        в каждом окне из стольких секунд срезов: по Config.LOCAL_SAMPLE_SIZE случайным клеткам прямоугольника,
+        накрывающего полосу радиуса Config.RADIUS вокруг draft_path в этом окне.
+        """
+        n_slices = self._goal.slice
+        if Config.LOCAL_AV_COST is None:
+            return np.full(n_slices, self._av_cost * Config.NONDIAGKOEF)
+        vector_ss = Config.BASE_TICK * Config.PRECISION * self._mult
+        window = max(int(2 * Config.LOCAL_AV_COST * 100 / vector_ss), 2)  # Диагональный ход - это два среза
+        lo, hi = self._band(draft_path, Config.RADIUS)
+        starts = np.arange(0, n_slices, window)
+        x_lo, x_hi = np.minimum.reduceat(lo, starts), np.maximum.reduceat(hi, starts)
+        s_lo, s_hi = starts + 1, np.minimum(starts + window, n_slices)
+        # Диагональное ребро в клетку (x, y) стоит costs(x-1, y-1), поэтому и выборка из векторов x-1, y-1
+        bounds = [np.clip(i - 1, 0, size - 1) for i, size in ((x_lo, len(self._x)), (x_hi, len(self._x)),
+                                                              (s_lo - x_hi, len(self._y)), (s_hi - x_lo, len(self._y)))]
+        rng = np.random.RandomState(Config.SEED)
+        samples = []
+        for low, high in (bounds[:2], bounds[2:]):
+            samples.append(low[:, np.newaxis] + (rng.random_sample((len(starts), Config.LOCAL_SAMPLE_SIZE))
+                                                 * (high - low + 1)[:, np.newaxis]).astype(np.int64))
+        local = self.costs(samples[0].ravel(), samples[1].ravel()).reshape(len(starts), -1).mean(axis=1)
+        return np.repeat(local * Config.NONDIAGKOEF, window)[:n_slices]
+
+    def costs(self, xs, ys):
+        """
+        Массив cos_log(x[xs[i]], y[ys[i]]) для массивов индексов xs, ys текущего уровня.
+        Считается по предподсчитанным в Spectrogram единичным векторам и логарифмам длин. Нуль-вектор нормирован
+        в нуль, так что 1-<u, v> с ним равно 1, как в cos_sim, а между двумя нуль-векторами множитель из
+        логарифмов равен нулю.
+        """
+        xs, ys = np.asarray(xs), np.asarray(ys)
+        metrics.count('cost_evaluations', len(xs))
+        sim = 1 - np.einsum('ij,ij->i', self._x.unit[xs], self._y.unit[ys], dtype=np.float64)  # Для float16
+        return np.clip(sim, 0, 2) * (self._x.log_norm[xs] + self._y.log_norm[ys])
+
     def _cost(self, v, move):
         if move == '/':
-            return cos_log(self._x[v.x], self._y[v.y])
+            return self.costs([v.x], [v.y])[0]
         return self._av_cost * Config.NONDIAGKOEF
 
     """
@@ -172,7 +447,7 @@ class Comparator:
         return abs(v.diff-self._goal.diff) * self._av_cost
 
     def _last_two_slice_search(self, draft_path):
-        first_stamp = prev_stamp = clock()
+        first_stamp = prev_stamp = perf_counter()
         for spec in (self._x, self._y):
             spec.calculate_spec()
         curr, prev1, prev2 = {}, {}, {}
@@ -180,8 +455,8 @@ class Comparator:
         current_slice = 1
         self._goal, self._av_cost = Point(len(self._x), len(self._y)), self._average_cost
         for point in draft_path.near_path(Config.RADIUS):
-            if clock() - prev_stamp > 10:
-                prev_stamp = clock()
+            if perf_counter() - prev_stamp > 10:
+                prev_stamp = perf_counter()
                 print(point)
             if point.slice > self._goal.slice:
                 break
@@ -199,50 +474,460 @@ class Comparator:
                     except KeyError:
                         continue
                 curr[point] = (best_cost, best_path)
-        print("Time for {0}-prec search: {1}".format(Config.BASE_TICK*Spectrogram.MULT_BY, clock()-first_stamp))
+        print("Time for {0}-prec search: {1}".format(Config.BASE_TICK*self._mult, perf_counter()-first_stamp))
         return curr[self._goal][1]
     """
 
+    # Коды решений в клетке полосы: из какого состояния и каким ходом в неё пришли лучшие пути.
+    # Хранятся в матрице uint8 (срез, x - lo[срез]), по которой путь восстанавливается в _trace_back.
+    DIAG_FROM_HORVER, HORVER_FROM_DIAG, HORVER_BY_DASH = 1, 2, 4
+    # Коды следующего хода в _backward: из диаг. состояния - гор./верт. ход, из гор./верт. - диагональный;
+    # HORVER_BY_DASH - следующий гор./верт. ход это '-'
+    DIAG_THEN_HORVER, HORVER_THEN_DIAG = 1, 2
+    WAVEFRONT_BLOCK = 2**16  # По скольку клеток полосы _wavefront считает стоимости рёбер за раз
+
+    def _band(self, draft_path, radius):
+        """
+        Границы lo, hi полосы радиуса radius (числа или массива радиусов по срезам draft_path) вокруг draft_path
+        для срезов 1..goal.slice, обрезанные по прямоугольнику решётки.
+        """
+        n_slices = self._goal.slice
+        lo, hi = draft_path.slice_bounds(radius)
+        if len(lo) < n_slices:
+            raise ValueError("Draft path is shorter than the grid")
+        slices = np.arange(1, n_slices+1)
+        return (np.maximum(lo[:n_slices], np.maximum(0, slices - self._goal.y)),
+                np.minimum(hi[:n_slices], np.minimum(self._goal.x, slices)))
+
+    @staticmethod
+    def _decision_matrix(lo, hi):
+        return np.zeros((len(lo), max(np.max(hi - lo, initial=0) + 1, 1)), dtype=np.uint8)
+
+    def _fits(self, lo, hi):
+        """Влезает ли матрица кодов решений полосы lo, hi в Config.TRACEBACK_MEMORY байт"""
+        return (Config.TRACEBACK_MEMORY is None or
+                len(lo) * max(np.max(hi - lo, initial=0) + 1, 1) <= Config.TRACEBACK_MEMORY)
+
     def _penalty_search(self, draft_path):
-        first_stamp = prev_stamp = clock()
+        """
+        Поточечная динамика по клеткам полосы, ключи словарей - пары (x, y). Клетки полосы берутся из
+        draft_path.band_cells целыми массивами, стоимости диагональных рёбер в них тоже считаются заранее разом.
+        """
+        first_stamp = perf_counter()
         curr, prev1, prev2 = {}, {}, {}
-        prev1[Point(0, 0)] = ((0., Path()), (0., Path()))
+        # Лучшие стоимости путей, кончающихся диагональным и гор./верт. ребром
+        prev1[0, 0] = self._init_state(self._around[0])
         current_slice = 1
         self._goal, self._av_cost = Point(len(self._x), len(self._y)), self._average_cost()
+        lo, hi = self._band(draft_path, Config.RADIUS)
+        decisions = self._decision_matrix(lo, hi)
         infinity = self._av_cost * max(Config.PENALTY, 1000) * self._goal.x * self._goal.y
-        for point in draft_path.near_path(Config.RADIUS):
-            if clock() - prev_stamp > 10:
-                prev_stamp = clock()
-                print(point)
-            if point.slice > self._goal.slice:
-                break
-            if point.slice > current_slice:
-                current_slice = point.slice
+        xs, ys = draft_path.band_cells(Config.RADIUS, 1, self._goal.slice)
+        inside = (xs >= 0) & (xs <= self._goal.x) & (ys >= 0) & (ys <= self._goal.y)
+        xs, ys = xs[inside], ys[inside]
+        diag = (xs > 0) & (ys > 0)
+        diag_costs = np.zeros(len(xs))
+        diag_costs[diag] = self.costs(xs[diag] - 1, ys[diag] - 1)
+        self._horver_costs = self._local_horver_costs(draft_path)
+        horver_costs = self._horver_costs.tolist()
+        horver_cost = horver_costs[0]
+        metrics.record('band_cells', len(xs))
+        for x, y, diag_cost in zip(xs.tolist(), ys.tolist(), diag_costs.tolist()):
+            if x + y > current_slice:
+                current_slice = x + y
+                metrics.progress(current_slice, self._goal.slice)
                 curr, prev1, prev2 = {}, curr, prev1
-            if 0 <= point.x <= self._goal.x and 0 <= point.y <= self._goal.y:
-                best_diag_cost, best_diag_path, best_horver_cost, best_horver_path = infinity, None, infinity, None
-                for move, prev in self._options_back(point):
-                    try:
-                        if move == '/':
-                            cost, path = min(prev2[prev][0], self.add_penalty(prev2[prev][1]))
-                            new_cost = cost + self._cost(prev, move)
-                            if best_diag_cost > new_cost:
-                                best_diag_cost, best_diag_path = new_cost, path.plus(move)
-                        else:
-                            cost, path = min(prev1[prev][1], self.add_penalty(prev1[prev][0]))
-                            new_cost = cost + self._cost(prev, move)
-                            if best_horver_cost > new_cost:
-                                best_horver_cost, best_horver_path = new_cost, path.plus(move)
-                    except KeyError:
-                        pass
-
-                curr[point] = ((best_diag_cost, best_diag_path), (best_horver_cost, best_horver_path))
+                horver_cost = horver_costs[current_slice - 1]
+            best_diag_cost, best_horver_cost, code = infinity, infinity, 0
+            if (x - 1, y - 1) in prev2:
+                prev_diag, prev_horver = prev2[x - 1, y - 1]
+                stay, switch = prev_diag, prev_horver + Config.PENALTY
+                best_diag_cost = min(stay, switch) + diag_cost
+                code |= self.DIAG_FROM_HORVER if switch < stay else 0
+            for move, prev in (('|', (x, y - 1)), ('-', (x - 1, y))):
+                if prev in prev1:
+                    stay, switch = prev1[prev][1], prev1[prev][0] + Config.PENALTY
+                    new_cost = min(stay, switch) + horver_cost
+                    if best_horver_cost > new_cost:
+                        best_horver_cost = new_cost
+                        code = (code & self.DIAG_FROM_HORVER | (self.HORVER_FROM_DIAG if switch < stay else 0)
+                                | (self.HORVER_BY_DASH if move == '-' else 0))
+            curr[x, y] = (best_diag_cost, best_horver_cost)
+            decisions[x + y - 1, x - lo[x + y - 1]] = code
         print("Time for penalty search (precision {0} ss): {1}".format(Config.BASE_TICK * Config.PRECISION *
-                                                                       Spectrogram.MULT_BY, clock()-first_stamp))
-        ans = min(curr[self._goal])[1]
+                                                                       self._mult, perf_counter()-first_stamp))
+        goal = self._goal.x, self._goal.y
+        if goal not in curr:
+            raise ValueError("Goal {} is out of the search band".format(self._goal))
+        horver = self._end_state(*curr[goal], self._around[1])
+        ans = Path.from_moves(self._trace_back(Point(0, 0), self._goal, horver, lo, decisions))
+        metrics.record('path_length', len(ans))
+        print("Draft path: {}".format(ans))
+        return ans
+
+    def _wavefront_search(self, draft_path, forbidden=None):
+        """
+        То же, что _penalty_search, но каждый срез полосы (антидиагональ x+y=slice) хранится как пара numpy-массивов
+        стоимостей: для путей, заканчивающихся диагональным и гор./верт. ребром. Переходы, штрафы и минимумы
+        считаются сразу для всего среза.
+        При Config.ADAPTIVE_RADIUS ширина полосы своя на каждом срезе, см. _initial_radius и _widen.
+        forbidden - маска срезов 1..len(x)+len(y), на которых гор./верт. ходы запрещены (см. _lazy_refine).
+        """
+        first_stamp = perf_counter()
+        self._goal, self._av_cost = Point(len(self._x), len(self._y)), self._average_cost()
+        self._horver_costs = self._local_horver_costs(draft_path)
+        if forbidden is not None:
+            self._horver_costs[forbidden] = np.inf
+        radius = self._initial_radius(draft_path) if Config.ADAPTIVE_RADIUS else Config.RADIUS
+        lo, hi = self._band(draft_path, radius)
+        moves = self._solve(Point(0, 0), self._init_state(self._around[0]), self._goal, self._around[1], lo, hi)
+        cells = rerun_cells = int(np.sum(np.maximum(hi - lo + 1, 0)))
+        metrics.record('band_width', int(np.max(hi - lo + 1, initial=0)))
+        if Config.ADAPTIVE_RADIUS:
+            moves, rerun_cells = self._widen(draft_path, radius, moves)
+            metrics.record('rerun_cells', int(rerun_cells))
+            lo, hi = self._band(draft_path, Config.RADIUS)
+            print("Cells evaluated: {0} + {1} in re-runs, {2} with fixed radius"
+                  .format(cells, rerun_cells, np.sum(np.maximum(hi - lo + 1, 0))))
+        else:
+            print("Cells evaluated: {}".format(cells))
+        ans = Path.from_moves(moves)
+        metrics.record('band_cells', cells)
+        metrics.record('path_length', len(ans))
+        print("Time for wavefront search (precision {0} ss): {1}".format(Config.BASE_TICK * Config.PRECISION *
+                                                                         self._mult, perf_counter()-first_stamp))
         print("Draft path: {}".format(ans))
         return ans
 
+    def _wavefront(self, start, init, lo, hi, keep=True):
+        """
+        Динамика по срезам start.slice+1, ..., start.slice+len(lo), на срезе start.slice+i лежат клетки полосы
+        с x от lo[i-1] до hi[i-1]. Все пути начинаются в start, init - (стоимость диаг., стоимость гор./верт.) в нём.
+        Возвращает матрицу кодов решений (None при keep=False) и два последних среза в виде
+        (lo, стоимости диаг., стоимости гор./верт.).
+        Срезы лежат в трёх строках ширины полосы с бесконечными полями, так что соседние срезы берутся срезами строк
+        без копий, а стоимости рёбер считаются сразу для блоков по WAVEFRONT_BLOCK клеток.
+        Там, где гор./верт. ходы запрещены (их стоимость бесконечна, см. _lazy_refine) и полоса идёт по диагонали,
+        в клетку можно прийти только диагональным ходом из того же столбца строки среза s-2, так что такие срезы
+        считаются сразу целым блоком накопленными суммами по чётным и нечётным срезам с тем же порядком сложений.
+        """
+        decisions = self._decision_matrix(lo, hi) if keep else None
+        sizes = np.maximum(hi - lo + 1, 0)
+        width = max(int(np.max(sizes, initial=0)), 1)
+        los = np.concatenate(([start.x, start.x], lo)).astype(np.int64)
+        margin = int(np.max(np.abs(np.concatenate((los[2:] - los[1:-1], los[2:] - los[:-2]))), initial=0)) + 1
+        # Строки срезов s-2, s-1 и s стоимостей диаг. и гор./верт.; клетка x среза лежит в столбце x - lo + margin
+        diags, horvers = np.full((3, width + 2*margin), np.inf), np.full((3, width + 2*margin), np.inf)
+        diags[2, margin], horvers[2, margin] = init  # Срез start
+        inside = np.arange(width)
+        block = max(self.WAVEFRONT_BLOCK // width, 1)
+        code = np.empty(width, dtype=np.uint8)
+        switch, vert, dash = (np.empty(width) for _ in range(3))
+        from_horver, from_diag, dash_from_diag, by_dash = (np.empty(width, dtype=bool) for _ in range(4))
+        forbidden = ~np.isfinite(self._horver_costs[start.slice:start.slice + len(lo)])
+        bulk = np.zeros(len(lo), dtype=bool)  # Срезы, которые считаются целыми блоками
+        bulk[2:] = forbidden[2:] & forbidden[:-2] & (lo[2:] - lo[:-2] == 1) & (sizes[2:] == sizes[:-2])
+        stops = np.append(np.flatnonzero(~bulk), len(lo))  # Где кончаются блоки таких срезов
+        i, costs_from = 0, -block
+        while i < len(lo):
+            if bulk[i]:
+                end = int(stops[np.searchsorted(stops, i)])
+                for first in range(i, end, block):
+                    last = min(first + block, end)
+                    diag_costs, _ = self._edge_costs(start, lo, sizes, first, last, inside)
+                    metrics.progress(start.slice + last, self._goal.slice)
+                    prevs = [diags[(first + k - 2) % 3, margin:margin + width].copy() for k in (0, 1)]
+                    for k, prev in enumerate(prevs):
+                        rows = diag_costs[k::2]
+                        if len(rows):
+                            row = (first + k + 2 * (len(rows) - 1)) % 3
+                            diags[row, margin:margin + width] = np.add.accumulate(np.vstack((prev, rows)))[-1]
+                            horvers[row, margin:margin + width] = np.inf
+                i, costs_from = end, -block
+                continue
+            if not costs_from <= i < costs_from + block:  # Стоимости рёбер в клетки следующих block срезов
+                costs_from = i
+                diag_costs, horver_costs = self._edge_costs(start, lo, sizes, i, min(i + block, len(lo)), inside)
+            s, row = start.slice + i + 1, i % 3
+            metrics.progress(s, self._goal.slice)
+            diag, horver = diags[row, margin:margin + width], horvers[row, margin:margin + width]
+            prev1, prev2 = (i - 1) % 3, (i - 2) % 3
+            at = los[i + 2] - los[i] + margin - 1  # Клетка x-1 среза s-2
+            stay = diags[prev2, at:at + width]
+            np.add(horvers[prev2, at:at + width], Config.PENALTY, out=switch)
+            np.less(switch, stay, out=from_horver)
+            np.minimum(switch, stay, out=diag)
+            diag += diag_costs[i - costs_from]
+
+            at = los[i + 2] - los[i + 1] + margin  # Клетка x среза s-1 (ход '|'), левее неё - x-1 (ход '-')
+            for offset, candidate, candidate_from_diag in ((0, vert, from_diag), (1, dash, dash_from_diag)):
+                stay = horvers[prev1, at - offset:at - offset + width]
+                np.add(diags[prev1, at - offset:at - offset + width], Config.PENALTY, out=switch)
+                np.less(switch, stay, out=candidate_from_diag)
+                np.minimum(switch, stay, out=candidate)
+            np.less(dash, vert, out=by_dash)
+            np.minimum(dash, vert, out=horver)
+            horver += horver_costs[i - costs_from]
+
+            if keep:
+                np.copyto(from_diag, dash_from_diag, where=by_dash)
+                np.multiply(from_horver, self.DIAG_FROM_HORVER, out=code, casting='unsafe')
+                code |= from_diag.view(np.uint8) * np.uint8(self.HORVER_FROM_DIAG)
+                code |= by_dash.view(np.uint8) * np.uint8(self.HORVER_BY_DASH)
+                decisions[i, :width] = code
+            i += 1
+        return decisions, self._wavefront_slice(len(lo) - 2, los, sizes, diags, horvers, margin), \
+            self._wavefront_slice(len(lo) - 1, los, sizes, diags, horvers, margin)
+
+    def _edge_costs(self, start, lo, sizes, first, last, inside):
+        """
+        Стоимости диагональных и гор./верт. рёбер в клетки срезов start.slice+first+1..start.slice+last полосы
+        _wavefront (строка - срез, столбец - x - lo), вне полосы и решётки - бесконечность
+        """
+        xs = lo[first:last, np.newaxis] + inside
+        slices = (start.slice + 1 + np.arange(first, last))[:, np.newaxis]
+        in_band = inside < sizes[first:last, np.newaxis]
+        diag_costs = np.full(xs.shape, np.inf)
+        real = in_band & (xs > 0) & (slices - xs > 0)
+        diag_costs[real] = self.costs(xs[real] - 1, (slices - xs)[real] - 1)
+        return diag_costs, np.where(in_band, self._horver_costs[slices - 1], np.inf)
+
+    @staticmethod
+    def _wavefront_slice(i, los, sizes, diags, horvers, margin):
+        """Срез номер i (-1 - срез start) из строк _wavefront в виде (lo, стоимости диаг., стоимости гор./верт.)"""
+        n = sizes[i] if i >= 0 else int(i == -1)
+        return los[i + 2], diags[i % 3, margin:margin + n].copy(), horvers[i % 3, margin:margin + n].copy()
+
+    def _solve(self, start, init, end, next_move, lo, hi, end_horver=None):
+        """
+        Ходы лучшего пути из start в end в полосе lo, hi (см. _wavefront). Если за end путь продолжается ходом
+        next_move, то состояние в end выбирается с учётом штрафа за смену направления на этом ходу; если задан
+        end_horver, путь приходит в end в этом состоянии.
+        Если матрица кодов решений больше Config.TRACEBACK_MEMORY байт, путь ищется делением пополам, см. _split_solve.
+        Полоса из двух срезов уже не делится (обе половины могли бы выйти ею же), так что в ней хватает памяти
+        на две строки кодов, даже если Config.TRACEBACK_MEMORY меньше.
+        """
+        if len(lo) > 2 and not self._fits(lo, hi):
+            return self._split_solve(start, init, end, next_move, lo, hi, end_horver)
+        decisions, _, (x_lo, diag, horver) = self._wavefront(start, init, lo, hi)
+        if not x_lo <= end.x < x_lo + len(diag):
+            raise ValueError("Point {} is out of the search band".format(end))
+        if end_horver is None:
+            end_horver = self._end_state(diag[end.x - x_lo], horver[end.x - x_lo], next_move)
+        return self._trace_back(start, end, end_horver, lo, decisions)
+
+    def _split_solve(self, start, init, end, next_move, lo, hi, end_horver=None):
+        """
+        То же, что _solve, но с памятью порядка ширины полосы (как у Хиршберга): прямой проход от start до среднего
+        среза m, обратный проход от end до него же, стык в точке с наименьшей суммой стоимостей, а обе половины
+        ищутся через _solve, то есть делятся дальше, пока их матрица кодов не влезет в Config.TRACEBACK_MEMORY.
+        Половину, которая уже влезает, второй раз не считаем: проход по ней сразу запоминает коды, и путь по ней
+        восстанавливается назад от стыка (_trace_back) или вперёд от него (_trace_forward).
+        Путь либо проходит через клетку среза m, либо перепрыгивает его диагональным ходом и приходит на срез m+1
+        в диагональном состоянии, так что стык выбирается среди тех и других вместе с состоянием пути в нём, и штрафы
+        за смену направления на стыке учитываются точно. При равных стоимостях путь может отличаться от _solve.
+        """
+        half = len(lo) // 2  # Срез m = start.slice+half, его полоса - lo[half-1], полоса среза m+1 - lo[half]
+        metrics.count('split_searches')
+        decisions, middle, after = self._wavefront(start, init, lo[:half+1], hi[:half+1],
+                                                   keep=self._fits(lo[:half+1], hi[:half+1]))
+        codes, backward = self._backward(start.slice + half, end, self._tail(next_move, end_horver), lo, hi,
+                                         start.slice, keep=self._fits(lo[half-1:-1], hi[half-1:-1]))
+        candidates = []  # (стоимость, срез, x, состояние гор./верт.)
+        for (x_lo, diag, horver), (b_lo, b_diag, b_horver), s in zip((middle, after), backward, (0, 1)):
+            totals = (diag + _shifted(b_diag, b_lo, x_lo, len(diag)),
+                      horver + _shifted(b_horver, b_lo, x_lo, len(horver)))
+            for state, total in enumerate(totals[:2 - s]):  # На срез m+1 в гор./верт. состоянии путь приходит с m
+                if len(total):
+                    i = int(np.argmin(total))
+                    candidates.append((total[i], start.slice + half + s, x_lo + i, bool(state)))
+        cost, s, x, horver = min(candidates, default=(np.inf, 0, 0, False))
+        if not np.isfinite(cost):
+            raise ValueError("Point {} is out of the search band".format(end))
+        joint, part = Point(x, s - x), s - start.slice
+        if decisions is not None:
+            moves = self._trace_back(start, joint, horver, lo, decisions)
+        else:
+            moves = self._solve(start, init, joint, None, lo[:part], hi[:part], end_horver=horver)
+        if joint.slice == end.slice:
+            return moves
+        if codes is not None:
+            return moves + self._trace_forward(joint, end, horver, lo, start.slice, start.slice + half, codes)
+        return moves + self._solve(joint, self._init_state('|' if horver else '/'), end, next_move, lo[part:],
+                                   hi[part:], end_horver)
+
+    def _backward(self, stop, end, tail, lo, hi, base, keep=False):
+        """
+        Динамика от end назад до среза stop: для клеток полосы (срез s - от lo[s-base-1] до hi[s-base-1]) стоимости
+        лучших путей до end, если в клетку пришли диагональным и гор./верт. ходом. tail - добавки к ним в самом end,
+        см. _tail. Срезы лежат в строках, как в _wavefront.
+        Возвращает матрицу кодов следующего хода для срезов stop..end.slice-1 (None при keep=False, см.
+        _trace_forward) и срезы stop и stop+1 в виде (lo, стоимости диаг., стоимости гор./верт.).
+        """
+        part = slice(stop - base - 1, end.slice - base - 1)
+        sizes = np.concatenate((np.maximum(hi[part] - lo[part] + 1, 0), [1, 0]))  # И срезы end, end+1
+        los = np.concatenate((lo[part], [end.x, end.x])).astype(np.int64)
+        width = max(int(np.max(sizes, initial=0)), 1)
+        margin = int(np.max(np.abs(np.concatenate((los[1:] - los[:-1], los[2:] - los[:-2]))), initial=0)) + 2
+        codes = self._decision_matrix(lo[part], hi[part]) if keep else None
+        # Строки срезов s, s+1 и s+2, срез номер t = s - stop лежит в строке t % 3
+        diags, horvers = np.full((3, width + 2*margin), np.inf), np.full((3, width + 2*margin), np.inf)
+        last = len(los) - 2
+        diags[last % 3, margin], horvers[last % 3, margin] = tail
+        inside = np.arange(width)
+        block = max(self.WAVEFRONT_BLOCK // width, 1)
+        code = np.empty(width, dtype=np.uint8)
+        diag, horver, vert, dash = (np.empty(width) for _ in range(4))
+        by_dash, then_switch = np.empty(width, dtype=bool), np.empty(width, dtype=bool)
+        for t in range(last - 1, -1, -1):
+            if (last - 1 - t) % block == 0:  # Стоимости ходов из клеток предыдущих block срезов
+                first = max(t - block + 1, 0)
+                xs = los[first:t + 1, np.newaxis] + inside
+                slices = (stop + np.arange(first, t + 1))[:, np.newaxis]
+                in_band = inside < sizes[first:t + 1, np.newaxis]
+                diag_costs = np.full(xs.shape, np.inf)
+                real = in_band & (xs < self._goal.x) & (slices - xs < self._goal.y)
+                diag_costs[real] = self.costs(xs[real], (slices - xs)[real])
+                horver_costs = np.where(in_band, self._horver_costs[slices], np.inf)
+            s, row, next1, next2 = stop + t, t % 3, (t + 1) % 3, (t + 2) % 3
+            metrics.progress(self._goal.slice - s, self._goal.slice)
+            at = los[t] + 1 - los[t + 2] + margin  # Клетка x+1 среза s+2
+            np.add(diags[next2, at:at + width], diag_costs[t - first], out=diag)
+            at = los[t] - los[t + 1] + margin  # Клетка x среза s+1 (ход '|'), правее неё - x+1 (ход '-')
+            np.less(horvers[next1, at + 1:at + 1 + width], horvers[next1, at:at + width], out=by_dash)
+            np.minimum(horvers[next1, at + 1:at + 1 + width], horvers[next1, at:at + width], out=horver)
+            horver += horver_costs[t - first]
+            if keep:
+                code[:] = by_dash
+                code *= self.HORVER_BY_DASH
+            np.add(horver, Config.PENALTY, out=vert)
+            np.less(vert, diag, out=then_switch)
+            np.minimum(vert, diag, out=diags[row, margin:margin + width])
+            if keep:
+                code[then_switch] |= self.DIAG_THEN_HORVER
+            np.add(diag, Config.PENALTY, out=dash)
+            np.less(dash, horver, out=then_switch)
+            np.minimum(dash, horver, out=horvers[row, margin:margin + width])
+            if keep:
+                code[then_switch] |= self.HORVER_THEN_DIAG
+                codes[t, :width] = code
+        return codes, [(los[t], diags[t % 3, margin:margin + sizes[t]].copy(),
+                        horvers[t % 3, margin:margin + sizes[t]].copy()) for t in (0, 1)]
+
+    def _trace_forward(self, start, end, horver, lo, base, stop, codes):
+        """
+        Ходы пути из start в end по матрице кодов следующего хода из _backward (её строка t - срез stop+t,
+        столбец - x - lo[stop+t-base-1]). В start путь пришёл в состоянии horver (иначе диагональном).
+        """
+        moves, x, s = [], start.x, start.slice
+        while s < end.slice:
+            code = codes[s - stop, x - lo[s - base - 1]]
+            if horver and code & self.HORVER_THEN_DIAG or not horver and not code & self.DIAG_THEN_HORVER:
+                moves.append('/')
+                x, s, horver = x + 1, s + 2, False
+            else:
+                move = '-' if code & self.HORVER_BY_DASH else '|'
+                moves.append(move)
+                x, s, horver = x + (move == '-'), s + 1, True
+        return moves
+
+    @staticmethod
+    def _tail(next_move, end_horver=None):
+        """
+        Добавки к стоимостям (диаг., гор./верт.) в конце пути: штраф за смену направления на следующем за концом
+        ходе next_move или бесконечность для состояния, в котором по end_horver приходить в конец нельзя.
+        """
+        if end_horver is not None:
+            return (np.inf, 0.) if end_horver else (0., np.inf)
+        if next_move is None:
+            return 0., 0.
+        return (0., Config.PENALTY) if next_move == '/' else (Config.PENALTY, 0.)
+
+    @staticmethod
+    def _init_state(prev_move):
+        """(стоимость диаг., стоимость гор./верт.) в начале пути, в который входят ходом prev_move (None - ниоткуда)"""
+        if prev_move is None:
+            return 0., 0.
+        return (0., np.inf) if prev_move == '/' else (np.inf, 0.)
+
+    @staticmethod
+    def _end_state(diag, horver, next_move):
+        """Приходить ли в конец в гор./верт. состоянии при стоимостях diag, horver, если дальше идёт ход next_move"""
+        if next_move is None:
+            return diag > horver
+        elif next_move == '/':
+            return horver + Config.PENALTY < diag
+        return not diag + Config.PENALTY < horver
+
+    def _trace_back(self, start, end, horver, lo, decisions):
+        """
+        Восстанавливает ходы пути из start в end по матрице кодов решений, где i-я строка соответствует срезу
+        start.slice+i+1. В end путь приходит в состоянии horver (иначе диагональном).
+        """
+        moves, x, s = [], end.x, end.slice
+        while s > start.slice:
+            i = s - start.slice - 1
+            code = decisions[i, x - lo[i]]
+            if horver:
+                move = '-' if code & self.HORVER_BY_DASH else '|'
+                horver = not code & self.HORVER_FROM_DIAG
+                x, s = x - (move == '-'), s - 1
+            else:
+                move = '/'
+                horver = bool(code & self.DIAG_FROM_HORVER)
+                x, s = x - 1, s - 2
+            moves.append(move)
+        return moves[::-1]
+
+    @staticmethod
+    def _initial_radius(draft_path):
+        """
+        Радиусы полосы по срезам draft_path: там, где грубый путь идёт прямо, точный путь почти наверняка идёт рядом,
+        так что хватает Config.MIN_RADIUS. Config.RADIUS берётся только в 4*Config.RADIUS срезах от изломов.
+        """
+        margin = 4 * Config.RADIUS
+        breaks = draft_path.breaks()
+        radius = np.full(breaks[-1] if len(breaks) else 0, max(Config.MIN_RADIUS, 1))  # При 0 полоса рвётся
+        for s in breaks[:-1]:
+            radius[max(s - margin, 0):s + margin] = Config.RADIUS
+        return radius
+
+    def _widen(self, draft_path, radius, moves):
+        """
+        Пока найденный путь где-то упирается в край полосы (а не прямоугольника), расширяет полосу вдвое (но не
+        больше чем до Config.MAX_RADIUS) на 4*Config.RADIUS срезов до и после места касания. Так же, но только
+        до Config.RADIUS, полоса расширяется вокруг изломов найденного пути, где её радиус меньше Config.RADIUS:
+        излом, которого нет у грубого пути, в узкой полосе может выйти не там, где в полосе постоянной ширины, даже
+        не касаясь её краёв. После каждого расширения путь ищется заново во всей полосе: лучший путь может отойти
+        от найденного на всех его прямых отрезках между изломами, а не только около места касания.
+        Массив radius меняется на месте. Возвращает новые ходы и число клеток, посчитанных при повторных поисках.
+        """
+        margin, cells = 4 * Config.RADIUS, 0
+        while True:
+            lo, hi = self._band(draft_path, radius)
+            steps = np.array([(0, 1) if move == '|' else (1, 1 + (move == '/')) for move in moves]).reshape(-1, 2)
+            xs, slices = np.concatenate(([[0, 0]], np.cumsum(steps, axis=0))).T
+            inner = (slices > 0) & (slices <= len(lo))
+            at, i = np.flatnonzero(inner), slices[inner] - 1
+            touch = (((xs[at] == lo[i]) & (lo[i] > np.maximum(0, slices[at] - self._goal.y))) |
+                     ((xs[at] == hi[i]) & (hi[i] < np.minimum(self._goal.x, slices[at]))))
+            touch &= radius[i] < Config.MAX_RADIUS
+            codes = np.frombuffer(''.join(moves).encode('ascii'), dtype=np.uint8)
+            bends = np.zeros(len(slices), dtype=bool)  # Изломы найденного пути
+            bends[1:-1] = codes[1:] != codes[:-1]
+            bends = bends[at] & (radius[i] < Config.RADIUS)
+            if not touch.any() and not bends.any():
+                return moves, cells
+            for s in slices[at[touch]].tolist():
+                widened = radius[max(s - margin, 1)-1:s + margin]
+                widened[:] = np.minimum(np.maximum(widened * 2, 1), Config.MAX_RADIUS)
+            for s in slices[at[bends]].tolist():
+                widened = radius[max(s - margin, 1)-1:s + margin]
+                widened[:] = np.maximum(widened, Config.RADIUS)
+            lo, hi = self._band(draft_path, radius)
+            moves = self._solve(Point(0, 0), self._init_state(self._around[0]), self._goal, self._around[1], lo, hi)
+            cells += np.sum(np.maximum(hi - lo + 1, 0))
+
     def _options(self, v):
         if v.x == self._goal.x:
             moves = '|'
@@ -261,39 +946,421 @@ class Comparator:
             moves = '|-/'
         return ((move, v - move) for move in moves)
 
-    def full_search(self):
+    def full_search(self, engine=None, focus=None):
+        """
+        Путь на самом подробном уровне в сантисекундах. focus - моменты первой записи в сантисекундах, которые
+        потом будут отображаться (начала и концы событий сабов): при заданном Config.LAZY_WINDOW самые подробные
+        уровни считаются только около них, см. _lazy_refine.
+        """
         min_len = min(self._x.base_len, self._y.base_len)
-        Spectrogram.MULT_BY = 2**int(np.log(min_len/Config.PRECISION)/np.log(2))
-        draft_path = None
+        top_mult = 2**int(np.log(min_len/Config.PRECISION)/np.log(2))
+        for spec in (self._x, self._y):
+            spec.build_pyramid(top_mult)
+        lazy = Config.LAZY_WINDOW is not None and focus is not None and len(focus) > 0
+        split_mult = self._split_mult(top_mult) if Config.SEARCH_WORKERS > 1 and not lazy else 1
+        draft_path, mult = self._anchor_draft(top_mult, split_mult) if Config.ANCHORS else (None, None)
+        if draft_path is None:
+            self._use_level(top_mult)
+            draft_path, mult = Path.parse('-{} |{}'.format(len(self._x), len(self._y))), top_mult
+        if lazy:
+            lazy_mult = max(min(Config.LAZY_MULT, mult), 1)
+            draft_path = self.refine(draft_path, mult, engine, last_mult=lazy_mult)
+            if lazy_mult > 1:
+                draft_path = self._lazy_refine(draft_path, lazy_mult, focus, engine)
+            return draft_path * Config.PRECISION
+        draft_path = self.refine(draft_path, mult, engine, last_mult=split_mult)
+        if split_mult > 1:
+            draft_path = self._parallel_refine(draft_path, split_mult, engine)
+        return draft_path * Config.PRECISION
+
+    def _anchor_draft(self, top_mult, split_mult):
+        """
+        Начальный путь через якоря landmarks.find_anchors и уровень, с которого его уточнять: на нём вектор примерно
+        в Config.RADIUS раз короче окна голосования, чтобы полоса накрыла отклонения пути между якорями.
+        Между соседними якорями путь идёт по диагонали, а разница по x и y добирается ходами '-' или '|' посередине.
+        (None, None), если якорей не нашлось.
+        """
+        xs, ys = landmarks.find_anchors(self._x.levels[1], self._y.levels[1])
+        if not len(xs):
+            print("No anchors found, searching from the coarsest level")
+            return None, None
+        window = Config.ANCHOR_WINDOW * landmarks.vectors_per_second()
+        mult = max(min(2**int(np.log2(max(window / Config.RADIUS, 1))), top_mult), split_mult)
+        goal = [len(self._x.levels[mult]), len(self._y.levels[mult])]
+        points = np.concatenate(([[0, 0]], np.minimum(np.transpose((xs, ys)) // mult, goal), [goal]))
+        moves = []
+        for dx, dy in np.diff(points, axis=0).tolist():
+            diag = min(dx, dy)
+            moves.append('/' * (diag // 2) + '-' * (dx - diag) + '|' * (dy - diag) + '/' * (diag - diag // 2))
+        return Path.from_moves(moves), mult
+
+    def refine(self, draft_path, mult, engine=None, last_mult=1):
+        """
+        Ищет путь на уровнях mult, mult/2, ..., last_mult, каждый раз в окрестности пути с предыдущего уровня;
+        draft_path - начальное приближение на уровне mult. Возвращает путь уровня last_mult.
+        """
+        search = {'dict': self._penalty_search, 'wavefront': self._wavefront_search}[engine or Config.SEARCH_ENGINE]
         while True:
-            for spec in (self._x, self._y):
-                spec.calculate_curr_spec()
-            if draft_path is None:
-                draft_path = Path.parse('-{} |{}'.format(len(self._x), len(self._y)))
-            print("Multfactor={0}".format(Spectrogram.MULT_BY))
-            draft_path = self._penalty_search(draft_path)
-            Spectrogram.MULT_BY //= 2
-            if Spectrogram.MULT_BY == 0:
+            self._use_level(mult)
+            print("Multfactor={0}".format(self._mult))
+            with metrics.span('search_level', mult=self._mult, engine=engine or Config.SEARCH_ENGINE,
+                              size=(len(self._x), len(self._y))):
+                draft_path = search(draft_path)
+            if mult == last_mult:
+                return draft_path
+            mult //= 2
+            draft_path *= 2
+
+    def _split_mult(self, top_mult):
+        """
+        Самый грубый уровень, на котором путь можно разрезать на Config.SEARCH_WORKERS кусков хотя бы по
+        Config.SEGMENT_SLICES срезов; 1, если такого нет и искать надо в одном процессе.
+        """
+        mult = top_mult
+        while mult > 1:
+            slices = sum(len(spec.levels[mult]) for spec in (self._x, self._y))
+            if slices >= Config.SEARCH_WORKERS * Config.SEGMENT_SLICES:
+                return mult
+            mult //= 2
+        return 1
+
+    def _parallel_refine(self, draft_path, split_mult, engine):
+        """
+        Уточняет путь уровня split_mult до самого подробного уровня по кускам в Config.SEARCH_WORKERS процессах.
+        Путь режется на куски, перекрывающиеся на Config.SEGMENT_OVERLAP срезов в каждую сторону от разреза;
+        каждый кусок ищется как отдельная задача между своими концами на пути. Уровни пирамиды передаются
+        процессам .npy-файлами через mmap, а средние расстояния - готовыми, чтобы они были те же, что у целого пути.
+        Соседние куски сшиваются в общей точке их путей в зоне перекрытия, ближайшей к её середине. Если их пути
+        в зоне перекрытия расходятся (см. _stitch), эти два куска сливаются в один и ищутся заново, и об этом
+        печатается: путь, сшитый из несогласных кусков, может отличаться от пути, найденного в одном процессе.
+        """
+        moves = draft_path.moves()
+        steps = np.array([(0, 1) if move == '|' else (1, 1 + (move == '/')) for move in moves]).reshape(-1, 2)
+        xs, slices = np.concatenate(([[0, 0]], np.cumsum(steps, axis=0))).T
+        cuts = [slices[-1] * i // Config.SEARCH_WORKERS for i in range(1, Config.SEARCH_WORKERS)]
+        segments = []  # Номера первой и последней вершин куска на draft_path
+        for i in range(Config.SEARCH_WORKERS):
+            begin = 0 if i == 0 else cuts[i-1] - Config.SEGMENT_OVERLAP
+            end = slices[-1] if i == len(cuts) else cuts[i] + Config.SEGMENT_OVERLAP
+            segments.append((max(np.searchsorted(slices, begin, side='right') - 1, 0),
+                             min(np.searchsorted(slices, end), len(slices) - 1)))
+        av_costs, tmp_dir, files = {}, mkdtemp(dir=Config.SPEC_MEMMAP_DIR), {}
+        mult = split_mult // 2
+        while mult >= 1:
+            self._use_level(mult)
+            av_costs[mult] = self._average_cost()
+            files[mult] = []
+            for name, spec in (('x', self._x), ('y', self._y)):
+                files[mult].append(path.join(tmp_dir, '{0}_{1}.npy'.format(name, mult)))
+                np.save(files[mult][-1], spec.levels[mult])
+            mult //= 2
+        try:
+            with ProcessPoolExecutor(Config.SEARCH_WORKERS) as pool:
+                results = {}
+                while True:
+                    tasks = [(first, last) for first, last in segments if (first, last) not in results]
+                    futures = [pool.submit(refine_segment, files, (xs[first], slices[first] - xs[first],
+                                                                   xs[last], slices[last] - xs[last]),
+                                           moves[first:last], (moves[first-1] if first else None,
+                                                               moves[last] if last < len(moves) else None),
+                                           split_mult, av_costs, engine, metrics.active())
+                               for first, last in tasks]
+                    for task, future in zip(tasks, futures):
+                        results[task], spans = future.result()
+                        metrics.attach(spans)
+                    failed, stitched = self._stitch(segments, results, xs, slices, split_mult)
+                    if failed is None:
+                        break
+                    print("Segments {0} and {1} disagree on their overlap, merging them".format(failed, failed + 1))
+                    metrics.count('merged_segments')
+                    segments[failed:failed + 2] = [(segments[failed][0], segments[failed + 1][1])]
+        finally:
+            rmtree(tmp_dir, ignore_errors=True)
+        ans = Path.from_moves(stitched)
+        print("Parallel search: {0} segments from level {1}".format(len(segments), split_mult))
+        return ans
+
+    @staticmethod
+    def _stitch(segments, results, xs, slices, split_mult):
+        """
+        Сшивает пути кусков (строки ходов самого подробного уровня в results) в один. Сшивать можно только
+        на общем ребре: если пути лишь пересекаются в точке, в ней у них разные состояния, и сшитый путь заплатил бы
+        лишний штраф, которого нет ни в одном из них (так бывает, когда кусок уводят в сторону концы на грубом пути).
+        Концы кусков - точки грубого пути, и у них путь куска может сворачивать к этой точке. Поэтому, кроме таких
+        хвостов (см. _trim_ends), пути соседних кусков должны совпадать во всей зоне перекрытия: если там один
+        из них делает скачок, которого нет у другого, хотя бы один из них уведён своим концом, и сшивать их нельзя.
+        Возвращает (None, ходы) или (номер куска, None), если путь куска не согласуется с путём следующего.
+        """
+        reach = Config.RADIUS * split_mult // 2
+        points, trimmed = [], []  # Абсолютные координаты вершин пути каждого куска и он же без хвостов у концов
+        for i, (first, last) in enumerate(segments):
+            start = Point(int(xs[first]) * split_mult, int(slices[first] - xs[first]) * split_mult)
+            points.append(Comparator._move_points(results[first, last], start))
+            begin, _, moves = Comparator._trim_ends(results[first, last], start, i > 0, i < len(segments) - 1, reach)
+            trimmed.append(Comparator._move_points(moves, begin))
+        anchors = [0]  # Номер вершины пути куска, с которой он берётся в итоговый путь
+        stitched = []
+        for i in range(len(segments) - 1):
+            (x1, s1), (x2, s2) = trimmed[i], trimmed[i + 1]
+            common = (max(s1[0], s2[0]), min(s1[-1], s2[-1]))
+            inside1, inside2 = (s1 >= common[0]) & (s1 <= common[1]), (s2 >= common[0]) & (s2 <= common[1])
+            if not (np.array_equal(x1[inside1], x2[inside2]) and np.array_equal(s1[inside1], s2[inside2])):
+                return i, None
+            (x1, s1), (x2, s2) = points[i], points[i + 1]
+            width = max(x1[-1], x2[-1]) + 1  # Вершина (x, s) кодируется числом s*width + x
+            _, at1, at2 = np.intersect1d(s1 * width + x1, s2 * width + x2, return_indices=True)
+            moves1, moves2 = results[segments[i]], results[segments[i + 1]]
+            after = at1 > anchors[-1]
+            after[after] = [j < len(moves1) and k < len(moves2) and moves1[j] == moves2[k]
+                            for j, k in zip(at1[after].tolist(), at2[after].tolist())]
+            at1, at2 = at1[after], at2[after]
+            if not len(at1):
+                return i, None
+            best = np.argmin(np.abs(s1[at1] - (s2[0] + s1[-1]) / 2))  # Ближайшая к середине зоны перекрытия
+            stitched.extend(moves1[anchors[-1]:at1[best]])
+            anchors.append(at2[best])
+        stitched.extend(results[segments[-1]][anchors[-1]:])
+        return None, stitched
+
+    def _lazy_refine(self, draft_path, lazy_mult, focus, engine):
+        """
+        Уточняет путь уровня lazy_mult до самого подробного, считая уровни подробнее lazy_mult только в окнах:
+        Config.LAZY_WINDOW секунд в каждую сторону от моментов focus (в сантисекундах первой записи), Config.RADIUS
+        ходов draft_path в каждую сторону от каждого его недиагонального хода и у обоих углов решётки; пересекающиеся
+        окна сливаются. Окно - кусок draft_path между его точками на краях, оно уточняется до уровня 2 отдельно, как
+        кусок в _parallel_refine. У краёв окна путь может сворачивать к этим точкам, такие хвосты (см. _trim_ends)
+        отрезаются, и между окнами путь уровня 2 идёт по диагонали, а если концы соседних окон лежат на разных
+        диагоналях - со скачком посередине.
+        Самый подробный уровень ищется по всему пути в полосе вокруг этого пути, как при полном поиске, но между
+        окнами гор./верт. ходы запрещены, и _wavefront считает эти срезы целыми блоками. Участок между окнами, на
+        который выгоднее перенести скачок этого пути или найденного (см. _jump_places), открывается, и уровень
+        ищется заново. Так диагонали и места скачков выбираются по стоимости всего пути, с теми же ничьими, что и
+        при полном поиске, а путь кончается ровно в углу решётки.
+        """
+        moves = draft_path.moves()
+        steps = np.array([(0, 1) if move == '|' else (1, 1 + (move == '/')) for move in moves]).reshape(-1, 2)
+        xs, slices = np.concatenate(([[0, 0]], np.cumsum(steps, axis=0))).T
+        vector_ss = Config.BASE_TICK * Config.PRECISION * lazy_mult
+        centers, margin = np.sort(np.asarray(focus, dtype=float)) / vector_ss, Config.LAZY_WINDOW * 100 / vector_ss
+        jumps = np.flatnonzero(np.frombuffer(moves.encode('ascii'), dtype=np.uint8) != ord('/'))
+        firsts = np.concatenate((np.searchsorted(xs, centers - margin, side='right') - 1, jumps - Config.RADIUS,
+                                 [0, len(moves) - Config.RADIUS]))
+        lasts = np.concatenate((np.searchsorted(xs, centers + margin), jumps + 1 + Config.RADIUS,
+                                [Config.RADIUS, len(moves)]))
+        windows = []  # Номера первой и последней точек окна на draft_path
+        for first, last in sorted(zip(np.clip(firsts, 0, len(moves)).tolist(), np.clip(lasts, 0, len(moves)).tolist())):
+            if windows and first <= windows[-1][1]:
+                windows[-1][1] = max(windows[-1][1], last)
+            elif first < last:
+                windows.append([first, last])
+        draft = draft_path
+        if lazy_mult > 2:
+            av_costs, mult = {}, lazy_mult // 2
+            while mult >= 2:
+                self._use_level(mult)
+                av_costs[mult] = self._average_cost()
+                mult //= 2
+            levels = tuple({mult: spec.levels[mult] for mult in av_costs} for spec in (self._x, self._y))
+            goal, scale = Point(len(self._x), len(self._y)), lazy_mult // 2
+            reach = Config.RADIUS * scale // 2  # Сколько ходов у края окна путь может сворачивать к точке draft_path
+            parts, done = [], Point(0, 0)
+            for first, last in windows:
+                bounds = (xs[first], slices[first] - xs[first], xs[last], slices[last] - xs[last])
+                around = (moves[first-1] if first else None, moves[last] if last < len(moves) else None)
+                with metrics.span('lazy_window', bounds=[int(i) for i in bounds]):
+                    found = refine_piece(levels, bounds, moves[first:last], around, lazy_mult, av_costs, engine,
+                                         last_mult=2)
+                # Точка draft_path на уровне 2, прижатая к краю решётки, как в refine_piece
+                corner = Point(min(int(xs[first]) * scale, goal.x), min(int(slices[first] - xs[first]) * scale, goal.y))
+                start, end, found = self._trim_ends(found, corner, first > 0, last < len(moves), reach)
+                dx, dy = start.x - done.x, start.y - done.y
+                diag = min(dx, dy)
+                parts.append('/' * (diag // 2) + '-' * (dx - diag) + '|' * (dy - diag) + '/' * (diag - diag // 2))
+                parts.append(found)
+                done = end
+            draft = Path.from_moves(parts)
+        self._use_level(1)
+        print("Multfactor={0}".format(self._mult))
+        draft *= 2
+        forbidden = np.ones(len(self._x) + len(self._y), dtype=bool)  # Срезы 1..len(x)+len(y) между окнами
+        for first, last in windows:
+            forbidden[max(slices[first] * lazy_mult - 1, 0):slices[last] * lazy_mult] = False
+        # Скачок, который выгоднее поставить на запрещённом участке, полный поиск поставил бы там: такие участки
+        # открываются - сначала по скачкам draft, потом по найденному пути, и уровень ищется заново
+        searches, found = 0, draft
+        while True:
+            runs = np.cumsum(np.diff(forbidden.astype(np.int8), prepend=0) == 1) * forbidden  # Номера участков
+            touched = np.setdiff1d(runs[self._jump_places(found.moves(), forbidden) - 1], [0])
+            if searches and not len(touched):
                 break
-            else:
-                draft_path *= 2
-        return draft_path * Config.PRECISION
+            forbidden &= ~np.isin(runs, touched)
+            with metrics.span('search_level', mult=1, engine='wavefront', size=(len(self._x), len(self._y))):
+                found = self._wavefront_search(draft, forbidden)
+            searches += 1
+        share = sum(slices[last] - slices[first] for first, last in windows) / max(slices[-1], 1)
+        metrics.record('lazy_windows', len(windows))
+        metrics.record('lazy_share', float(share))
+        metrics.record('lazy_free_share', float(1 - np.mean(forbidden)))
+        metrics.record('lazy_searches', searches)
+        print("Lazy refinement: {0} windows cover {1:.0%} of the path from level {2}, horizontal and vertical "
+              "moves allowed on {3:.0%}, {4} searches on level 1"
+              .format(len(windows), share, lazy_mult, 1 - np.mean(forbidden), searches))
+        return found
+
+    def _jump_places(self, moves, forbidden):
+        """
+        Срезы, куда выгоднее всего перенести группы подряд идущих гор./верт. ходов пути moves текущего уровня:
+        группа сдвигается по отрезку между соседними группами, до неё путь идёт по диагонали, на которой начинается
+        группа, а после - по той, на которой она кончается. Смотрятся только группы, у которых на этом отрезке есть
+        срезы forbidden (маска срезов 1..len(x)+len(y), см. _wavefront_search). Возвращает срезы лучших положений
+        таких групп вместе с двумя срезами по краям. Растянутый грубый путь может выходить за решётку, эта его
+        часть не смотрится.
+        """
+        codes = np.frombuffer(moves.encode('ascii'), dtype=np.uint8)
+        xs = np.concatenate(([0], np.cumsum(codes != ord('|'))))
+        ys = np.concatenate(([0], np.cumsum(codes != ord('-'))))
+        outside = np.flatnonzero((xs > len(self._x)) | (ys > len(self._y)))
+        if len(outside):
+            codes, xs, ys = codes[:outside[0] - 1], xs[:outside[0]], ys[:outside[0]]
+        jump = codes != ord('/')
+        firsts = np.flatnonzero(jump & ~np.concatenate(([False], jump[:-1])))  # Первые ходы групп
+        lasts = np.flatnonzero(jump & ~np.concatenate((jump[1:], [False]))) + 1  # Точки после последних ходов
+        blocked = np.concatenate(([0], np.cumsum(forbidden)))
+        places = [np.zeros(0, dtype=np.int64)]
+        for i, (first, last) in enumerate(zip(firsts.tolist(), lasts.tolist())):
+            begin = lasts[i - 1] if i else 0  # Отрезок между соседними группами, в точках пути
+            end = firsts[i + 1] if i + 1 < len(firsts) else len(codes)
+            if blocked[xs[end] + ys[end]] == blocked[xs[begin] + ys[begin]]:
+                continue
+            dash, before, after = xs[last] - xs[first], xs[first] - ys[first], xs[last] - ys[last]
+            # Группа после k диагональных ходов из точки begin: до неё клетки диагонали before с x до xs[begin]+k,
+            # после - клетки диагонали after с x от xs[begin]+k+dash+1
+            cells = np.arange(xs[begin] + 1, xs[end] - dash + 1)
+            on_before = np.concatenate(([0], np.cumsum(self.costs(cells - 1, cells - before - 1))))
+            on_after = np.concatenate(([0], np.cumsum(self.costs(cells + dash - 1, cells + dash - after - 1))))
+            totals = on_before + on_after[-1] - on_after
+            shifts = np.flatnonzero(totals <= totals.min())
+            starts = xs[begin] + ys[begin] + 2 * shifts  # Срезы точек, где начинается группа
+            places.append((starts[:, np.newaxis] + np.arange(-1, last - first + 3)).ravel())
+        return np.clip(np.concatenate(places), 1, len(forbidden))
 
     @staticmethod
-    def add_penalty(pair):
-        return pair[0] + Config.PENALTY, pair[1]
+    def _move_points(moves, start):
+        """Массивы x и срезов точек, через которые проходят ходы moves из start, вместе с самой start"""
+        steps = np.array([(0, 1) if move == '|' else (1, 1 + (move == '/')) for move in moves]).reshape(-1, 2)
+        seg_xs, seg_slices = np.concatenate(([[0, 0]], np.cumsum(steps, axis=0))).T
+        return seg_xs + start.x, seg_slices + start.slice
 
-    def image(self, filename):
+    @staticmethod
+    def _trim_ends(moves, start, head, tail, reach):
+        """
+        Отрезает от ходов moves куска пути из start, концы которого прижаты к точкам грубого пути (окна _lazy_refine,
+        куски _parallel_refine), недиагональные хвосты: в первых reach ходах, если head, и в последних reach,
+        если tail. Возвращает (начало, конец, ходы) того, что осталось.
+        """
+        begin, end = 0, len(moves)
+        if head:
+            begin = max((i + 1 for i, move in enumerate(moves[:reach]) if move != '/'), default=0)
+        if tail:
+            edge = max(end - reach, begin)
+            end = min((edge + i for i, move in enumerate(moves[edge:]) if move != '/'), default=end)
+
+        def shifted(point, part):  # Куда приходят ходы part из point
+            return Point(point.x + len(part) - part.count('|'), point.y + len(part) - part.count('-'))
+        first = shifted(start, moves[:begin])
+        return first, shifted(first, moves[begin:end]), moves[begin:end]
+
+    def cost_block(self, xs, ys):
+        """Матрица cos_log(x[i], y[j]) для i из xs, j из ys (срезов или массивов индексов текущего уровня)"""
+        unit_x, unit_y = self._x.unit[xs], self._y.unit[ys]
+        metrics.count('cost_evaluations', len(unit_x) * len(unit_y))
+        sim = np.clip(1 - unit_x @ unit_y.T, 0, 2)
+        return sim * (self._x.log_norm[xs][:, np.newaxis] + self._y.log_norm[ys][np.newaxis, :])
+
+    def _to_pixels(self, costs):
+        # Близкие векторы тёмные, всё от двух средних расстояний и дальше - белое
+        return (np.minimum(costs / (2*self._av_cost), 1) * 255).astype(np.uint8)
+
+    def image(self, filename=None, mode='overview', final_path=None, radius=None, tile=None):
+        """
+        Картинка расстояний между векторами в uint8, считается блоками tile x tile (Config.IMAGE_TILE) сразу
+        в выходной массив, который сохраняется в filename и в Config.VISUAL. Режимы:
+        'full' - вся матрица текущего уровня (строки - векторы первой спектрограммы, столбцы - второй);
+        'overview' - вся матрица на самом подробном уровне пирамиды, где обе стороны не больше Config.IMAGE_SIZE;
+        'band' - только полоса радиуса radius (по умолчанию Config.RADIUS) вокруг final_path, найденного full_search,
+        на самом подробном уровне: строка s - срез x+y=s, столбец - сдвиг x от левого края полосы на этом срезе.
+        """
+        tile = tile or Config.IMAGE_TILE
+        if mode == 'overview':
+            mult = 1
+            while max(self._x.base_len, self._y.base_len) / (Config.PRECISION * mult) > Config.IMAGE_SIZE:
+                mult *= 2
+            self._use_level(mult)
+        elif mode == 'band':
+            self._use_level(1)
         self._av_cost = self._average_cost()
-        visual = np.zeros((len(self._x), len(self._y)))
-        for i in range(len(self._x)):
-            for j in range(len(self._y)):
-                visual[i][j] = int(min(self._cost(Point(i, j), '/')/(2*self._av_cost), 1)*255)
-            print("{0}/{1}".format(i, len(self._x)))
-        print("Visual constructed!")
-        result = Image.fromarray(visual.astype(np.uint8))
+        if mode == 'band':
+            visual = self._band_image(final_path // Config.PRECISION, radius or Config.RADIUS, tile)
+        else:
+            visual = np.empty((len(self._x), len(self._y)), dtype=np.uint8)
+            for row in range(0, len(self._x), tile):
+                metrics.progress(row, len(self._x))
+                for column in range(0, len(self._y), tile):
+                    block = self.cost_block(slice(row, row + tile), slice(column, column + tile))
+                    visual[row:row + tile, column:column + tile] = self._to_pixels(block)
+        print("Visual constructed: {0}x{1}".format(*visual.shape))
         Config.VISUAL = visual
-        try:
-            result.save(filename)
-        except IOError:
-            print("Cannot save image")
+        if filename is not None:
+            try:
+                Image.fromarray(visual).save(filename)
+            except (IOError, NameError):  # NameError - если нет pillow
+                print("Cannot save image")
+        return visual
+
+    def _use_level(self, mult):
+        for spec in (self._x, self._y):
+            spec.use_level(mult)
+        self._mult = mult
+
+    def _band_image(self, band_path, radius, tile):
+        """Полоса вокруг band_path (в векторах текущего уровня) по tile срезов за раз; вне решётки - белое"""
+        lo, _ = band_path.slice_bounds(radius)
+        width = 2 * radius + 1
+        visual = np.full((len(lo), width), 255, dtype=np.uint8)
+        for begin in range(0, len(lo), tile):
+            metrics.progress(begin, len(lo))
+            end = min(begin + tile, len(lo))
+            xs = lo[begin:end, np.newaxis] + np.arange(width)
+            ys = np.arange(begin + 1, end + 1)[:, np.newaxis] - xs
+            inside = (xs >= 0) & (xs < len(self._x)) & (ys >= 0) & (ys < len(self._y))
+            visual[begin:end][inside] = self._to_pixels(self.costs(xs[inside], ys[inside]))
+        return visual
+
+
+def refine_piece(levels, bounds, draft, around, split_mult, av_costs, engine=None, last_mult=1):
+    """
+    Уточняет кусок пути с уровня split_mult до уровня last_mult (см. Comparator._parallel_refine и _lazy_refine).
+    levels - ({уровень: спектрограмма первой записи}, {уровень: второй}) целиком для всех уровней меньше split_mult,
+    bounds = (x0, y0, x1, y1) - концы куска на уровне split_mult, draft - его ходы там же, around - ходы пути перед
+    куском и после него (см. Comparator). Возвращает строку ходов.
+    """
+    pieces = ({}, {})
+    for i, spec_levels in enumerate(levels):
+        for mult, spec in spec_levels.items():
+            scale = split_mult // mult
+            pieces[i][mult] = spec[bounds[i] * scale:min(bounds[i + 2] * scale, len(spec))]
+    cmp = Comparator(*(Spectrogram('segment', cached=(None, None, piece)) for piece in pieces), av_costs, around)
+    return cmp.refine(Path.from_moves(draft) * 2, split_mult // 2, engine, last_mult).moves()
+
+
+def refine_segment(files, bounds, draft, around, split_mult, av_costs, engine=None, collect=False):
+    """
+    Выполняется в отдельном процессе (см. Comparator._parallel_refine): refine_piece по уровням из files -
+    {уровень: (.npy первой спектрограммы, .npy второй)}. Возвращает строку ходов и замеры (или None).
+    """
+    if collect:
+        metrics.start(force=True)
+    levels = tuple({mult: np.load(names[i], mmap_mode='r') for mult, names in files.items()} for i in range(2))
+    with metrics.span('segment', bounds=[int(i) for i in bounds]):
+        ans = refine_piece(levels, bounds, draft, around, split_mult, av_costs, engine)
+    return ans, metrics.finish()['spans'] if collect else None
@@ -0,0 +1,123 @@
+"""Проверки Spectrogram и Comparator на синтетических дорожках из benchmark.py"""
+import numpy as np
+import pytest
+
+import benchmark
+import memory
+from config import Config
+from main import shift_subs
+from spectrum import Spectrogram, Comparator
+from util import Subs
+
+
+@pytest.fixture
+def signal():
+    return benchmark.synthetic_pair(60)[0]
+
+
+@pytest.mark.parametrize('storage', memory.STORAGES)
+def test_stored_dtypes_follow_plan(monkeypatch, signal, storage):
+    """Бюджет ровно на нужное хранение: типы базовой спектрограммы и уровней те, что в плане, и пик не больше оценки"""
+    spec = Spectrogram('synthetic', (Config.DEFAULT_HZ, signal))
+    ticks, width = spec.base_spec.shape
+    peak = memory.projected_peak(ticks, width, signal.nbytes, *storage)
+    monkeypatch.setattr(Config, 'MEMORY_BUDGET', 2 * peak)
+    spec = Spectrogram('synthetic', (Config.DEFAULT_HZ, signal))
+    spec.build_pyramid(64)
+    assert spec.base_spec.dtype == storage[0]
+    stored = spec.base_spec.nbytes
+    for mult in spec.levels:
+        spec.use_level(mult)
+        assert spec.levels[mult].dtype == storage[0]
+        assert spec.unit.dtype == (storage[1] if mult >= Config.FLOAT16_MULT else storage[0])
+        stored += spec.levels[mult].nbytes + spec.unit.nbytes + spec.log_norm.nbytes
+    assert signal.nbytes + stored <= peak
+
+
+def test_over_budget(monkeypatch, signal):
+    monkeypatch.setattr(Config, 'MEMORY_BUDGET', 1)
+    monkeypatch.setattr(Config, 'OVER_BUDGET', 'refuse')
+    with pytest.raises(MemoryError):
+        Spectrogram('synthetic', (Config.DEFAULT_HZ, signal))
+    monkeypatch.setattr(Config, 'OVER_BUDGET', 'disk')
+    spec = Spectrogram('synthetic', (Config.DEFAULT_HZ, signal))
+    spec.build_pyramid(8)
+    assert isinstance(spec.base_spec, np.memmap) and isinstance(spec.levels[8], np.memmap)
+
+
+@pytest.mark.parametrize('seconds, cut', [(90, (0.3, 0.4)), (120, (0.5, 0.55)), (90, (0.7, 0.72))])
+@pytest.mark.parametrize('inserted', [False, True])
+def test_lazy_search_matches_full(monkeypatch, seconds, cut, inserted):
+    """shift_subs по пути с Config.LAZY_WINDOW даёт те же тайминги, что и по полному поиску, и у событий около склеек"""
+    pair = benchmark.synthetic_pair(seconds, cut=cut)
+    if inserted:  # Кусок, вырезанный из второй дорожки, - это кусок, вставленный во вторую вместо первой
+        pair = pair[::-1]
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, signal)) for signal in pair]
+    shifted = []
+    for window in (None, 3):
+        monkeypatch.setattr(Config, 'LAZY_WINDOW', window)
+        subs = Subs()
+        subs.parse('Sub_MLPFiM_S06E24_English.ass')
+        subs.events = [event for event in subs.events if event.timing.end_ss < seconds * 100]
+        focus = [stamp for event in subs for stamp in (event.timing.begin_ss, event.timing.end_ss)]
+        shift_subs(subs, Comparator(*spectrums).full_search(focus=focus).time_map())
+        shifted.append([(event.timing.begin_str, event.timing.end_str) for event in subs])
+    assert shifted[0] == shifted[1]
+
+
+@pytest.mark.parametrize('name', ['offset', 'mixed', 'remove'])
+def test_lazy_search_matches_full_on_scenarios(monkeypatch, name):
+    """То же на сценариях benchmark.py с редкими событиями, когда окна покрывают малую часть пути"""
+    source, target, subs, _ = benchmark.scenario(name, 600)
+    begins, ends = ([getattr(event.timing, key) for event in subs.events[::5]] for key in ('begin_ss', 'end_ss'))
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, benchmark.to_int16(i))) for i in (source, target)]
+    shifted = []
+    for window in (None, 3):
+        monkeypatch.setattr(Config, 'LAZY_WINDOW', window)
+        time_map = Comparator(*spectrums).full_search(focus=begins + ends).time_map()
+        shifted.append((time_map.last(begins).tolist(), time_map.first(ends).tolist()))
+    assert shifted[0] == shifted[1]
+
+
+@pytest.mark.parametrize('name', ['insert', 'mixed', 'remove'])
+def test_online_error_close_to_offline(name):
+    offline, online = benchmark.compare_online(120, [name])[name]
+    assert online <= offline + 10
+
+
+@pytest.mark.parametrize('memory_limit', [1, 13, 26, 50])
+@pytest.mark.parametrize('adaptive', [False, True])
+def test_split_search_with_tiny_traceback_memory(monkeypatch, memory_limit, adaptive):
+    """Деление полосы при Config.TRACEBACK_MEMORY меньше двух её строк доходит до конца и даёт тот же путь"""
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, signal)) for signal in benchmark.synthetic_pair(60)]
+    monkeypatch.setattr(Config, 'RADIUS', 6)
+    monkeypatch.setattr(Config, 'ADAPTIVE_RADIUS', adaptive)
+    paths = []
+    for limit in (None, memory_limit):
+        monkeypatch.setattr(Config, 'TRACEBACK_MEMORY', limit)
+        paths.append(repr(Comparator(*spectrums).full_search()))
+    assert paths[0] == paths[1]
+
+
+@pytest.mark.parametrize('name', ['recap', 'mixed', 'speed', 'offset'])
+def test_adaptive_radius_matches_fixed(monkeypatch, name):
+    """Полоса Config.ADAPTIVE_RADIUS даёт тот же путь, что и полоса постоянного радиуса Config.RADIUS"""
+    source, target, _, _ = benchmark.scenario(name, 120)
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, benchmark.to_int16(i))) for i in (source, target)]
+    paths = []
+    for adaptive in (False, True):
+        monkeypatch.setattr(Config, 'ADAPTIVE_RADIUS', adaptive)
+        paths.append(repr(Comparator(*spectrums).full_search()))
+    assert paths[0] == paths[1]
+
+
+@pytest.mark.parametrize('name, seconds', [('mixed', 300), ('remove', 120), ('speed', 120), ('recap', 120)])
+def test_parallel_search_matches_single(monkeypatch, name, seconds):
+    """Путь, сшитый из кусков Config.SEARCH_WORKERS процессов, тот же, что у поиска в одном процессе"""
+    source, target, _, _ = benchmark.scenario(name, seconds)
+    spectrums = [Spectrogram('synthetic', (Config.DEFAULT_HZ, benchmark.to_int16(i))) for i in (source, target)]
+    paths = []
+    for workers in (1, 4):
+        monkeypatch.setattr(Config, 'SEARCH_WORKERS', workers)
+        paths.append(repr(Comparator(*spectrums).full_search()))
+    assert paths[0] == paths[1]
@@ -15,11 +15,17 @@ def pairwise(iterable):
 class Timing:
     """Тайминг события: begin_str - момент появления на экране, end_str - момент исчезновения с экрана, (строки)
     begin_ss, end_ss - то же самое в сантисекундах,
-    length - целое число, длительность в сантисекундах"""
+    length - целое число, длительность в сантисекундах
+    Строки после сдвига не форматируются сразу: str_update только сбрасывает их, а пересчитываются они
+    при первом обращении, то есть обычно уже при записи файла."""
     def __init__(self, begin_str, end_str):
-        self.begin_str, self.end_str = begin_str, end_str  # 10-символьные строки типа 0:00:00.00
+        self._strings = begin_str, end_str  # 10-символьные строки типа 0:00:00.00
         self.begin_ss, self.end_ss = map(self.to_ss, (begin_str, end_str))  # В сотых секунды
 
+    @classmethod
+    def from_ss(cls, begin_ss, end_ss):
+        return cls(cls.to_string(begin_ss), cls.to_string(end_ss))
+
     def __hash__(self):
         return hash((self.begin_ss, self.end_ss))
 
@@ -48,6 +54,14 @@ class Timing:
     def __repr__(self):
         return self.begin_str + ',' + self.end_str
 
+    @property
+    def begin_str(self):
+        return self._format()[0]
+
+    @property
+    def end_str(self):
+        return self._format()[1]
+
     @property
     def pad_view(self):
         tmp, ss = divmod(self.begin_ss, 100)
@@ -65,24 +79,28 @@ class Timing:
         tmp, ss = divmod(ss, 100)
         tmp, s = divmod(tmp, 60)
         h, m = divmod(tmp, 60)
-        return "{h}:{m:0>2}:{s:0>2}.{ss:0>2}".format(h=h, m=m, s=s, ss=ss)
+        return "%d:%02d:%02d.%02d" % (h, m, s, ss)
+
+    def _format(self):
+        if self._strings is None:
+            self._strings = self.to_string(self.begin_ss), self.to_string(self.end_ss)
+        return self._strings
 
     def str_update(self):
-        self.begin_str, self.end_str = map(self.to_string, (self.begin_ss, self.end_ss))
+        self._strings = None
 
 
 class Event:
-    TEMPLATE = "Dialogue: {df.layer},{self.timing},{self.style},{actor}," + \
-        "{df.margin_l},{df.margin_r},{df.margin_v},{df.effect},{self.text}"
     DEFAULT_EVENT = []
     (layer, margin_l, margin_r, margin_v), effect = '0'*4, ''
+    DEFAULTS = (layer, margin_l, margin_r, margin_v, effect)
 
     def __init__(self, event_string):
         """Типичный event_string: '0,0:00:08.62,0:00:09.14,Default,,0,0,0,,This is a sentence, perhaps, with commas'"""
         self.layer, begin, end, self.style, self.actor, self.margin_l, \
             self.margin_r, self.margin_v, self.effect, self.text = event_string.split(',', 9)
         self.timing = Timing(begin, end)
-        if str(self) != repr(self):
+        if (self.layer, self.margin_l, self.margin_r, self.margin_v, self.effect) != self.DEFAULTS:
             print("Warning: non-default parameters in event '{}'".format(self.timing))
 
     def __eq__(self, other):
@@ -99,25 +117,32 @@ class Event:
     def __lt__(self, other):
         return self.timing < other.timing
 
+    def _line(self, fields, actor):
+        """Строка 'Dialogue: ...' с полями layer, margin_l, margin_r, margin_v, effect из fields"""
+        layer, margin_l, margin_r, margin_v, effect = fields
+        return 'Dialogue: ' + ','.join((layer, repr(self.timing), self.style, actor,
+                                        margin_l, margin_r, margin_v, effect, self.text))
+
     @property
     def actorless_str(self):
-        return self.TEMPLATE.format(self=self, df=Event, actor='')
+        return self._line(self.DEFAULTS, '')
 
     def __str__(self):
-        return self.TEMPLATE.format(self=self, df=Event, actor=self.actor)
+        return self._line(self.DEFAULTS, self.actor)
 
     def __repr__(self):
-        return self.TEMPLATE.format(self=self, df=self, actor=self.actor)
+        return self._line((self.layer, self.margin_l, self.margin_r, self.margin_v, self.effect), self.actor)
 
 
 class Style:
     TEMPLATE = "Style: {self.name},{df.fontname},{df.fontsize},{self.color},{df.tail}"
     fontname, fontsize, tail = "Arial", 68, "0,0,0,0,100,100,0,0,1,2.25,2.25,2,30,30,45,1"
+    DEFAULTS = (fontname, str(fontsize), tail)
 
     def __init__(self, style_string):
         self.name, self.fontname, self.fontsize, col1, col2, col3, col4, self.tail = style_string.split(',', 7)
         self.color = ','.join((col1, col2, col3, col4))
-        if str(self) != repr(self):
+        if (self.fontname, self.fontsize, self.tail) != self.DEFAULTS:
             print("Warning: non-default parameters in style '{}'".format(self.name))
 
     def __eq__(self, other):
@@ -133,6 +158,59 @@ class Style:
         return self.TEMPLATE.format(self=self, df=self)
 
 
+class SrtEvent:
+    """Событие .srt: тайминг в сантисекундах, как у Event, а миллисекунды, отброшенные при переводе в них,
+    хранятся отдельно и возвращаются при записи, так что несдвинутые события пишутся без изменений"""
+    TIME = re.compile(r'(\d+):(\d\d):(\d\d)[,.](\d{3})\s*-->\s*(\d+):(\d\d):(\d\d)[,.](\d{3})')
+
+    def __init__(self, timing, text, extra_ms=(0, 0)):
+        """timing - Timing, text - строки текста через '\n', extra_ms - миллисекунды сверх сантисекунд начала и конца"""
+        self.timing, self.text, self.extra_ms = timing, text, extra_ms
+
+    @classmethod
+    def from_match(cls, match, text):
+        """Событие по совпадению с TIME в строке вида '00:00:08,620 --> 00:00:09,140'"""
+        h1, m1, s1, ms1, h2, m2, s2, ms2 = map(int, match.groups())
+        (begin, extra_begin), (end, extra_end) = (divmod(((h*60 + m)*60 + s)*1000 + ms, 10)
+                                                  for h, m, s, ms in ((h1, m1, s1, ms1), (h2, m2, s2, ms2)))
+        return cls(Timing.from_ss(begin, end), text, (extra_begin, extra_end))
+
+    @classmethod
+    def from_event(cls, event):
+        """Событие .ass без тегов оформления в фигурных скобках, \\N и \\n становятся переводами строк"""
+        text = re.sub(r'{[^}]*}', '', event.text).replace('\\N', '\n').replace('\\n', '\n')
+        return cls(Timing.from_ss(event.timing.begin_ss, event.timing.end_ss), text)
+
+    def to_event(self, style='Default'):
+        return Event('0,{0},{1},,0,0,0,,{2}'.format(self.timing, style, self.text.replace('\n', '\\N')))
+
+    def __iadd__(self, ss):
+        self.timing += ss
+        return self
+
+    def __imul__(self, koef):
+        self.timing *= koef
+        return self
+
+    def __lt__(self, other):
+        return self.timing < other.timing
+
+    def __repr__(self):
+        return '{0} {1}'.format(self.timing, self.text.replace('\n', ' / '))
+
+    @staticmethod
+    def to_string(ss, extra_ms):
+        tmp, ms = divmod(ss*10 + extra_ms, 1000)
+        tmp, s = divmod(tmp, 60)
+        h, m = divmod(tmp, 60)
+        return "%02d:%02d:%02d,%03d" % (h, m, s, ms)
+
+    def block(self, number):
+        """Запись события в файле без завершающей пустой строки"""
+        return '{0}\n{1} --> {2}\n{3}'.format(number, self.to_string(self.timing.begin_ss, self.extra_ms[0]),
+                                              self.to_string(self.timing.end_ss, self.extra_ms[1]), self.text)
+
+
 def file_to_text(filename, encoding='utf-8'):
     f = open(filename, "rb")
     text = f.read().decode(encoding).replace('\r', '')
@@ -140,6 +218,37 @@ def file_to_text(filename, encoding='utf-8'):
     return text
 
 
+def file_lines(filename, encoding='utf-8'):
+    """Строки файла по одной, без переводов строк и без '\r' (как в file_to_text)"""
+    with open(filename, encoding=encoding, newline='\n') as f:
+        for line in f:
+            yield line.rstrip('\n').replace('\r', '')
+
+
+# Замены в тексте по опциям Subs.output, в порядке применения
+REPLACEMENTS = (('unify', (('...', '…'), (' - ', ' — '))),
+                ('rusify', (('…?', '?..'), ('…!', '!..'))),
+                ('englify', (('?..', '…?'), ('!..', '…!'))))
+SPACES = re.compile(r' +')
+FORMAT_LINE = re.compile(r'Format: [a-zA-Z, ]*')
+
+
+def replacements(options):
+    """Пары (что, на что) заменять при данных опциях вывода"""
+    return [pair for option, pairs in REPLACEMENTS if option in options for pair in pairs]
+
+
+def fix_text(text, pairs):
+    """Замены pairs и схлопывание подряд идущих пробелов. Ни одна замена не затрагивает переводов строк,
+    так что результат один и тот же, делать ли это над всем файлом или над каждой строкой по отдельности."""
+    for old, new in pairs:
+        if old in text:
+            text = text.replace(old, new)
+    if '  ' in text:
+        text = SPACES.sub(' ', text)
+    return text
+
+
 class Subs:
     ResX, ResY = 1920, 1080
     verbose = True
@@ -167,74 +276,195 @@ class Subs:
         for i in self.events:
             yield i
 
-    def parse(self, filename):
-        match = re.search(r'\[Script Info\](.*?)PlayResX: (\d+)\s+PlayResY: (\d+)(.*?)(\[Aegisub Project Garbage\].*?)?'
-                          r'\[V4\+ Styles\](.*?)\[Events\](.*)', file_to_text(filename), re.DOTALL)
-        if match is None:
+    def parse(self, filename, encoding='utf-8'):
+        """Читает файл построчно, секция за секцией, не держа в памяти весь текст.
+        Между строкой PlayResY и следующей секцией всё отбрасывается, из [Aegisub Project Garbage]
+        строки берутся как есть, в стилях и событиях - только строки после первой строки Format."""
+        section, info, garbage, resolution = None, [], [], []
+        style_format = event_format = None
+        for line in file_lines(filename, encoding):
+            if section is None:
+                if '[Script Info]' in line:
+                    section = 'info'
+                    info.append(line[line.index('[Script Info]') + len('[Script Info]'):])
+            elif section == 'info':
+                if not resolution:
+                    match = re.match(r'PlayResX: (\d+)', line)
+                    if match is None:
+                        info.append(line)
+                    else:
+                        resolution.append(int(match.group(1)))
+                elif line.strip():
+                    match = re.match(r'\s*PlayResY: (\d+)', line)
+                    if match is None:
+                        break
+                    resolution.append(int(match.group(1)))
+                    section = 'header'
+            elif section in ('header', 'garbage') and line.startswith('[V4+ Styles]'):
+                section = 'styles'
+            elif section == 'header':
+                if line.startswith('[Aegisub Project Garbage]'):
+                    section = 'garbage'
+                    garbage.append(line)
+            elif section == 'garbage':
+                garbage.append(line)
+            elif section == 'styles':
+                if line.startswith('[Events]'):
+                    section = 'events'
+                elif style_format is None:
+                    if FORMAT_LINE.fullmatch(line):
+                        style_format = line
+                elif line.startswith('Style: '):
+                    self.add_style(Style(line[len('Style: '):]))
+            elif event_format is None:
+                if FORMAT_LINE.fullmatch(line):
+                    event_format = line
+            elif line.startswith('Dialogue: '):
+                new_event = Event(line[len('Dialogue: '):])
+                self.events.append(new_event)
+                self.existing_styles.add(new_event.style)
+        if section != 'events':
             raise SyntaxError("Bad .ass file structure in {}, cannot process it.".format(filename))
-        self.info, X, Y, _, self.garbage, styles, events = [match.group(i) for i in range(1, 8)]
-        if self.garbage is None:
-            self.garbage = ''
-        if self.verbose and int(X) != self.ResX or int(Y) != self.ResY:
-            print('Warning: wrong resolution in file "{}".'.format(filename))
-        m_styles = re.search(r'(Format: [a-zA-Z, ]*)\n(.*)', styles, re.DOTALL)
-        if m_styles is None:
+        if style_format is None:
             raise SyntaxError("Bad styles structure in {}, cannot process it.".format(filename))
-        self.style_format = m_styles.group(1)
-        for line in m_styles.group(2).split('\n'):
-            begin = 'Style: '
-            if line[:len(begin)] == begin:
-                new_style = Style(line[len(begin):])
-                name = new_style.name
-                if name in self.styles:
-                    if self.verbose and self.styles[name] != new_style:
-                        print("Style collision: {0}!\n{1}\n{2}\n\n"
-                              .format(name, repr(self.styles[name]), repr(new_style)))
-                else:
-                    self.styles[name] = new_style
-        m_events = re.search(r'(Format: [a-zA-Z, ]*)\n(.*)', events, re.DOTALL)
-        if m_events is None:
+        if event_format is None:
             raise SyntaxError("Bad events structure in {}, cannot process it.".format(filename))
-        self.event_format = m_events.group(1)
-        for line in m_events.group(2).split("\n"):
-            begin = 'Dialogue: '
-            if line[:len(begin)] == begin:
-                new_event = Event(line[len(begin):])
-                self.events.append(new_event)
-                self.existing_styles.add(new_event.style)
+        self.info, self.garbage = '\n'.join(info) + '\n', ''.join(line + '\n' for line in garbage)
+        self.style_format, self.event_format = style_format, event_format
+        if self.verbose and resolution != [self.ResX, self.ResY]:
+            print('Warning: wrong resolution in file "{}".'.format(filename))
         return self
 
+    def add_style(self, new_style):
+        name = new_style.name
+        if name in self.styles:
+            if self.verbose and self.styles[name] != new_style:
+                print("Style collision: {0}!\n{1}\n{2}\n\n"
+                      .format(name, repr(self.styles[name]), repr(new_style)))
+        else:
+            self.styles[name] = new_style
+
     def join_styles(self, default):
         """Default is a boolean variable which is True if we need to set the default parameters to styles
         like fontsize = 68"""
         output_styles = [(str if default else repr)(self.styles[i]) for i in self.existing_styles]
         return '{}\n'.format(self.style_format) + '\n'.join(sorted(output_styles))
 
-    def join_events(self, default):
-        """Default is a variable of values 'actorless', 'default', 'full'"""
-        self.events.sort()
+    def event_lines(self, default):
+        """Строки событий по порядку, без 'Format'; default - как в join_events"""
+        self.events.sort(key=lambda event: (event.timing.begin_ss, event.timing.end_ss))
         for ev1, ev2 in pairwise(self.events):
             if self.verbose and ev1.timing.end_ss > ev2.timing.begin_ss:
                 print("Warning: event collision:\n{0}\n{1}".format(ev1, ev2))
         func = {'actorless': (lambda i: i.actorless_str), 'default': str, 'full': repr}[default]
-        return '{}\n'.format(self.event_format) + '\n'.join(func(i) for i in self.events)
+        return map(func, self.events)
 
-    def output(self, filename, encoding='utf-8', **options):
-        text = '[Script Info]{self.info}PlayResX: {self.ResX}\nPlayResY: {self.ResY}\n\n' \
-               '{garbage}[V4+ Styles]\n{styles}\n\n[Events]\n{events}'\
+    def join_events(self, default):
+        """Default is a variable of values 'actorless', 'default', 'full'"""
+        return '{}\n'.format(self.event_format) + '\n'.join(self.event_lines(default))
+
+    def header(self, **options):
+        """Всё, что в файле идёт до строки формата событий"""
+        return '[Script Info]{self.info}PlayResX: {self.ResX}\nPlayResY: {self.ResY}\n\n' \
+               '{garbage}[V4+ Styles]\n{styles}\n\n[Events]\n'\
                 .format(self=self, garbage=('' if options['remove_garbage'] else self.garbage),
-                        styles=self.join_styles(options['default_styles']),
-                        events=self.join_events(options['default_events']))
-        if 'unify' in options:
-            text = text.replace('...', '…').replace(' - ', ' — ')
-        if 'rusify' in options:
-            text = text.replace('…?', '?..').replace('…!', '!..')
-        if 'englify' in options:
-            text = text.replace('?..', '…?').replace('!..', '…!')
-        text = re.sub(r' +', ' ', text)
-        f = open(filename, "wb")
-        f.write(text.replace('\n', '\r\n').encode(encoding))
-        f.close()
+                        styles=self.join_styles(options['default_styles']))
+
+    def output(self, filename, encoding='utf-8', **options):
+        """Пишет файл через буфер строка за строкой: замены по опциям unify, rusify, englify делаются
+        над каждой строкой по отдельности (см. fix_text), а '\n' становится '\r\n' при записи"""
+        pairs = replacements(options)
+        with open(filename, 'w', encoding=encoding, newline='\r\n', buffering=2**16) as f:
+            f.write(fix_text(self.header(**options) + self.event_format + '\n', pairs))
+            separator = ''
+            for line in self.event_lines(options['default_events']):
+                f.write(separator + fix_text(line, pairs))
+                separator = '\n'
+
+
+class Srt:
+    """Сабы .srt: только события, без стилей и заголовка. Интерфейс тот же, что у Subs, так что main.shift_subs
+    и слияние (merge_parts) работают с ними одинаково"""
+    def __init__(self):
+        self.events = []
+
+    def __getitem__(self, item):
+        return self.events[item]
+
+    def __iadd__(self, ss):
+        for event in self.events:
+            event += ss
+        return self
+
+    def __imul__(self, koef):
+        for event in self.events:
+            event *= koef
+        return self
+
+    def __iter__(self):
+        for i in self.events:
+            yield i
+
+    def parse(self, filename, encoding='utf-8-sig'):
+        """Читает файл построчно: событие начинается со строки тайминга, а кончается пустой строкой;
+        номера событий не нужны, при записи они ставятся заново"""
+        text = None
+        for line in file_lines(filename, encoding):
+            match = SrtEvent.TIME.match(line.strip())
+            if match is not None:
+                text, timing = [], match
+            elif not line.strip():
+                if text is not None:
+                    self.events.append(SrtEvent.from_match(timing, '\n'.join(text)))
+                text = None
+            elif text is not None:
+                text.append(line)
+        if text is not None:
+            self.events.append(SrtEvent.from_match(timing, '\n'.join(text)))
+        return self
+
+    def output(self, filename, encoding='utf-8', **options):
+        """Пишет события по порядку и с новыми номерами; из options берутся только замены unify, rusify, englify"""
+        pairs = replacements(options)
+        self.events.sort(key=lambda event: (event.timing.begin_ss, event.timing.end_ss))
+        with open(filename, 'w', encoding=encoding, newline='\r\n', buffering=2**16) as f:
+            for number, event in enumerate(self.events, 1):
+                f.write(fix_text(event.block(number), pairs) + '\n\n')
+
+
+def load_subs(filename):
+    """Subs или Srt по расширению файла"""
+    return (Srt if filename.lower().endswith('.srt') else Subs)().parse(filename)
+
+
+def merge_parts(parts, to_srt=False):
+    """
+    Сливает разобранные сабы (Subs и Srt) в одни. В Srt (to_srt) события .ass попадают без тегов оформления.
+    Иначе заголовок берётся из первого Subs среди parts, стили - из всех, а события .srt получают стиль Default.
+    """
+    if to_srt:
+        result = Srt()
+        result.events = [event if isinstance(event, SrtEvent) else SrtEvent.from_event(event)
+                         for part in parts for event in part]
+        return result
+    ass = [part for part in parts if isinstance(part, Subs)]
+    if not ass:
+        raise ValueError("Cannot merge into .ass without any .ass file among the parts")
+    result = Subs()
+    result.info, result.garbage = ass[0].info, ass[0].garbage
+    result.style_format, result.event_format = ass[0].style_format, ass[0].event_format
+    for part in parts:
+        if isinstance(part, Subs):
+            for style in part.styles.values():
+                result.add_style(style)
+            result.events.extend(part.events)
+        else:
+            result.events.extend(event.to_event() for event in part)
+    if len(ass) < len(parts) and 'Default' not in result.styles:
+        result.add_style(Style('Default,{0.fontname},{0.fontsize},&H00FFFFFF,&H000000FF,&H00000000,&H00000000,'
+                               '{0.tail}'.format(Style)))
+    result.existing_styles = {event.style for event in result.events}
+    return result
 
 
 def merge(dir_name='merge', **options):
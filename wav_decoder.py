@@ -0,0 +1,50 @@
+"""
+Заменитель FFmpeg для машин, где его нет: понимает те же аргументы, что генерирует media.decoder_command,
+но умеет читать только wav-файлы. Включается в конфиге: DECODER = ['python', 'wav_decoder.py'].
+"""
+import sys
+from fractions import Fraction
+
+import numpy as np
+from scipy.io import wavfile
+from scipy.signal import resample_poly
+
+from media import PCM_TYPES
+
+
+def convert(data, rate, new_rate, channels):
+    """Сигнал в виде float от -1 до 1 с нужными частотой и числом каналов, как его отдаёт FFmpeg"""
+    if data.dtype.kind in 'iu':
+        info = np.iinfo(data.dtype)
+        data = (data.astype(float) - (info.max + info.min + 1) / 2) / ((info.max - info.min + 1) / 2)
+    if len(data.shape) > 1 and channels == 1:
+        data = np.average(data, axis=1)
+    if rate != new_rate:
+        ratio = Fraction(new_rate, rate)
+        data = resample_poly(data, ratio.numerator, ratio.denominator, axis=0)
+    return data
+
+
+def to_s16(data):
+    return np.clip(np.round(data * 32768), -32768, 32767).astype(np.int16)
+
+
+def main(args):
+    options, output = {}, args[-1]
+    flags = iter(args[:-1])
+    for flag in flags:
+        if flag in ('-i', '-ac', '-ar', '-f'):
+            options[flag] = next(flags)
+    rate, data = wavfile.read(options['-i'])
+    new_rate = int(options.get('-ar', rate))
+    data = convert(data, rate, new_rate, int(options.get('-ac', 0)))
+    if output in ('-', 'pipe:1'):
+        fmt = options.get('-f', 's16le')
+        data = to_s16(data) if fmt == 's16le' else data.astype(PCM_TYPES[fmt])
+        sys.stdout.buffer.write(data.tobytes())
+    else:
+        wavfile.write(output, new_rate, to_s16(data))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])